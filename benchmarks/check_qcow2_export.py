@@ -0,0 +1,194 @@
+"""Check qcow2-export against streaming-qcow2-writer, with qemu-img.
+
+A sparse disk image is made with random extents of data and zeros (or one is
+given), and its layout is written like ``rbd diff --format=json`` would. Both
+exporters are run on it. Their outputs are compared byte for byte, each one
+goes through ``qemu-img check``, and each one is converted back to raw with
+``qemu-img convert`` and compared with the disk. The output of qcow2-export
+is also written back with qcow2-import and compared.
+
+This needs streaming-qcow2-writer and qemu-img (qemu-utils) on the PATH, or
+given with --writer and --qemu-img. It fails if any exporter's output doesn't
+pass the check or doesn't give back the disk. Outputs that differ byte for
+byte are only reported, unless --require-identical is given.
+
+Usage: python benchmarks/check_qcow2_export.py [--size BYTES] [--seed N]
+    [--disk DISK] [--writer PATH] [--qemu-img PATH] [--require-identical]
+"""
+
+import argparse
+import filecmp
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+QCOW2_EXPORT = os.path.join(ROOT, 'ceph_backup', 'qcow2_export.py')
+QCOW2_IMPORT = os.path.join(ROOT, 'ceph_backup', 'qcow2_import.py')
+
+# Extents are placed at offsets that don't line up with clusters, to catch
+# partial clusters
+GRAIN = 4096
+
+
+def make_disk(path, size, rng):
+    """Make a sparse file with random extents of data, and some zeros."""
+    with open(path, 'wb') as fp:
+        fp.truncate(size)
+        offset = 0
+        while offset < size:
+            offset += rng.randrange(0, 64) * GRAIN * 16
+            length = min(rng.randrange(1, 256) * GRAIN, size - offset)
+            if length <= 0:
+                break
+            fp.seek(offset)
+            if rng.random() < 0.2:
+                # Allocated, but holding zeros
+                fp.write(bytes(length))
+            else:
+                fp.write(rng.randbytes(length))
+            offset += length
+
+
+def disk_layout(path):
+    """Get the allocated extents of a file, like ``rbd diff``."""
+    layout = []
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        size = os.lseek(fd, 0, os.SEEK_END)
+        offset = 0
+        while offset < size:
+            try:
+                start = os.lseek(fd, offset, os.SEEK_DATA)
+            except OSError:
+                # No more data
+                break
+            end = os.lseek(fd, start, os.SEEK_HOLE)
+            layout.append({
+                'offset': start,
+                'length': end - start,
+                'exists': 'true',
+            })
+            offset = end
+    finally:
+        os.close(fd)
+    return layout
+
+
+def export(command, disk, layout, output):
+    with open(output, 'wb') as fp:
+        subprocess.run(command + [disk, layout], stdout=fp, check=True)
+
+
+def qemu_check(qemu_img, name, image, disk):
+    """Run ``qemu-img check`` and compare the converted image to the disk."""
+    ok = True
+    proc = subprocess.run(
+        [qemu_img, 'check', '-f', 'qcow2', image],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+    )
+    if proc.returncode != 0:
+        print("%s: qemu-img check failed:" % name)
+        print(proc.stdout.decode('utf-8', 'replace'))
+        ok = False
+    else:
+        print("%s: qemu-img check passed" % name)
+
+    raw = image + '.raw'
+    subprocess.run(
+        [qemu_img, 'convert', '-f', 'qcow2', '-O', 'raw', image, raw],
+        check=True,
+    )
+    if filecmp.cmp(raw, disk, shallow=False):
+        print("%s: converted image matches the disk" % name)
+    else:
+        print("%s: converted image differs from the disk" % name)
+        ok = False
+    return ok
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Check qcow2-export against streaming-qcow2-writer",
+    )
+    parser.add_argument('--size', type=int, default=256 << 20)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--disk', help="Use this disk image instead")
+    parser.add_argument(
+        '--writer',
+        default=shutil.which('streaming-qcow2-writer'),
+    )
+    parser.add_argument('--qemu-img', default=shutil.which('qemu-img'))
+    parser.add_argument(
+        '--require-identical', action='store_true', default=False,
+        help="Fail if the outputs of the exporters differ byte for byte",
+    )
+    args = parser.parse_args()
+
+    if not args.writer or not args.qemu_img:
+        sys.exit("streaming-qcow2-writer and qemu-img are needed")
+
+    tmp = tempfile.mkdtemp(prefix='check-qcow2-')
+    try:
+        disk = args.disk
+        if disk is None:
+            disk = os.path.join(tmp, 'disk')
+            make_disk(disk, args.size, random.Random(args.seed))
+        layout = os.path.join(tmp, 'layout.json')
+        with open(layout, 'w') as fp:
+            json.dump(disk_layout(disk), fp)
+
+        ours = os.path.join(tmp, 'qcow2-export.qcow2')
+        theirs = os.path.join(tmp, 'streaming-qcow2-writer.qcow2')
+        export([sys.executable, QCOW2_EXPORT], disk, layout, ours)
+        export([args.writer], disk, layout, theirs)
+
+        ok = True
+        if filecmp.cmp(ours, theirs, shallow=False):
+            print("Outputs are identical")
+        else:
+            print(
+                (
+                    "Outputs differ: qcow2-export %d bytes, "
+                    + "streaming-qcow2-writer %d bytes"
+                ) % (os.path.getsize(ours), os.path.getsize(theirs)),
+            )
+            if args.require_identical:
+                ok = False
+
+        ok = qemu_check(args.qemu_img, 'qcow2-export', ours, disk) and ok
+        ok = qemu_check(
+            args.qemu_img, 'streaming-qcow2-writer', theirs, disk,
+        ) and ok
+
+        # Write it back the way restores do
+        restored = os.path.join(tmp, 'restored')
+        with open(restored, 'wb') as fp:
+            fp.truncate(os.path.getsize(disk))
+        with open(ours, 'rb') as fp:
+            subprocess.run(
+                [sys.executable, QCOW2_IMPORT, '--skip-zeros', restored],
+                stdin=fp,
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+        if filecmp.cmp(restored, disk, shallow=False):
+            print("qcow2-import: restored image matches the disk")
+        else:
+            print("qcow2-import: restored image differs from the disk")
+            ok = False
+    finally:
+        shutil.rmtree(tmp)
+
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,470 @@
+"""A stand-in for the Kubernetes API server, serving objects from memory.
+
+It implements the subset of the API that ceph-backup uses: get, list (with
+label selectors, pagination and watch), create, merge-patch, replace,
+delete and deletecollection, on any resource path. It counts the requests
+it serves and the bytes it sends.
+"""
+
+import copy
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import itertools
+import json
+import re
+import sys
+import threading
+import time
+from urllib.parse import urlsplit, parse_qs
+import uuid
+
+
+PATH_RE = re.compile(
+    r'^/(api/v1|apis/[^/]+/[^/]+)'
+    r'(?:/namespaces/([^/]+))?'
+    r'/([^/]+)(?:/([^/]+))?(?:/(status))?$'
+)
+
+KINDS = {
+    'namespaces': 'Namespace',
+    'persistentvolumes': 'PersistentVolume',
+    'persistentvolumeclaims': 'PersistentVolumeClaim',
+    'jobs': 'Job',
+    'pods': 'Pod',
+    'nodes': 'Node',
+    'configmaps': 'ConfigMap',
+    'leases': 'Lease',
+    'volumeattachments': 'VolumeAttachment',
+}
+
+
+def parse_selector(selector):
+    """Parse a label selector into a list of predicates on label dicts."""
+    if not selector:
+        return []
+    # Split on commas that are not inside parentheses
+    terms = re.findall(r'[^,(]+(?:\([^)]*\))?', selector)
+    predicates = []
+    for term in terms:
+        term = term.strip()
+        m = re.match(r'^(\S+)\s+(in|notin)\s+\((.*)\)$', term)
+        if m:
+            key, op, values = m.groups()
+            values = set(v.strip() for v in values.split(','))
+            if op == 'in':
+                predicates.append(
+                    lambda labels, k=key, v=values: labels.get(k) in v
+                )
+            else:
+                predicates.append(
+                    lambda labels, k=key, v=values: labels.get(k) not in v
+                )
+        elif '!=' in term:
+            key, value = term.split('!=', 1)
+            predicates.append(
+                lambda labels, k=key, v=value: labels.get(k) != v
+            )
+        elif '=' in term:
+            key, value = term.split('=', 1)
+            key = key.rstrip('=')
+            predicates.append(
+                lambda labels, k=key, v=value: labels.get(k) == v
+            )
+        elif term.startswith('!'):
+            predicates.append(lambda labels, k=term[1:]: k not in labels)
+        else:
+            predicates.append(lambda labels, k=term: k in labels)
+    return predicates
+
+
+def merge_patch(target, patch):
+    if not isinstance(patch, dict):
+        return patch
+    if not isinstance(target, dict):
+        target = {}
+    for key, value in patch.items():
+        if value is None:
+            target.pop(key, None)
+        else:
+            target[key] = merge_patch(target.get(key), value)
+    return target
+
+
+class Store(object):
+    def __init__(self):
+        self.lock = threading.Condition()
+        self.resource_version = itertools.count(1)
+        self.current_version = 0
+        # (prefix, resource) -> {(namespace, name): object}
+        self.collections = {}
+        # Sorted and filtered lists, to serve paginated lists quickly
+        self._selections = {}
+        # List of (version, prefix, resource, type, object)
+        self.events = []
+        self.requests = 0
+        self.requests_by_verb = {}
+        self.bytes_sent = 0
+
+    def _next_version(self):
+        self.current_version = next(self.resource_version)
+        return str(self.current_version)
+
+    def collection(self, prefix, resource):
+        return self.collections.setdefault((prefix, resource), {})
+
+    def put(self, prefix, resource, obj, event='ADDED'):
+        """Store an object (used to seed data and by the handlers).
+
+        If ``event`` is None, no watch event is recorded, which is faster to
+        seed a lot of objects.
+        """
+        with self.lock:
+            meta = obj.setdefault('metadata', {})
+            meta.setdefault('uid', str(uuid.uuid4()))
+            meta.setdefault(
+                'creationTimestamp',
+                time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            )
+            meta['resourceVersion'] = self._next_version()
+            key = meta.get('namespace'), meta['name']
+            self.collection(prefix, resource)[key] = obj
+            if event is not None:
+                self.events.append((
+                    self.current_version, prefix, resource, event, obj,
+                ))
+                self.lock.notify_all()
+            return obj
+
+    def delete(self, prefix, resource, key):
+        with self.lock:
+            obj = self.collection(prefix, resource).pop(key)
+            obj = copy.deepcopy(obj)
+            obj['metadata']['resourceVersion'] = self._next_version()
+            self.events.append((
+                self.current_version, prefix, resource, 'DELETED', obj,
+            ))
+            self.lock.notify_all()
+            return obj
+
+    def select(self, prefix, resource, namespace, selector):
+        with self.lock:
+            key = prefix, resource, namespace, selector
+            cached = self._selections.get(key)
+            if cached is not None and cached[1] == str(self.current_version):
+                return cached
+            predicates = parse_selector(selector)
+            items = [
+                obj
+                for (ns, name), obj in sorted(
+                    self.collection(prefix, resource).items(),
+                    key=lambda i: (i[0][0] or '', i[0][1]),
+                )
+                if (namespace is None or ns == namespace)
+                and all(
+                    p(obj['metadata'].get('labels') or {})
+                    for p in predicates
+                )
+            ]
+            cached = self._selections[key] = (
+                items, str(self.current_version),
+            )
+            return cached
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    @property
+    def store(self):
+        return self.server.store
+
+    def _count(self, verb):
+        with self.store.lock:
+            self.store.requests += 1
+            self.store.requests_by_verb[verb] = (
+                self.store.requests_by_verb.get(verb, 0) + 1
+            )
+
+    def _send(self, code, body):
+        data = json.dumps(body).encode('utf-8')
+        with self.store.lock:
+            self.store.bytes_sent += len(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _status(self, code, reason, message=''):
+        self._send(code, {
+            'kind': 'Status',
+            'apiVersion': 'v1',
+            'status': 'Failure',
+            'reason': reason,
+            'message': message,
+            'code': code,
+        })
+
+    def _read_body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return None
+        return json.loads(self.rfile.read(length))
+
+    def _parse(self):
+        url = urlsplit(self.path)
+        m = PATH_RE.match(url.path)
+        if not m:
+            return None
+        prefix, namespace, resource, name, subresource = m.groups()
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        return prefix, namespace, resource, name, subresource, query
+
+    def _kind(self, resource):
+        return KINDS.get(resource, resource.capitalize())
+
+    def _api_version(self, prefix):
+        if prefix == 'api/v1':
+            return 'v1'
+        return prefix[5:]
+
+    def do_GET(self):
+        parsed = self._parse()
+        if parsed is None:
+            self._count('other')
+            return self._status(404, 'NotFound')
+        prefix, namespace, resource, name, subresource, query = parsed
+
+        if name is not None:
+            self._count('get')
+            with self.store.lock:
+                obj = self.store.collection(prefix, resource).get(
+                    (namespace, name),
+                )
+            if obj is None:
+                return self._status(404, 'NotFound', name)
+            return self._send(200, obj)
+
+        if query.get('watch', '').lower() in ('true', '1'):
+            self._count('watch')
+            return self._watch(prefix, namespace, resource, query)
+
+        self._count('list')
+        items, version = self.store.select(
+            prefix, resource, namespace, query.get('labelSelector'),
+        )
+        start = int(query.get('continue') or 0)
+        limit = int(query.get('limit') or 0)
+        metadata = {'resourceVersion': version}
+        if limit and start + limit < len(items):
+            metadata['continue'] = str(start + limit)
+            items = items[start:start + limit]
+        else:
+            items = items[start:]
+
+        accept = self.headers.get('Accept', '')
+        if 'as=PartialObjectMetadataList' in accept:
+            items = [
+                {
+                    'kind': 'PartialObjectMetadata',
+                    'apiVersion': 'meta.k8s.io/v1',
+                    'metadata': obj['metadata'],
+                }
+                for obj in items
+            ]
+            kind = 'PartialObjectMetadataList'
+            api_version = 'meta.k8s.io/v1'
+        else:
+            kind = self._kind(resource) + 'List'
+            api_version = self._api_version(prefix)
+        self._send(200, {
+            'kind': kind,
+            'apiVersion': api_version,
+            'metadata': metadata,
+            'items': items,
+        })
+
+    def _watch(self, prefix, namespace, resource, query):
+        since = int(query.get('resourceVersion') or 0)
+        timeout = float(query.get('timeoutSeconds') or 60)
+        predicates = parse_selector(query.get('labelSelector'))
+        deadline = time.monotonic() + timeout
+        metadata_only = 'as=PartialObjectMetadata;' in \
+            self.headers.get('Accept', '')
+
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.end_headers()
+
+        def write_chunk(data):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(data), data))
+            self.wfile.flush()
+
+        position = 0
+        try:
+            while True:
+                with self.store.lock:
+                    events = self.store.events[position:]
+                    position = len(self.store.events)
+                    if not events:
+                        remaining = deadline - time.monotonic()
+                        if remaining <= 0:
+                            break
+                        self.store.lock.wait(min(remaining, 1))
+                        continue
+                for version, e_prefix, e_resource, type_, obj in events:
+                    if version <= since:
+                        continue
+                    if (e_prefix, e_resource) != (prefix, resource):
+                        continue
+                    meta = obj['metadata']
+                    if namespace is not None and \
+                            meta.get('namespace') != namespace:
+                        continue
+                    if not all(
+                        p(meta.get('labels') or {}) for p in predicates
+                    ):
+                        continue
+                    if metadata_only:
+                        obj = {
+                            'kind': 'PartialObjectMetadata',
+                            'apiVersion': 'meta.k8s.io/v1',
+                            'metadata': meta,
+                        }
+                    data = json.dumps({'type': type_, 'object': obj})
+                    data = data.encode('utf-8') + b'\n'
+                    with self.store.lock:
+                        self.store.bytes_sent += len(data)
+                    write_chunk(data)
+            write_chunk(b'')
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+    def do_POST(self):
+        parsed = self._parse()
+        self._count('create')
+        if parsed is None:
+            return self._status(404, 'NotFound')
+        prefix, namespace, resource, name, subresource, query = parsed
+        obj = self._read_body()
+        meta = obj.setdefault('metadata', {})
+        if namespace is not None:
+            meta['namespace'] = namespace
+        if not meta.get('name'):
+            meta['name'] = meta['generateName'] + uuid.uuid4().hex[:5]
+        obj.setdefault('kind', self._kind(resource))
+        obj.setdefault('apiVersion', self._api_version(prefix))
+        with self.store.lock:
+            collection = self.store.collection(prefix, resource)
+            if (namespace, meta['name']) in collection:
+                return self._status(409, 'AlreadyExists', meta['name'])
+            self.store.put(prefix, resource, obj)
+        self._send(201, obj)
+
+    def do_PATCH(self):
+        parsed = self._parse()
+        self._count('patch')
+        if parsed is None:
+            return self._status(404, 'NotFound')
+        prefix, namespace, resource, name, subresource, query = parsed
+        patch = self._read_body()
+        with self.store.lock:
+            collection = self.store.collection(prefix, resource)
+            obj = collection.get((namespace, name))
+            if obj is None:
+                return self._status(404, 'NotFound', name)
+            obj = merge_patch(copy.deepcopy(obj), patch)
+            self.store.put(prefix, resource, obj, 'MODIFIED')
+        self._send(200, obj)
+
+    def do_PUT(self):
+        parsed = self._parse()
+        self._count('update')
+        if parsed is None:
+            return self._status(404, 'NotFound')
+        prefix, namespace, resource, name, subresource, query = parsed
+        obj = self._read_body()
+        with self.store.lock:
+            collection = self.store.collection(prefix, resource)
+            existing = collection.get((namespace, name))
+            if existing is None:
+                return self._status(404, 'NotFound', name)
+            expected = obj['metadata'].get('resourceVersion')
+            if expected and \
+                    expected != existing['metadata']['resourceVersion']:
+                return self._status(409, 'Conflict', name)
+            self.store.put(prefix, resource, obj, 'MODIFIED')
+        self._send(200, obj)
+
+    def do_DELETE(self):
+        parsed = self._parse()
+        if parsed is None:
+            self._count('other')
+            return self._status(404, 'NotFound')
+        prefix, namespace, resource, name, subresource, query = parsed
+        self._read_body()
+        if name is not None:
+            self._count('delete')
+            try:
+                obj = self.store.delete(prefix, resource, (namespace, name))
+            except KeyError:
+                return self._status(404, 'NotFound', name)
+            return self._send(200, obj)
+
+        self._count('deletecollection')
+        items, version = self.store.select(
+            prefix, resource, namespace, query.get('labelSelector'),
+        )
+        for obj in items:
+            meta = obj['metadata']
+            self.store.delete(
+                prefix, resource, (meta.get('namespace'), meta['name']),
+            )
+        self._send(200, {
+            'kind': self._kind(resource) + 'List',
+            'apiVersion': self._api_version(prefix),
+            'metadata': {},
+            'items': items,
+        })
+
+
+class _HTTPServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Clients going away (e.g. with watches open) is expected
+        exc = sys.exc_info()[1]
+        if not isinstance(exc, (BrokenPipeError, ConnectionResetError)):
+            super(_HTTPServer, self).handle_error(request, client_address)
+
+
+class FakeApiServer(object):
+    def __init__(self, host='127.0.0.1', port=0):
+        self.store = Store()
+        self.httpd = _HTTPServer((host, port), Handler)
+        self.httpd.store = self.store
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return 'http://%s:%d' % (host, port)
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.httpd.serve_forever,
+            daemon=True,
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.httpd.shutdown()
+
+    def reset_counters(self):
+        with self.store.lock:
+            self.store.requests = 0
+            self.store.requests_by_verb = {}
+            self.store.bytes_sent = 0
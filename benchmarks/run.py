@@ -0,0 +1,341 @@
+"""Measure how the scheduler and the metrics exporter scale.
+
+Each entry point runs in its own process against a fake API server (see
+fake_apiserver.py) filled with synthetic namespaces, PVs, PVCs and jobs,
+with an in-memory fake RBD backend. For each entry point and number of
+volumes, this reports the wall time, the number of API requests, the bytes
+sent by the API server, and the peak RSS of the process.
+
+With ``--rbd-backend cli`` or ``native``, the RBD operations go to a real
+Ceph cluster instead, through the backend the scheduler would use, with the
+images of all the volumes in ``--pool``. They are created (1 MiB each)
+before the entry point runs, and removed after, with their backup snapshots.
+This needs CEPH_USER and CEPH_CONF (a configuration file that also holds the
+keyring) in the environment, and for the native backend, the rados and rbd
+modules for the Python it runs with (python3-rados, python3-rbd with the
+distribution's Python, as in the ceph-backup image).
+
+Usage: python benchmarks/run.py [--sizes 1000,10000,100000]
+    [--entries backup_main,cleanup_jobs,collect] [--json]
+    [--rbd-backend fake|cli|native] [--pool POOL]
+"""
+
+import argparse
+from datetime import datetime, timedelta
+import json
+import os
+import resource
+import subprocess
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from benchmarks.fake_apiserver import FakeApiServer  # noqa: E402
+
+
+PREFIX = 'cephbackup.hpc.nyu.edu/'
+NAMESPACE = 'ceph-backup'
+VOLUMES_PER_NAMESPACE = 20
+
+ENTRIES = ['backup_main', 'cleanup_jobs', 'collect']
+
+
+def render_date(dt):
+    return dt.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def pool_name(i, pool=None):
+    return pool or 'pool-%d' % (i % 4)
+
+
+def seed(store, volumes, entry, pool=None):
+    """Fill the store with synthetic objects."""
+    now = datetime.utcnow()
+    created = render_date(now - timedelta(days=30))
+
+    store.put('api/v1', 'namespaces', {
+        'metadata': {'name': NAMESPACE},
+    }, None)
+    for i in range(volumes // VOLUMES_PER_NAMESPACE + 1):
+        store.put('api/v1', 'namespaces', {
+            'metadata': {'name': 'ns-%d' % i, 'annotations': {}},
+        }, None)
+
+    for i in range(volumes):
+        pv = 'pvc-%08d' % i
+        block = i % 5 == 0
+        last_attempt = now - timedelta(hours=i % 48)
+        store.put('api/v1', 'persistentvolumes', {
+            'metadata': {
+                'name': pv,
+                'creationTimestamp': created,
+                'annotations': {
+                    PREFIX + 'last-start': render_date(last_attempt),
+                    'pv.kubernetes.io/provisioned-by': 'rbd.csi.ceph.com',
+                },
+            },
+            'spec': {
+                'capacity': {'storage': '%dGi' % (1 + i % 100)},
+                'volumeMode': 'Block' if block else 'Filesystem',
+                'accessModes': ['ReadWriteOnce'],
+                'claimRef': {
+                    'namespace': 'ns-%d' % (i // VOLUMES_PER_NAMESPACE),
+                    'name': 'data-%d' % i,
+                },
+                'csi': {
+                    'driver': 'rbd.csi.ceph.com',
+                    'volumeHandle': '0001-0009-rook-%016x' % i,
+                    'fsType': None if block else 'ext4',
+                    'volumeAttributes': {
+                        'clusterID': 'rook',
+                        'pool': pool_name(i, pool),
+                        'imageName': 'csi-vol-%08d' % i,
+                        'imageFeatures': 'layering',
+                    },
+                },
+            },
+            'status': {'phase': 'Bound'},
+        }, None)
+        store.put('api/v1', 'persistentvolumeclaims', {
+            'metadata': {
+                'name': 'data-%d' % i,
+                'namespace': 'ns-%d' % (i // VOLUMES_PER_NAMESPACE),
+                'annotations': {
+                    PREFIX + 'last-backup': render_date(
+                        last_attempt - timedelta(days=1),
+                    ),
+                },
+            },
+            'spec': {
+                'volumeName': pv,
+                'volumeMode': 'Block' if block else 'Filesystem',
+                'accessModes': ['ReadWriteOnce'],
+                'resources': {
+                    'requests': {'storage': '%dGi' % (1 + i % 100)},
+                },
+            },
+            'status': {'phase': 'Bound'},
+        }, None)
+
+    # Finished backup jobs, as there would be after an hourly run
+    jobs = volumes // 24 if entry != 'backup_main' else 0
+    for i in range(jobs):
+        pv = 'pvc-%08d' % i
+        labels = {
+            PREFIX + 'volume-type': 'rbd',
+            PREFIX + 'volume-mode': 'block' if i % 5 == 0 else 'filesystem',
+            PREFIX + 'pv-name': pv,
+            PREFIX + 'pvc-namespace': 'ns-%d' % (i // VOLUMES_PER_NAMESPACE),
+            PREFIX + 'pvc-name': 'data-%d' % i,
+            PREFIX + 'rbd-pool': pool_name(i, pool),
+            PREFIX + 'rbd-name': 'csi-vol-%08d' % i,
+        }
+        store.put('apis/batch/v1', 'jobs', {
+            'metadata': {
+                'name': 'backup-rbd-%d' % i,
+                'namespace': NAMESPACE,
+                'labels': labels,
+                'annotations': {
+                    PREFIX + 'start-time': render_date(now),
+                },
+            },
+            'spec': {'template': {'spec': {'containers': []}}},
+            'status': {
+                'startTime': render_date(now),
+                'completionTime': render_date(now + timedelta(minutes=10)),
+                'succeeded': 1,
+            },
+        }, None)
+
+
+def real_rbd_backend(name):
+    """Make an RBD backend talking to Ceph, that records the calls made."""
+    from ceph_backup.rbd_backend import CliRbdBackend, \
+        InstrumentedRbdBackend, NativeRbdBackend
+
+    class CountingRbdBackend(InstrumentedRbdBackend):
+        def __init__(self, backend):
+            super(CountingRbdBackend, self).__init__(backend)
+            self.calls = []
+
+        def _call(self, operation, *args):
+            self.calls.append((operation,) + args)
+            return super(CountingRbdBackend, self)._call(operation, *args)
+
+    if name == 'cli':
+        backend = CliRbdBackend()
+    elif name == 'native':
+        backend = NativeRbdBackend(os.environ['CEPH_USER'])
+    else:
+        raise ValueError("Unknown RBD backend %r" % name)
+    return CountingRbdBackend(backend)
+
+
+def child(entry, url, volumes, rbd_backend='fake', pool=None):
+    """Run an entry point against the fake API server."""
+    import logging
+    import kubernetes.client as k8s_client
+
+    logging.basicConfig(level=logging.ERROR)
+    os.environ.setdefault('NAMESPACE', NAMESPACE)
+
+    configuration = k8s_client.Configuration(host=url)
+    k8s_client.Configuration.set_default(configuration)
+
+    from ceph_backup import backup, metrics
+    from ceph_backup.informer import ClusterCache
+    from ceph_backup.rbd_backend import FakeRbdBackend
+
+    if rbd_backend == 'fake':
+        rbd = FakeRbdBackend(create_images=True)
+        images = []
+    else:
+        rbd = real_rbd_backend(rbd_backend)
+        images = ['csi-vol-%08d' % i for i in range(volumes)]
+        for image in images:
+            if not rbd.image_exists(pool, image):
+                rbd.create_image(pool, image, 1 << 20)
+        rbd.calls = []
+    ceph = {'monitors': ['192.0.2.1'], 'secret': 'ceph-key', 'user': 'bench'}
+    result = {}
+
+    start = time.perf_counter()
+    if entry == 'backup_main':
+        backup.backup_main(datetime.utcnow(), rbd, ceph, False)
+    elif entry == 'cleanup_jobs':
+        backup.cleanup_jobs(backup.make_api_client(10), rbd)
+    elif entry == 'collect':
+        cache = ClusterCache(k8s_client.ApiClient())
+        cache.start()
+        cache.wait_synced()
+        result['sync_time'] = time.perf_counter() - start
+        start = time.perf_counter()
+        metrics.collect(cache)
+    else:
+        raise ValueError("Unknown entry point %r" % entry)
+    result['wall_time'] = time.perf_counter() - start
+
+    result['rbd_calls'] = len(rbd.calls)
+
+    for image in images:
+        backup.delete_backup_snapshot(rbd, pool, image)
+        rbd.remove_image(pool, image)
+    rbd.close()
+    # ru_maxrss is in kilobytes on Linux
+    result['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    result['peak_rss'] *= 1024
+    print(json.dumps(result))
+    sys.stdout.flush()
+    os._exit(0)
+
+
+def run(entry, volumes, rbd_backend='fake', pool=None):
+    server = FakeApiServer()
+    seed(server.store, volumes, entry, pool)
+    server.start()
+    try:
+        server.reset_counters()
+        proc = subprocess.run(
+            [
+                sys.executable, os.path.abspath(__file__),
+                '--child', entry, '--url', server.url,
+                '--volumes', '%d' % volumes,
+                '--rbd-backend', rbd_backend,
+            ] + (['--pool', pool] if pool else []),
+            stdout=subprocess.PIPE,
+            check=True,
+        )
+        result = json.loads(proc.stdout.decode('utf-8').splitlines()[-1])
+        with server.store.lock:
+            result['requests'] = server.store.requests
+            result['requests_by_verb'] = dict(server.store.requests_by_verb)
+            result['bytes'] = server.store.bytes_sent
+    finally:
+        server.stop()
+    result['entry'] = entry
+    result['volumes'] = volumes
+    return result
+
+
+def format_bytes(size):
+    for unit in ('B', 'KiB', 'MiB'):
+        if size < 1024:
+            return '%.1f %s' % (size, unit)
+        size /= 1024
+    return '%.1f GiB' % size
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark ceph-backup against a fake API server",
+    )
+    parser.add_argument('--sizes', default='1000,10000,100000')
+    parser.add_argument('--entries', default=','.join(ENTRIES))
+    parser.add_argument('--json', action='store_true', default=False)
+    parser.add_argument(
+        '--rbd-backend', choices=['fake', 'cli', 'native'], default='fake',
+        help="Where the RBD operations go (default: in memory)",
+    )
+    parser.add_argument(
+        '--pool',
+        help="Pool to create the images in, with a real RBD backend",
+    )
+    parser.add_argument('--child', help=argparse.SUPPRESS)
+    parser.add_argument('--url', help=argparse.SUPPRESS)
+    parser.add_argument('--volumes', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.rbd_backend != 'fake' and not args.pool:
+        parser.error("--pool is needed with a real RBD backend")
+
+    if args.child:
+        child(
+            args.child, args.url, args.volumes, args.rbd_backend, args.pool,
+        )
+        return
+
+    from ceph_backup.table import print_table
+
+    results = []
+    for volumes in (int(s) for s in args.sizes.split(',')):
+        for entry in args.entries.split(','):
+            result = run(entry, volumes, args.rbd_backend, args.pool)
+            results.append(result)
+            if not args.json:
+                print(
+                    "%s with %d volumes: %.2fs" % (
+                        entry, volumes, result['wall_time'],
+                    ),
+                    file=sys.stderr,
+                )
+
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+        return
+
+    table = []
+    for result in results:
+        table.append((
+            result['entry'],
+            '%d' % result['volumes'],
+            '%.2fs' % result['wall_time'],
+            '%.2fs' % result['sync_time'] if 'sync_time' in result else '',
+            '%d' % result['requests'],
+            format_bytes(result['bytes']),
+            '%d' % result['rbd_calls'],
+            format_bytes(result['peak_rss']),
+        ))
+    print_table(
+        print,
+        table,
+        (
+            'ENTRY', 'VOLUMES', 'WALL', 'CACHE SYNC', 'REQUESTS', 'BYTES',
+            'RBD CALLS', 'PEAK RSS',
+        ),
+    )
+
+
+if __name__ == '__main__':
+    main()
@@ -1,16 +1,35 @@
 import argparse
-from datetime import datetime
+from datetime import datetime, timedelta
+import itertools
+import json
 import kubernetes.client as k8s_client
 import kubernetes.config as k8s_config
 import logging
 import math
 import opentelemetry.trace
 import os
-import shlex
-import subprocess
-
+import sys
+import threading
+import time
+
+from .dispatch import run_concurrently
+from .informer import Informer
+from .instrumentation import InstrumentedApiClient, \
+    publish as publish_metrics
 from .metadata import METADATA_PREFIX, ANNOTATION_LAST_ATTEMPT, NAMESPACE, \
-    parse_date, list_volumes_to_backup
+    ANNOTATION_LAST_DURATION, ANNOTATION_LAST_FULL_BACKUP, \
+    ANNOTATION_BACKUP_SUMMARY, ANNOTATION_CHANGE_RATE, ANNOTATION_VOLUMES, \
+    ANNOTATION_LOCAL_SNAPSHOTS, ANNOTATION_BACKUP_CHAIN, JOB_LABEL_SELECTOR, \
+    local_snapshot_name, parse_bool, parse_date, parse_size, naive_utc, \
+    job_volumes, list_pages, list_volumes_to_backup, \
+    read_persistent_volume_claims, list_attached_volumes
+from .leader import LeaderElection
+from .ledger import SCHEDULE_LEDGER, SCHEDULE_LEDGER_ANNOTATIONS, Ledger, \
+    volume_shard
+from .placement import BACKUP_MAX_PODS_PER_NODE, NodeSlots, \
+    container_resources, pod_annotations, pod_placement
+from .rbd_backend import make_rbd_backend
+from .stages import StageTimes
 
 
 logger = logging.getLogger(__name__)
@@ -31,35 +50,174 @@ BACKUP_IMAGE_PULL_POLICY = os.environ.get(
     'IfNotPresent',
 )
 
+# How many volumes to set up at the same time, overall and per RBD pool
+BACKUP_CONCURRENCY = int(os.environ.get('BACKUP_CONCURRENCY', '8'), 10)
+BACKUP_POOL_CONCURRENCY = int(
+    os.environ.get('BACKUP_POOL_CONCURRENCY', '4'),
+    10,
+)
 
-def render_date(dt):
-    s = dt.isoformat()
-    assert len(s) >= 19 and s[10] == 'T'
-    return dt.isoformat()[:19] + 'Z'
+# How many backup jobs can be running at the same time, and how many bytes
+# of volumes they can be backing up in total (0 for no limit). Volumes that
+# don't fit are left for the next run, where they are the oldest due
+BACKUP_MAX_RUNNING_JOBS = int(
+    os.environ.get('BACKUP_MAX_RUNNING_JOBS', '0'),
+    10,
+)
+BACKUP_MAX_INFLIGHT_BYTES = parse_size(
+    os.environ.get('BACKUP_MAX_INFLIGHT_BYTES') or '0',
+)
+
+# Daemon mode: run a pass whenever a backup job finishes, waiting
+# DAEMON_SETTLE_SECONDS for other jobs finishing around the same time, and
+# every DAEMON_INTERVAL seconds otherwise. Replicas elect a leader through
+# the DAEMON_LEASE_NAME Lease
+DAEMON_INTERVAL = float(os.environ.get('DAEMON_INTERVAL', '300'))
+DAEMON_SETTLE_SECONDS = float(os.environ.get('DAEMON_SETTLE_SECONDS', '10'))
+DAEMON_LEASE_NAME = os.environ.get('DAEMON_LEASE_NAME', 'ceph-backup')
+
+# In daemon mode, the share of the volumes (or the budget) that is done every
+# hour is spread over the passes, counting the backups started over this many
+# seconds
+DAEMON_WINDOW = 3600
+
+# How many finished jobs to remove the PVs and PVCs of in one request
+CLEANUP_BATCH_SIZE = int(os.environ.get('CLEANUP_BATCH_SIZE', '50'), 10)
+
+# How to pick the volumes to backup on each run:
+# * "count" does 1/24th of the volumes every time
+# * "size" does up to SCHEDULER_BUDGET bytes of volumes (a quantity, such as
+#   "100Gi")
+# * "duration" does up to SCHEDULER_BUDGET seconds of estimated job runtime
+# If the budget is not set, 1/24th of the total for all volumes is used
+SCHEDULER_MODE = os.environ.get('SCHEDULER_MODE', 'count')
+if SCHEDULER_MODE == 'size':
+    SCHEDULER_BUDGET = parse_size(os.environ.get('SCHEDULER_BUDGET'))
+else:
+    SCHEDULER_BUDGET = float(os.environ.get('SCHEDULER_BUDGET') or 0)
+
+# Throughput to assume for volumes that we haven't seen a backup of yet,
+# in bytes per second, and time it takes to start and stop a job
+SCHEDULER_DEFAULT_THROUGHPUT = float(
+    os.environ.get('SCHEDULER_DEFAULT_THROUGHPUT', 20 * 1024 * 1024),
+)
+JOB_OVERHEAD = 60
+
+# How long after the last attempt a volume is due again
+DEFAULT_INTERVAL = 24 * 3600
+
+# Adaptive interval: back up each volume after about ADAPTIVE_CHANGE_TARGET
+# bytes changed, going by the data added by its previous backups, but not
+# more often than every ADAPTIVE_MIN_INTERVAL_HOURS and not less often than
+# every ADAPTIVE_MAX_AGE_HOURS
+ADAPTIVE_INTERVAL = parse_bool(os.environ.get('ADAPTIVE_INTERVAL')) or False
+ADAPTIVE_CHANGE_TARGET = parse_size(
+    os.environ.get('ADAPTIVE_CHANGE_TARGET') or '1Gi',
+)
+ADAPTIVE_MIN_INTERVAL_HOURS = float(
+    os.environ.get('ADAPTIVE_MIN_INTERVAL_HOURS', '6'),
+)
+ADAPTIVE_MAX_AGE_HOURS = float(
+    os.environ.get('ADAPTIVE_MAX_AGE_HOURS', '168'),
+)
 
+# Incremental block backups: keep the previous backup snapshot, and only
+# read the extents that changed since then, doing a full backup every
+# BLOCK_FULL_INTERVAL_DAYS
+BLOCK_INCREMENTAL = parse_bool(os.environ.get('BLOCK_INCREMENTAL')) or False
+BLOCK_FULL_INTERVAL_DAYS = float(
+    os.environ.get('BLOCK_FULL_INTERVAL_DAYS', '7'),
+)
 
-def call(args):
-    logger.info("> %s", ' '.join(shlex.quote(a) for a in args))
-    retcode = subprocess.call(args, stdout=subprocess.DEVNULL)
-    logger.info("-> %d", retcode)
-    return retcode
+# Keep the snapshots of the last LOCAL_SNAPSHOTS successful backups of each
+# volume on Ceph, as backup-local-1 (newest) to backup-local-N, for fast
+# restores (0 to remove the snapshot after the backup). Incremental block
+# backups then start from backup-local-1 instead of backup-prev
+LOCAL_SNAPSHOTS = int(os.environ.get('LOCAL_SNAPSHOTS', '0'), 10)
+
+# Program streaming block volumes as qcow2: "streaming-qcow2-writer", or
+# "qcow2-export" which reads the extents ahead with BLOCK_EXPORT_WORKERS
+# threads
+BLOCK_EXPORTER = os.environ.get('BLOCK_EXPORTER') or 'streaming-qcow2-writer'
+BLOCK_EXPORT_WORKERS = int(os.environ.get('BLOCK_EXPORT_WORKERS', '8'), 10)
+
+# Get the extents of block volumes as written rather than whole RADOS
+# objects, reading extents up to BLOCK_COALESCE_GAP bytes apart together
+# (only with qcow2-export)
+BLOCK_FINE_EXTENTS = parse_bool(os.environ.get('BLOCK_FINE_EXTENTS')) or False
+BLOCK_COALESCE_GAP = parse_size(
+    os.environ.get('BLOCK_COALESCE_GAP') or '1Mi',
+)
 
+# Read the extents of block volumes a first time to find the clusters that
+# only hold zeros, and leave them out of the backup (only with qcow2-export)
+BLOCK_DROP_ZEROS = parse_bool(os.environ.get('BLOCK_DROP_ZEROS')) or False
+
+# Mount the snapshot of filesystem volumes directly, without cloning it,
+# when the volume is not attached to any node (so the filesystem is clean)
+FS_SKIP_CLONE = parse_bool(os.environ.get('FS_SKIP_CLONE')) or False
+
+# Fast scan of filesystem volumes: use the last snapshot of the volume as
+# the parent explicitly, and don't compare inode numbers and ctimes, which
+# don't carry over to a new clone, so that unchanged files are not read again
+FS_FAST_SCAN = parse_bool(os.environ.get('FS_FAST_SCAN')) or False
+
+# Back up filesystem volumes up to FS_BATCH_VOLUME_SIZE in batches, with one
+# job for up to FS_BATCH_MAX_VOLUMES volumes and FS_BATCH_MAX_SIZE bytes,
+# instead of one job per volume (1 disables batching)
+FS_BATCH_MAX_VOLUMES = int(os.environ.get('FS_BATCH_MAX_VOLUMES', '1'), 10)
+FS_BATCH_VOLUME_SIZE = parse_size(
+    os.environ.get('FS_BATCH_VOLUME_SIZE') or '1Gi',
+)
+FS_BATCH_MAX_SIZE = parse_size(os.environ.get('FS_BATCH_MAX_SIZE') or '10Gi')
+
+# Don't run restic on a CephFS volume if the recursive ctime of its snapshot
+# (ceph.dir.rctime) shows nothing changed since the last backup started. This
+# is done for the whole volume only: restic doesn't carry the subtrees it is
+# told to exclude over from the parent snapshot, so excluding the unchanged
+# ones would leave them out of the new snapshot
+CEPHFS_RCTIME_PRUNING = parse_bool(
+    os.environ.get('CEPHFS_RCTIME_PRUNING'),
+) is not False
+
+# Allowance for the clocks of the CephFS clients, which set the ctimes, being
+# behind ours, in seconds
+CEPHFS_RCTIME_SLACK = 600
+
+# Name of the snapshot of CephFS volumes, in their .snap directory
+CEPHFS_SNAPSHOT = 'backup'
+
+# Persistent restic cache, so jobs don't download the repository index every
+# time: "none", "node" for a hostPath directory on each node, or "pvc" for a
+# shared PersistentVolumeClaim (ReadWriteMany). Concurrent jobs each lock one
+# of RESTIC_CACHE_SLOTS cache directories, starting from an empty cache if
+# they are all taken
+RESTIC_CACHE_MODE = os.environ.get('RESTIC_CACHE_MODE') or 'none'
+RESTIC_CACHE_HOST_PATH = (
+    os.environ.get('RESTIC_CACHE_HOST_PATH')
+    or '/var/cache/ceph-backup-restic'
+)
+RESTIC_CACHE_PVC = os.environ.get('RESTIC_CACHE_PVC') or None
+RESTIC_CACHE_SLOTS = int(os.environ.get('RESTIC_CACHE_SLOTS', '4'), 10)
+RESTIC_CACHE_PATH = '/var/cache/restic'
+
+# Appended to the restic command in backup jobs: keep the output in the logs,
+# and write restic's final summary as the termination message of the pod, for
+# the scheduler to copy onto the job
+RESTIC_SUMMARY = (
+    ' | tee /dev/stderr'
+    + ' | grep \'"message_type":"summary"\''
+    + ' > /dev/termination-log'
+)
 
-def check_call(args):
-    retcode = call(args)
-    if retcode != 0:
-        raise subprocess.CalledProcessError(retcode, args)
 
+stages = StageTimes()
 
-def check_output(args):
-    logger.info("> %s", ' '.join(shlex.quote(a) for a in args))
-    with subprocess.Popen(args, stdout=subprocess.PIPE) as process:
-        stdout, stderr = process.communicate()
-        retcode = process.poll()
-    logger.info("-> %d", retcode)
-    if retcode != 0:
-        raise subprocess.CalledProcessError(retcode, args)
-    return stdout
+
+def render_date(dt):
+    s = dt.isoformat()
+    assert len(s) >= 19 and s[10] == 'T'
+    return dt.isoformat()[:19] + 'Z'
 
 
 def format_env(**kwargs):
@@ -97,8 +255,15 @@ def main():
     )
     parser.add_argument('--kubeconfig', nargs=1)
     parser.add_argument('--cleanup-only', action='store_true', default=False)
+    parser.add_argument(
+        '--daemon', action='store_true', default=False,
+        help="Keep running, cleaning up jobs as they finish and starting "
+        + "new ones",
+    )
     args = parser.parse_args()
 
+    check_config()
+
     if args.kubeconfig:
         logger.info("Using specified config file")
         k8s_config.load_kube_config(args.kubeconfig[0])
@@ -106,7 +271,50 @@ def main():
         logger.info("Using in-cluster config")
         k8s_config.load_incluster_config()
 
-    ceph = {
+    ceph = ceph_from_env()
+
+    # Use the same connection to Ceph for the whole pass
+    rbd = make_rbd_backend(ceph['user'])
+
+    if args.daemon:
+        try:
+            daemon_main(rbd, ceph)
+        finally:
+            rbd.close()
+        return
+
+    try:
+        with tracer.start_as_current_span(
+            'ceph-backup',
+            attributes={'cleanup_only': args.cleanup_only},
+        ):
+            failures = backup_main(now, rbd, ceph, args.cleanup_only)
+    finally:
+        rbd.close()
+        publish_metrics()
+    if failures:
+        sys.exit(1)
+
+
+def check_config():
+    """Fail on settings that don't go together, before doing anything."""
+    if SCHEDULER_MODE not in ('count', 'size', 'duration'):
+        raise ValueError("Unknown SCHEDULER_MODE %r" % SCHEDULER_MODE)
+    if BLOCK_EXPORTER not in ('qcow2-export', 'streaming-qcow2-writer'):
+        raise ValueError("Unknown BLOCK_EXPORTER %r" % BLOCK_EXPORTER)
+    if BLOCK_INCREMENTAL and BLOCK_EXPORTER != 'qcow2-export':
+        # Only qcow2-export records the extents zeroed since the previous
+        # backup
+        raise ValueError("BLOCK_INCREMENTAL needs qcow2-export")
+    if BLOCK_FINE_EXTENTS and BLOCK_EXPORTER != 'qcow2-export':
+        raise ValueError("BLOCK_FINE_EXTENTS needs qcow2-export")
+    if BLOCK_DROP_ZEROS and BLOCK_EXPORTER != 'qcow2-export':
+        raise ValueError("BLOCK_DROP_ZEROS needs qcow2-export")
+
+
+def ceph_from_env():
+    """Get how pods connect to Ceph, from the environment."""
+    return {
         'monitors': [
             mon for mon in os.environ['CEPH_MONITORS'].split(',')
             if mon
@@ -115,25 +323,53 @@ def main():
         'user': os.environ['CEPH_USER'],
     }
 
-    with tracer.start_as_current_span(
-        'ceph-backup',
-        attributes={'cleanup_only': args.cleanup_only},
-    ):
-        backup_main(now, ceph, args.cleanup_only)
 
+def make_api_client(concurrency):
+    # Have enough connections for all the threads
+    configuration = k8s_client.Configuration.get_default_copy()
+    configuration.connection_pool_maxsize = max(
+        configuration.connection_pool_maxsize,
+        concurrency,
+    )
+    return InstrumentedApiClient(configuration)
 
-def backup_main(now, ceph, cleanup_only):
-    api = k8s_client.ApiClient()
-    corev1 = k8s_client.CoreV1Api(api)
 
+def backup_main(now, rbd, ceph, cleanup_only, window=None):
+    api = make_api_client(BACKUP_CONCURRENCY)
+
+    # Read the scheduling state of all the volumes at once
+    ledger = None
+    if SCHEDULE_LEDGER:
+        with stages.stage('ledger-read'):
+            ledger = Ledger.load(api)
+
+    try:
+        return backup_pass(
+            api, now, rbd, ceph, cleanup_only, ledger, window,
+        )
+    finally:
+        # Write the changes to the state at once
+        if ledger is not None:
+            with stages.stage('ledger-write'):
+                ledger.flush(api, BACKUP_CONCURRENCY)
+        stages.log_summary(logger.info)
+        stages.reset()
+
+
+def backup_pass(
+    api, now, rbd, ceph, cleanup_only, ledger=None, window=None,
+):
     # Clean old jobs
-    currently_backing_up = cleanup_jobs(api)
+    with stages.stage('cleanup'):
+        currently_backing_up = cleanup_jobs(api, rbd, ledger)
 
     if cleanup_only:
-        return
+        return []
 
     # Back up volumes
-    to_backup = build_list_to_backup(api, now)
+    with stages.stage('list'):
+        to_backup = build_list_to_backup(api, now, ledger, window)
+    to_dispatch = []
     for vol in to_backup:
         if vol['pv'] in currently_backing_up:
             logger.warning(
@@ -144,122 +380,419 @@ def backup_main(now, ceph, cleanup_only):
                 vol['rbd_pool'], vol['rbd_name'],
                 vol['mode'],
                 vol['size'] or 'unknown',
-                currently_backing_up[vol['pv']],
+                currently_backing_up[vol['pv']][0],
             )
             continue
+        to_dispatch.append(vol)
 
-        logger.info(
-            'Backing up: pv=%s, pvc=%s/%s, rbd=%s/%s, mode=%s, size=%s',
+    # Find which volumes are attached to a node
+    attached = None
+    if FS_SKIP_CLONE and any(
+        vol['type'] == 'rbd' and vol['mode'] == 'Filesystem'
+        for vol in to_dispatch
+    ):
+        with stages.stage('list-volume-attachments'):
+            attached = list_attached_volumes(api)
+
+    # Group small filesystem volumes, to back them up with fewer jobs
+    if FS_BATCH_MAX_VOLUMES > 1:
+        items = batch_small_volumes(to_dispatch)
+    else:
+        items = to_dispatch
+
+    # Don't go over the limits on running jobs and bytes being backed up
+    if BACKUP_MAX_RUNNING_JOBS or BACKUP_MAX_INFLIGHT_BYTES:
+        items = limit_in_flight(items, currently_backing_up)
+        to_dispatch = [vol for item in items for vol in item_volumes(item)]
+
+    # Only start as many jobs as there is room for on the nodes, the other
+    # volumes will be picked up by the next run
+    slots = None
+    if BACKUP_MAX_PODS_PER_NODE:
+        with stages.stage('list-nodes'):
+            slots = NodeSlots.load(api)
+        room = slots.total()
+        if len(items) > room:
+            logger.warning(
+                "Nodes are full, deferring %d of %d jobs",
+                len(items) - room, len(items),
+            )
+            items = items[:room]
+            to_dispatch = [
+                vol for item in items for vol in item_volumes(item)
+            ]
+
+    batch_failures = []
+
+    def backup_item(item):
+        node = slots.reserve() if slots is not None else None
+        if slots is not None and node is None:
+            raise RuntimeError("No room left for backup pods on any node")
+        if isinstance(item, list):
+            batch_failures.extend(
+                backup_rbd_fs_batch(
+                    api, rbd, ceph, item, now, attached, node, ledger,
+                ),
+            )
+        else:
+            backup_volume(
+                api, rbd, ceph, item, now, attached, node, ledger,
+            )
+
+    with stages.stage('dispatch'):
+        failures = run_concurrently(
+            backup_item,
+            items,
+            BACKUP_CONCURRENCY,
+            key=lambda item: item_volumes(item)[0]['rbd_pool'] or (
+                item_volumes(item)[0]['cephfs_fs']
+            ),
+            max_per_key=BACKUP_POOL_CONCURRENCY,
+        )
+    failures = [
+        (vol, exception)
+        for item, exception in failures
+        for vol in item_volumes(item)
+    ] + batch_failures
+    for vol, exception in failures:
+        logger.error(
+            "Backup failed: pv=%s, pvc=%s/%s, rbd=%s/%s",
             vol['pv'],
             vol['namespace'], vol['name'],
             vol['rbd_pool'], vol['rbd_name'],
-            vol['mode'],
-            vol['size'] or 'unknown',
+            exc_info=exception,
         )
 
-        vol_otel_attributes = {
-            'pvc_namespace': vol['namespace'],
-            'pvc': vol['name'],
-        }
+    logger.info(
+        "Started %d backups, %d failed",
+        len(to_dispatch) - len(failures),
+        len(failures),
+    )
+    return failures
 
-        # Annotate the PV
-        with tracer.start_as_current_span(
-            'annotate-pv',
-            attributes=vol_otel_attributes,
+
+def item_volumes(item):
+    """Get the volumes of a volume or batch of volumes."""
+    return item if isinstance(item, list) else [item]
+
+
+def limit_in_flight(items, currently_backing_up):
+    """Keep the volumes or batches that fit in the in-flight limits.
+
+    ``currently_backing_up`` is what ``cleanup_jobs()`` returned, the jobs
+    that are still running (or not cleaned up) and the size of their volumes.
+    The items are taken in order, stopping at the first one that doesn't fit,
+    so that the others wait for the next run behind it.
+    """
+    running_jobs = len(set(
+        job_name for job_name, size in currently_backing_up.values()
+    ))
+    running_bytes = sum(
+        size for job_name, size in currently_backing_up.values()
+    )
+    logger.info(
+        "%d backup jobs running, backing up %d bytes",
+        running_jobs, running_bytes,
+    )
+
+    jobs = running_jobs
+    in_flight = running_bytes
+    kept = 0
+    for item in items:
+        size = sum(parse_size(vol['size']) for vol in item_volumes(item))
+        if BACKUP_MAX_RUNNING_JOBS and jobs + 1 > BACKUP_MAX_RUNNING_JOBS:
+            break
+        # Always allow one job, even if it is bigger than the limit
+        if (
+            BACKUP_MAX_INFLIGHT_BYTES
+            and jobs > 0
+            and in_flight + size > BACKUP_MAX_INFLIGHT_BYTES
         ):
-            corev1.patch_persistent_volume(vol['pv'], {
-                'metadata': {
-                    'annotations': {
-                        ANNOTATION_LAST_ATTEMPT: render_date(now),
-                    },
-                },
-            })
+            break
+        jobs += 1
+        in_flight += size
+        kept += 1
+
+    if kept < len(items):
+        logger.warning(
+            "In-flight limits reached (%d jobs, %d bytes), deferring %d of "
+            + "%d jobs",
+            jobs, in_flight, len(items) - kept, len(items),
+        )
+    return items[:kept]
 
-        if vol['mode'] == 'Filesystem':
-            with tracer.start_as_current_span(
-                'backup_rbd_fs',
-                attributes=vol_otel_attributes,
-            ):
-                backup_rbd_fs(api, ceph, vol, now)
-        else:
+
+def daemon_main(rbd, ceph):
+    """Run passes as backup jobs finish, while we are the leader."""
+    api = make_api_client(BACKUP_CONCURRENCY)
+
+    LeaderElection(api, DAEMON_LEASE_NAME).acquire()
+
+    if not BACKUP_MAX_RUNNING_JOBS and not BACKUP_MAX_INFLIGHT_BYTES:
+        logger.warning(
+            "Running as a daemon without in-flight limits, every volume "
+            + "that is due will be started right away",
+        )
+
+    # Watch the backup jobs, to know when one finishes
+    finished = threading.Event()
+
+    def job_event(event_type, job):
+        completed, successful = job_status(job)
+        if (
+            event_type != 'DELETED'
+            and completed
+            and not (job.metadata.annotations or {}).get(
+                METADATA_PREFIX + 'cleaned-up',
+            )
+        ):
+            finished.set()
+
+    jobs = Informer(
+        'jobs',
+        lambda job: None,
+        k8s_client.BatchV1Api(api).list_namespaced_job,
+        NAMESPACE,
+        label_selector=JOB_LABEL_SELECTOR,
+    )
+    jobs.add_handler(job_event)
+    jobs.start()
+
+    while True:
+        try:
             with tracer.start_as_current_span(
-                'backup_rbd_block',
-                attributes=vol_otel_attributes,
+                'ceph-backup',
+                attributes={'cleanup_only': False},
             ):
-                backup_rbd_block(api, ceph, vol, now)
+                backup_main(
+                    datetime.utcnow(), rbd, ceph, False, DAEMON_WINDOW,
+                )
+        except Exception:
+            logger.exception("Pass failed")
+        publish_metrics()
 
+        # Wait for a job to finish, then for the other jobs finishing
+        # around the same time, so they are handled in the same pass
+        if finished.wait(DAEMON_INTERVAL):
+            time.sleep(DAEMON_SETTLE_SECONDS)
+        finished.clear()
 
-def build_list_to_backup(api, now):
-    to_backup = list_volumes_to_backup(api)
 
-    total_volumes = len(to_backup)
+def annotate_last_attempt(api, vol, now, ledger=None):
+    corev1 = k8s_client.CoreV1Api(api)
 
-    # Select based on last attempt
-    limit = 24 * 3600 - 30 * 60  # 23:30:00
-    to_backup = [
-        vol for vol in to_backup
-        if (
-            vol['last_attempt'] is None
-            or (now - vol['last_attempt']).total_seconds() > limit
+    if ledger is not None:
+        ledger.record(
+            vol['pv'], last_attempt=render_date(now), size=vol['size'],
         )
-    ]
+        if not SCHEDULE_LEDGER_ANNOTATIONS:
+            return
 
-    # Order the list by last backup
-    time_zero = datetime(1970, 1, 1)
-    to_backup = sorted(
-        to_backup,
-        key=lambda vol: vol['last_attempt'] or time_zero,
-    )
+    with stages.stage(
+        'annotate-pv',
+        attributes={'pvc_namespace': vol['namespace'], 'pvc': vol['name']},
+    ):
+        corev1.patch_persistent_volume(vol['pv'], {
+            'metadata': {
+                'annotations': {
+                    ANNOTATION_LAST_ATTEMPT: render_date(now),
+                },
+            },
+        })
 
-    # Instead of doing all the backups that are due right now,
-    # we do 1/24th of the total backups
-    # This is to spread out the backup times if they all coincide
-    do_now = min(math.ceil(total_volumes / 24), len(to_backup))
-    logger.info("%d volumes to backup, doing %d now", len(to_backup), do_now)
-    to_backup = to_backup[:do_now]
 
-    return to_backup
+def batch_small_volumes(volumes):
+    """Group the small filesystem volumes of each pool into batches.
 
+    Returns a list of volumes and of lists of volumes, in the original order
+    of their first volume.
+    """
+    items = []
+    batches = {}
+    for vol in volumes:
+        size = parse_size(vol['size'])
+        if (
+            vol['type'] != 'rbd'
+            or vol['mode'] != 'Filesystem'
+            or size > FS_BATCH_VOLUME_SIZE
+        ):
+            items.append(vol)
+            continue
+        batch = batches.get(vol['rbd_pool'])
+        if (
+            batch is None
+            or len(batch['volumes']) >= FS_BATCH_MAX_VOLUMES
+            or batch['size'] + size > FS_BATCH_MAX_SIZE
+        ):
+            batch = batches[vol['rbd_pool']] = {'volumes': [], 'size': 0}
+            items.append(batch['volumes'])
+        batch['volumes'].append(vol)
+        batch['size'] += size
+
+    # Back up batches of one volume normally
+    return [
+        item[0] if isinstance(item, list) and len(item) == 1 else item
+        for item in items
+    ]
 
-@tracer.start_as_current_span('cleanup_jobs')
-def cleanup_jobs(api):
-    currently_backing_up = {}
 
-    batchv1 = k8s_client.BatchV1Api(api)
-    with tracer.start_as_current_span('list_namespaced_job'):
-        jobs = batchv1.list_namespaced_job(
-            NAMESPACE,
-            label_selector=METADATA_PREFIX + 'volume-type=rbd',
-        ).items
-    for job in jobs:
-        labels = job.metadata.labels
+def backup_volume(
+    api, rbd, ceph, vol, now, attached=None, node=None, ledger=None,
+):
+    logger.info(
+        'Backing up: pv=%s, pvc=%s/%s, rbd=%s/%s, mode=%s, size=%s',
+        vol['pv'],
+        vol['namespace'], vol['name'],
+        vol['rbd_pool'], vol['rbd_name'],
+        vol['mode'],
+        vol['size'] or 'unknown',
+    )
+
+    vol_otel_attributes = {
+        'pvc_namespace': vol['namespace'],
+        'pvc': vol['name'],
+    }
+
+    annotate_last_attempt(api, vol, now, ledger)
+
+    if vol['type'] == 'cephfs':
         with tracer.start_as_current_span(
-            'cleanup_job',
-            attributes={
-                'job': job.metadata.name,
-                'pvc_namespace': labels[METADATA_PREFIX + 'pvc-namespace'],
-                'pvc_name': labels[METADATA_PREFIX + 'pvc-name'],
-            },
+            'backup_cephfs',
+            attributes=vol_otel_attributes,
         ):
-            cleaned_up = cleanup_job(api, job)
+            backup_cephfs(api, ceph, vol, now, node)
+    elif vol['mode'] == 'Filesystem':
+        with tracer.start_as_current_span(
+            'backup_rbd_fs',
+            attributes=vol_otel_attributes,
+        ):
+            # Volumes that are not attached don't need a clone
+            clone = attached is None or vol['pv'] in attached
+            backup_rbd_fs(api, rbd, ceph, vol, now, clone, node)
+    else:
+        with tracer.start_as_current_span(
+            'backup_rbd_block',
+            attributes=vol_otel_attributes,
+        ):
+            backup_rbd_block(api, rbd, ceph, vol, now, node)
 
-        if not cleaned_up:
-            # Don't start another backup before this job has finished
-            pv = labels[METADATA_PREFIX + 'pv-name']
-            currently_backing_up[pv] = job.metadata.name
 
-    return currently_backing_up
+def estimate_cost(vol):
+    """Estimate how much a backup costs, in the unit of SCHEDULER_MODE."""
+    size = parse_size(vol['size'])
+    if SCHEDULER_MODE == 'size':
+        return size
+    elif vol['last_duration'] is not None:
+        return vol['last_duration']
+    else:
+        return JOB_OVERHEAD + size / SCHEDULER_DEFAULT_THROUGHPUT
 
 
-def cleanup_job(api, job):
-    corev1 = k8s_client.CoreV1Api(api)
-    batchv1 = k8s_client.BatchV1Api(api)
+def backup_interval(vol):
+    """Get how long to wait between backups of a volume, in seconds."""
+    if not ADAPTIVE_INTERVAL or vol['change_rate'] is None:
+        return DEFAULT_INTERVAL
+    elif vol['change_rate'] > 0:
+        # Wait until about ADAPTIVE_CHANGE_TARGET bytes have changed
+        interval = ADAPTIVE_CHANGE_TARGET / vol['change_rate'] * 24 * 3600
+    else:
+        interval = ADAPTIVE_MAX_AGE_HOURS * 3600
+    return min(
+        max(interval, ADAPTIVE_MIN_INTERVAL_HOURS * 3600),
+        ADAPTIVE_MAX_AGE_HOURS * 3600,
+    )
 
-    meta = job.metadata
-    pvc_namespace = meta.labels[METADATA_PREFIX + 'pvc-namespace']
-    pvc_name = meta.labels[METADATA_PREFIX + 'pvc-name']
-    pv = meta.labels[METADATA_PREFIX + 'pv-name']
 
+def build_list_to_backup(api, now, ledger=None, window=None):
+    """Pick the volumes to back up in this pass.
+
+    Each pass does 1/24th of the volumes (or of the budget), as it runs every
+    hour. If ``window`` is given, passes can happen at any time, and the
+    backups started over the last ``window`` seconds count against the share
+    of the volumes for that time instead.
+    """
+    # Select based on last attempt, with 30 minutes of slack since we run
+    # every hour
+    total_volumes = 0
+    total_cost = 0
+    recent_volumes = 0
+    recent_cost = 0
+    to_backup = []
+    time_zero = datetime(1970, 1, 1)
+    for vol in list_volumes_to_backup(api, ledger):
+        interval = backup_interval(vol)
+        if ADAPTIVE_INTERVAL:
+            # Count volumes as many times as they get backed up in a day, so
+            # the time not spent on low-churn volumes goes to the others
+            weight = 24 * 3600 / interval
+        else:
+            weight = 1
+        total_volumes += weight
+        if SCHEDULER_MODE != 'count':
+            total_cost += estimate_cost(vol) * weight
+        if (
+            window is not None
+            and vol['last_attempt'] is not None
+            and (now - vol['last_attempt']).total_seconds() < window
+        ):
+            recent_volumes += 1
+            if SCHEDULER_MODE != 'count':
+                recent_cost += estimate_cost(vol)
+        if vol['last_attempt'] is None:
+            to_backup.append((time_zero, vol))
+        elif (now - vol['last_attempt']).total_seconds() > interval - 30 * 60:
+            due = vol['last_attempt'] + timedelta(seconds=interval)
+            to_backup.append((due, vol))
+
+    # Order the list by due date
+    to_backup = [
+        vol
+        for due, vol in sorted(to_backup, key=lambda item: item[0])
+    ]
+
+    if SCHEDULER_MODE == 'count':
+        # Instead of doing all the backups that are due right now,
+        # we do 1/24th of the total backups
+        # This is to spread out the backup times if they all coincide
+        if window is None:
+            do_now = math.ceil(total_volumes / 24)
+        else:
+            do_now = math.ceil(total_volumes * window / (24 * 3600))
+            do_now -= recent_volumes
+        do_now = max(0, min(do_now, len(to_backup)))
+        logger.info(
+            "%d volumes to backup, doing %d now",
+            len(to_backup), do_now,
+        )
+    else:
+        # Fill this run up to the budget, which is 1/24th of the total
+        # unless set, so that the load is spread over the day
+        budget = SCHEDULER_BUDGET or total_cost / 24
+        used = 0
+        if window is not None:
+            budget = budget * window / 3600
+            used = recent_cost
+        do_now = 0
+        for vol in to_backup:
+            cost = estimate_cost(vol)
+            # Always do at least one, even if it is bigger than the budget,
+            # unless the budget went to earlier passes
+            if (do_now > 0 or used > 0) and used + cost > budget:
+                break
+            used += cost
+            do_now += 1
+        logger.info(
+            "%d volumes to backup, doing %d now (%s %d of %d budget)",
+            len(to_backup), do_now,
+            SCHEDULER_MODE, used, budget,
+        )
+    to_backup = to_backup[:do_now]
+
+    return to_backup
+
+
+def job_status(job):
+    """Get whether a job has completed, and whether it was successful."""
     completed = False
     successful = True
     if job.status.completion_time:
@@ -271,14 +804,197 @@ def cleanup_job(api, job):
     ):
         completed = True
         successful = False
+    return completed, successful
 
-    if not completed:
-        # Don't start another backup before this job has finished
-        # Don't clean up
-        return False
 
-    if job.metadata.annotations.get(METADATA_PREFIX + 'cleaned-up'):
-        return True
+@tracer.start_as_current_span('cleanup_jobs')
+def cleanup_jobs(api, rbd, ledger=None):
+    """Clean up after finished jobs.
+
+    Returns the volumes that are still being backed up, as a dict mapping the
+    PV name to the name of the job and the size of the volume.
+    """
+    currently_backing_up = {}
+
+    def not_cleaned_up(job):
+        # Don't start another backup before this job is cleaned up
+        for vol in job_volumes(job):
+            currently_backing_up[vol['pv-name']] = (
+                job.metadata.name,
+                parse_size(vol.get('volume-size')),
+            )
+
+    corev1 = k8s_client.CoreV1Api(api)
+    batchv1 = k8s_client.BatchV1Api(api)
+    with tracer.start_as_current_span('list_namespaced_job'):
+        jobs = batchv1.list_namespaced_job(
+            NAMESPACE,
+            label_selector=JOB_LABEL_SELECTOR,
+        ).items
+
+    to_clean = []
+    for job in jobs:
+        completed, successful = job_status(job)
+        if not completed:
+            # Don't start another backup before this job has finished
+            # Don't clean up
+            not_cleaned_up(job)
+        elif not job.metadata.annotations.get(METADATA_PREFIX + 'cleaned-up'):
+            to_clean.append((job, successful))
+
+    if not to_clean:
+        return currently_backing_up
+
+    # Read the PVCs of the volumes that were backed up, which are few,
+    # rather than listing every PVC again
+    claims = None
+    if any(successful for job, successful in to_clean):
+        with stages.stage('read-pvcs'):
+            claims = read_persistent_volume_claims(
+                api,
+                set(
+                    (vol['pvc-namespace'], vol['pvc-name'])
+                    for job, successful in to_clean
+                    if successful
+                    for vol in job_volumes(job)
+                ),
+                BACKUP_CONCURRENCY,
+            )
+        if ledger is not None:
+            claims = {
+                key: ledger.apply_claim(claim)
+                for key, claim in claims.items()
+            }
+
+    # Get the restic summaries from the pods
+    summaries = {}
+    if any(successful for job, successful in to_clean):
+        try:
+            with stages.stage('list-pods'):
+                summaries = get_backup_summaries(api)
+        except k8s_client.ApiException:
+            logger.exception("Error getting backup summaries from pods")
+
+    # Clean up each volume of each job
+    to_clean_volumes = []
+    for job, successful in to_clean:
+        job_summaries = summaries.get(job.metadata.name, {})
+        batch = ANNOTATION_VOLUMES in job.metadata.annotations
+        for vol in job_volumes(job):
+            summary = job_summaries.get(vol['container'])
+            if batch:
+                # The containers of a batch job don't fail, whether restic
+                # succeeded is known from its summary
+                vol_successful = successful and summary is not None
+            else:
+                vol_successful = successful
+            to_clean_volumes.append((job, vol, vol_successful, summary))
+
+    # Annotate PVCs and remove snapshots
+    failures = run_concurrently(
+        lambda item: cleanup_job(
+            api, rbd, item[0], item[1], item[2], claims, item[3], ledger,
+        ),
+        to_clean_volumes,
+        BACKUP_CONCURRENCY,
+        key=lambda item: (
+            item[1].get('rbd-pool') or item[1].get('cephfs-fs')
+        ),
+        max_per_key=BACKUP_POOL_CONCURRENCY,
+    )
+    failed = set()
+    for (job, vol, successful, summary), exception in failures:
+        logger.error(
+            "Cleaning up job %s failed (pv=%s)",
+            job.metadata.name,
+            vol['pv-name'],
+            exc_info=exception,
+        )
+        failed.add(job.metadata.name)
+    for job, successful in to_clean:
+        if job.metadata.name in failed:
+            not_cleaned_up(job)
+    cleaned_up = [
+        job for job, successful in to_clean
+        if job.metadata.name not in failed
+    ]
+
+    # Remove the PVs and PVCs, if any, for a batch of jobs at a time
+    marked = []
+    for i in range(0, len(cleaned_up), CLEANUP_BATCH_SIZE):
+        batch = cleaned_up[i:i + CLEANUP_BATCH_SIZE]
+        pvs = sorted(set(
+            vol['pv-name']
+            for job in batch
+            for vol in job_volumes(job)
+        ))
+        label_selector = METADATA_PREFIX + 'pv-name in (%s)' % ','.join(pvs)
+        try:
+            with stages.stage('delete-snapshot-pv-pvc'):
+                corev1.delete_collection_persistent_volume(
+                    label_selector=label_selector,
+                )
+                corev1.delete_collection_namespaced_persistent_volume_claim(
+                    NAMESPACE,
+                    label_selector=label_selector,
+                )
+        except k8s_client.ApiException:
+            logger.exception("Error removing PVs and PVCs for %s", pvs)
+            for job in batch:
+                not_cleaned_up(job)
+        else:
+            marked.extend(batch)
+
+    # Write the state of the backups before marking the jobs, after which it
+    # wouldn't be recorded again
+    if ledger is not None and marked:
+        with stages.stage('ledger-write'):
+            failed_shards = ledger.flush(api, BACKUP_CONCURRENCY)
+        saved = []
+        for job in marked:
+            if any(
+                volume_shard(vol['pv-name']) in failed_shards
+                for vol in job_volumes(job)
+            ):
+                # Clean it up again next time
+                not_cleaned_up(job)
+            else:
+                saved.append(job)
+        marked = saved
+
+    # Annotate jobs
+    failures = run_concurrently(
+        lambda job: mark_job_cleaned_up(
+            api, job, summaries.get(job.metadata.name),
+        ),
+        marked,
+        BACKUP_CONCURRENCY,
+    )
+    for job, exception in failures:
+        logger.error(
+            "Annotating job %s failed",
+            job.metadata.name,
+            exc_info=exception,
+        )
+        # It will be cleaned up again, which must not happen to the
+        # snapshot of a newer backup
+        not_cleaned_up(job)
+
+    return currently_backing_up
+
+
+def cleanup_job(
+    api, rbd, job, vol, successful, claims, summary=None, ledger=None,
+):
+    """Clean up after the backup of one volume by a finished job.
+
+    ``vol`` is one of the volumes from ``job_volumes(job)``, ``summary`` the
+    summary restic printed for it, if any.
+    """
+    meta = job.metadata
+    pvc_namespace = vol['pvc-namespace']
+    pvc_name = vol['pvc-name']
+    pv = vol['pv-name']
 
     logger.info(
         "Cleaning up job=%s pv=%s, pvc=%s/%s, %s",
@@ -289,76 +1005,219 @@ def cleanup_job(api, job):
         "successful" if successful else "unsuccessful",
     )
 
-    if successful:
-        # Get start time
-        start_time = meta.annotations[METADATA_PREFIX + 'start-time']
+    with tracer.start_as_current_span(
+        'cleanup_job',
+        attributes={
+            'job': meta.name,
+            'pvc_namespace': pvc_namespace,
+            'pvc_name': pvc_name,
+        },
+    ):
+        if successful:
+            # Get start time
+            start_time = meta.annotations[METADATA_PREFIX + 'start-time']
+
+            # Annotate the PVC, if it still exists
+            claim = claims.get((pvc_namespace, pvc_name))
+            # Don't update if the PVC has a more recent time already
+            if claim is not None and (
+                not claim.last_backup
+                or claim.last_backup < parse_date(start_time)
+            ):
+                state = {'last_backup': start_time}
+
+                # Record how long the backup took, for scheduling
+                if summary is not None and len(job_volumes(job)) > 1:
+                    # The job backed up other volumes too
+                    duration = summary.get('total_duration', 0)
+                else:
+                    duration = (
+                        naive_utc(job.status.completion_time)
+                        - parse_date(start_time)
+                    ).total_seconds()
+                state['last_duration'] = int(duration)
+
+                if vol.get('block-backup-type') == 'full':
+                    state['last_full_backup'] = start_time
+
+                # Record the restic snapshot, to restore from the backups
+                # that succeeded only. If restic didn't report it, the chain
+                # is broken, and the next backup will be a full one
+                if vol['volume-mode'] == 'block':
+                    snapshot_id = (summary or {}).get('snapshot_id')
+                    if snapshot_id is None:
+                        chain = []
+                    elif vol.get('block-backup-type') != 'incremental':
+                        chain = [snapshot_id]
+                    elif claim.backup_chain:
+                        chain = claim.backup_chain + [snapshot_id]
+                    else:
+                        chain = []
+                    state['backup_chain'] = chain
+
+                # Record which backups the local snapshots are of
+                if LOCAL_SNAPSHOTS and vol['volume-mode'] != 'cephfs':
+                    state['local_snapshots'] = [start_time] + [
+                        render_date(dt)
+                        for dt in claim.local_snapshots[:LOCAL_SNAPSHOTS - 1]
+                    ]
+
+                # Record how much data changes per day, for the adaptive
+                # interval
+                if summary is not None and claim.last_backup:
+                    interval = (
+                        parse_date(start_time) - claim.last_backup
+                    ).total_seconds()
+                    data_added = summary.get('data_added')
+                    if interval > 0 and data_added is not None:
+                        state['change_rate'] = int(
+                            data_added * 24 * 3600 / interval
+                        )
+
+                if ledger is not None:
+                    ledger.record(pv, **state)
+                if ledger is None or SCHEDULE_LEDGER_ANNOTATIONS:
+                    annotate_claim(api, pvc_namespace, pvc_name, state)
 
-        # Annotate the PVC
-        with tracer.start_as_current_span('annotate-pvc'):
-            try:
-                pvc = corev1.read_namespaced_persistent_volume_claim(
-                    pvc_name,
-                    pvc_namespace,
-                )
-            except k8s_client.ApiException as e:
-                if e.status != 404:
-                    raise
-            else:
-                # Don't update if the PVC has a more recent time already
-                existing_time = pvc.metadata.annotations.get(
-                    METADATA_PREFIX + 'last-backup'
-                )
+        if (
+            successful
+            and summary is not None
+            and vol.get('fast-scan') == 'true'
+        ):
+            check_fast_scan(meta.name, summary)
+
+        # CephFS snapshots are replaced by the next backup of the volume
+        if vol['volume-mode'] == 'cephfs':
+            return
+
+        # Remove the snapshot and cloned image
+        rbd_pool = vol['rbd-pool']
+        rbd_name = vol['rbd-name']
+        # If the snapshot was mounted directly, there is no clone
+        cloned = vol.get('rbd-clone') != 'false'
+        if successful and LOCAL_SNAPSHOTS:
+            # Keep the snapshot for restores (and incremental backups)
+            rotate_local_snapshots(rbd, rbd_pool, rbd_name, cloned)
+        elif (
+            successful
+            and BLOCK_INCREMENTAL
+            and vol['volume-mode'] == 'block'
+        ):
+            # Keep the snapshot as the base for the next incremental backup
+            rotate_backup_snapshot(rbd, rbd_pool, rbd_name)
+        else:
+            delete_backup_snapshot(rbd, rbd_pool, rbd_name, cloned)
+
+
+def annotate_claim(api, pvc_namespace, pvc_name, state):
+    """Set the annotations of a PVC from the state of its last backup."""
+    corev1 = k8s_client.CoreV1Api(api)
+
+    annotation = {
+        METADATA_PREFIX + 'last-backup': state['last_backup'],
+        ANNOTATION_LAST_DURATION: '%d' % state['last_duration'],
+    }
+    if 'last_full_backup' in state:
+        annotation[ANNOTATION_LAST_FULL_BACKUP] = state['last_full_backup']
+    if 'local_snapshots' in state:
+        annotation[ANNOTATION_LOCAL_SNAPSHOTS] = json.dumps(
+            state['local_snapshots'],
+        )
+    if 'change_rate' in state:
+        annotation[ANNOTATION_CHANGE_RATE] = '%d' % state['change_rate']
+    if 'backup_chain' in state:
+        annotation[ANNOTATION_BACKUP_CHAIN] = json.dumps(state['backup_chain'])
+    with stages.stage('annotate-pvc'):
+        try:
+            corev1.patch_namespaced_persistent_volume_claim(
+                pvc_name,
+                pvc_namespace,
+                {
+                    'metadata': {
+                        'annotations': annotation,
+                    },
+                },
+            )
+        except k8s_client.ApiException as e:
+            if e.status != 404:
+                raise
+
+
+def get_backup_summaries(api):
+    """Get the restic summaries of backup jobs, from their pods.
+
+    Returns a dict mapping job names to a dict mapping container names to
+    the summary.
+    """
+    corev1 = k8s_client.CoreV1Api(api)
+
+    summaries = {}
+    for page in list_pages(
+        corev1.list_namespaced_pod,
+        NAMESPACE,
+        label_selector=JOB_LABEL_SELECTOR,
+    ):
+        for pod in page.items:
+            job_name = (pod.metadata.labels or {}).get('job-name')
+            for status in itertools.chain(
+                pod.status.init_container_statuses or (),
+                pod.status.container_statuses or (),
+            ):
+                terminated = status.state and status.state.terminated
+                if not terminated or not terminated.message:
+                    continue
+                try:
+                    summary = json.loads(terminated.message)
+                except ValueError:
+                    continue
                 if (
-                    not existing_time
-                    or parse_date(existing_time) < parse_date(start_time)
+                    isinstance(summary, dict)
+                    and summary.get('message_type') == 'summary'
                 ):
-                    annotation = {
-                        METADATA_PREFIX + 'last-backup': start_time,
-                    }
-                    corev1.patch_namespaced_persistent_volume_claim(
-                        pvc_name,
-                        pvc_namespace,
-                        {
-                            'metadata': {
-                                'annotations': annotation,
-                            },
-                        },
-                )
-
-    # Remove the snapshot and cloned image
-    rbd_pool = meta.labels[METADATA_PREFIX + 'rbd-pool']
-    rbd_name = meta.labels[METADATA_PREFIX + 'rbd-name']
-    rbd_fq_backup_img = rbd_pool + '/' + 'backup-' + rbd_name
-    rbd_fq_snapshot = rbd_pool + '/' + rbd_name + '@backup'
-    with tracer.start_as_current_span('delete-snapshot'):
-        if call(['rbd', 'info', rbd_fq_backup_img]) == 0:
-            check_call(['rbd', 'rm', rbd_fq_backup_img])
-        if call(['rbd', 'info', rbd_fq_snapshot]) == 0:
-            call(['rbd', 'snap', 'unprotect', rbd_fq_snapshot])
-            check_call(['rbd', 'snap', 'rm', rbd_fq_snapshot])
-
-    # Remove the PV and PVC if any
-    pv = meta.labels[METADATA_PREFIX + 'pv-name']
-    label_selector = METADATA_PREFIX + 'pv-name=%s' % pv
-    with tracer.start_as_current_span('delete-snapshot-pv-pvc'):
-        corev1.delete_collection_persistent_volume(
-            label_selector=label_selector,
+                    summaries.setdefault(job_name, {})[status.name] = summary
+    return summaries
+
+
+def check_fast_scan(job_name, summary):
+    """Check that a fast-scan backup did skip the files that didn't change."""
+    changed = summary.get('files_changed', 0)
+    unmodified = summary.get('files_unmodified', 0)
+    if changed > 0 and unmodified == 0:
+        logger.warning(
+            "Fast scan did not skip any file for job %s (%d files changed, "
+            + "none unmodified), check that the parent snapshot was used",
+            job_name, changed,
         )
-        corev1.delete_collection_namespaced_persistent_volume_claim(
-            NAMESPACE,
-            label_selector=label_selector,
+    else:
+        logger.info(
+            "Fast scan for job %s: %d files unmodified, %d changed, %d new",
+            job_name, unmodified, changed, summary.get('files_new', 0),
         )
 
-    # Annotate job
-    with tracer.start_as_current_span('patch-job'):
+
+def mark_job_cleaned_up(api, job, summaries=None):
+    batchv1 = k8s_client.BatchV1Api(api)
+
+    annotations = {
+        METADATA_PREFIX + 'cleaned-up': 'true',
+    }
+    # Keep what restic reported, for the metrics exporter: the summary, or
+    # for a batch job, the summary for each container
+    if ANNOTATION_VOLUMES not in job.metadata.annotations:
+        summaries = (summaries or {}).get('backup')
+    if summaries:
+        annotations[ANNOTATION_BACKUP_SUMMARY] = json.dumps(
+            summaries,
+            separators=(',', ':'),
+            sort_keys=True,
+        )
+    with stages.stage('patch-job'):
         batchv1.patch_namespaced_job(
             job.metadata.name,
             job.metadata.namespace,
             {
                 'metadata': {
-                    'annotations': {
-                        METADATA_PREFIX + 'cleaned-up': 'true',
-                    },
+                    'annotations': annotations,
                 },
                 'spec': {
                     'ttlSecondsAfterFinished': 3600,
@@ -366,49 +1225,483 @@ def cleanup_job(api, job):
             },
         )
 
-    return True
 
+def delete_backup_snapshot(rbd, rbd_pool, rbd_name, cloned=True):
+    rbd_backup_img = 'backup-' + rbd_name
+    if cloned and rbd.image_exists(rbd_pool, rbd_backup_img):
+        with stages.stage('delete-snapshot'):
+            rbd.remove_image(rbd_pool, rbd_backup_img)
+    if rbd.snapshot_exists(rbd_pool, rbd_name, 'backup'):
+        with stages.stage('delete-snapshot'):
+            if cloned:
+                rbd.unprotect_snapshot(rbd_pool, rbd_name, 'backup')
+            rbd.remove_snapshot(rbd_pool, rbd_name, 'backup')
+
+
+def rotate_backup_snapshot(rbd, rbd_pool, rbd_name):
+    rbd_backup_img = 'backup-' + rbd_name
+    with stages.stage('rotate-snapshot'):
+        if not rbd.snapshot_exists(rbd_pool, rbd_name, 'backup'):
+            # Already rotated, when cleaning up a job a second time
+            return
+        if rbd.image_exists(rbd_pool, rbd_backup_img):
+            rbd.remove_image(rbd_pool, rbd_backup_img)
+        if rbd.snapshot_exists(rbd_pool, rbd_name, 'backup-prev'):
+            rbd.remove_snapshot(rbd_pool, rbd_name, 'backup-prev')
+        rbd.unprotect_snapshot(rbd_pool, rbd_name, 'backup')
+        rbd.rename_snapshot(rbd_pool, rbd_name, 'backup', 'backup-prev')
+
+
+def rotate_local_snapshots(rbd, rbd_pool, rbd_name, cloned=True):
+    """Keep the backup snapshot as the newest local snapshot.
+
+    The oldest local snapshot is removed if there are LOCAL_SNAPSHOTS already.
+    This does nothing if the backup snapshot is gone, so a job can be cleaned
+    up again without shifting the local snapshots a second time.
+    """
+    rbd_backup_img = 'backup-' + rbd_name
+    with stages.stage('rotate-snapshot'):
+        if not rbd.snapshot_exists(rbd_pool, rbd_name, 'backup'):
+            # Already rotated
+            return
+        if cloned and rbd.image_exists(rbd_pool, rbd_backup_img):
+            rbd.remove_image(rbd_pool, rbd_backup_img)
+        if rbd.snapshot_exists(rbd_pool, rbd_name, 'backup-prev'):
+            # Left over from incremental backups without local snapshots
+            rbd.remove_snapshot(rbd_pool, rbd_name, 'backup-prev')
+        oldest = local_snapshot_name(LOCAL_SNAPSHOTS)
+        if rbd.snapshot_exists(rbd_pool, rbd_name, oldest):
+            try:
+                rbd.unprotect_snapshot(rbd_pool, rbd_name, oldest)
+                rbd.remove_snapshot(rbd_pool, rbd_name, oldest)
+            except Exception:
+                # Still the parent of an image restored with --no-flatten,
+                # move it out of the way of the rotation
+                kept = '%s-in-use-%d' % (oldest, time.time())
+                logger.warning(
+                    "Can't remove snapshot %s/%s@%s, it might have clones; "
+                    + "renaming it to %s, remove it once they are flattened",
+                    rbd_pool, rbd_name, oldest, kept,
+                    exc_info=True,
+                )
+                rbd.rename_snapshot(rbd_pool, rbd_name, oldest, kept)
+        for rank in range(LOCAL_SNAPSHOTS - 1, 0, -1):
+            name = local_snapshot_name(rank)
+            if rbd.snapshot_exists(rbd_pool, rbd_name, name):
+                rbd.rename_snapshot(
+                    rbd_pool, rbd_name, name, local_snapshot_name(rank + 1),
+                )
+        if cloned:
+            rbd.unprotect_snapshot(rbd_pool, rbd_name, 'backup')
+        rbd.rename_snapshot(
+            rbd_pool, rbd_name, 'backup', local_snapshot_name(1),
+        )
 
-def backup_rbd_fs(api, ceph, vol, now):
-    batchv1 = k8s_client.BatchV1Api(api)
 
-    rbd_fq_image = vol['rbd_pool'] + '/' + vol['rbd_name']
-    rbd_fq_snapshot = rbd_fq_image + '@backup'
+def snapshot_rbd_fs(rbd, vol, clone=True):
+    """Snapshot a filesystem volume, returning the image to mount."""
     rbd_backup_img = 'backup-' + vol['rbd_name']
-    rbd_fq_backup_img = vol['rbd_pool'] + '/' + rbd_backup_img
 
     # Clean old snapshots and cloned images for this image
-    if call(['rbd', 'info', rbd_fq_backup_img]) == 0:
-        with tracer.start_as_current_span('delete-snapshot'):
-            check_call(['rbd', 'rm', rbd_fq_backup_img])
-    if call(['rbd', 'info', rbd_fq_snapshot]) == 0:
-        with tracer.start_as_current_span('delete-snapshot'):
-            call(['rbd', 'snap', 'unprotect', rbd_fq_snapshot])
-            check_call(['rbd', 'snap', 'rm', rbd_fq_snapshot])
-
-    with tracer.start_as_current_span('create-snapshot'):
+    delete_backup_snapshot(rbd, vol['rbd_pool'], vol['rbd_name'])
+
+    with stages.stage('create-snapshot'):
         # Make a snapshot
-        check_call(['rbd', 'snap', 'create', rbd_fq_snapshot])
+        rbd.create_snapshot(vol['rbd_pool'], vol['rbd_name'], 'backup')
+
+        if clone:
+            # Turn it into an image, so the filesystem can be fixed on mount
+            # (if the image was in use when snapshotting, it will need repair)
+            rbd.protect_snapshot(vol['rbd_pool'], vol['rbd_name'], 'backup')
+            rbd.clone(
+                vol['rbd_pool'], vol['rbd_name'], 'backup', rbd_backup_img,
+            )
+        else:
+            # The volume is not attached, so the filesystem on the snapshot
+            # is clean and can be mounted read-only directly
+            rbd_backup_img = vol['rbd_name'] + '@backup'
+
+    return rbd_backup_img
+
+
+def restic_cache_volume():
+    """Build the pod volume for the restic cache, or None if disabled."""
+    if RESTIC_CACHE_MODE == 'none':
+        return None
+    elif RESTIC_CACHE_MODE == 'node':
+        return k8s_client.V1Volume(
+            name='restic-cache',
+            host_path=k8s_client.V1HostPathVolumeSource(
+                path=RESTIC_CACHE_HOST_PATH,
+                type='DirectoryOrCreate',
+            ),
+        )
+    elif RESTIC_CACHE_MODE == 'pvc':
+        if not RESTIC_CACHE_PVC:
+            raise ValueError("RESTIC_CACHE_MODE=pvc requires RESTIC_CACHE_PVC")
+        return k8s_client.V1Volume(
+            name='restic-cache',
+            persistent_volume_claim=(
+                k8s_client.V1PersistentVolumeClaimVolumeSource(
+                    claim_name=RESTIC_CACHE_PVC,
+                )
+            ),
+        )
+    else:
+        raise ValueError("Unknown RESTIC_CACHE_MODE %r" % RESTIC_CACHE_MODE)
+
+
+def restic_cache_mounts():
+    """Build the volume mounts for the restic cache, if enabled."""
+    if RESTIC_CACHE_MODE == 'none':
+        return []
+    return [
+        k8s_client.V1VolumeMount(
+            mount_path=RESTIC_CACHE_PATH,
+            name='restic-cache',
+        ),
+    ]
+
+
+def restic_cache_script():
+    """Shell commands setting RESTIC_CACHE_DIR, if the cache is enabled.
+
+    restic doesn't lock its cache, so each job takes one of the slots with
+    flock (held until the script exits). If they are all in use, restic
+    uses its default cache in the container rather than waiting.
+    """
+    if RESTIC_CACHE_MODE == 'none':
+        return ''
+    return (
+        'for i in $(seq 1 %d); do' % RESTIC_CACHE_SLOTS
+        + ' exec 9>%s/slot-$i.lock;' % RESTIC_CACHE_PATH
+        + ' if flock -n 9; then'
+        + ' export RESTIC_CACHE_DIR=%s/slot-$i; break;' % RESTIC_CACHE_PATH
+        + ' fi;'
+        + ' exec 9>&-;'
+        + ' done; '
+        + 'if [ -z "$RESTIC_CACHE_DIR" ]; then'
+        + ' echo "All restic cache slots are in use" >&2; fi; '
+    )
 
-        # Turn it into an image, so the filesystem can be fixed on mount
-        # (if the image was in use when snapshotting, it will need repair)
-        check_call(['rbd', 'snap', 'protect', rbd_fq_snapshot])
-        check_call(['rbd', 'clone', rbd_fq_snapshot, rbd_fq_backup_img])
+
+def rbd_fs_volume_labels(vol, clone=True):
+    """Get the job labels for a filesystem volume, without the prefix."""
+    labels = {
+        'volume-mode': 'filesystem',
+        'pv-name': vol['pv'],
+        'pvc-namespace': vol['namespace'],
+        'pvc-name': vol['name'],
+        'rbd-pool': vol['rbd_pool'],
+        'rbd-name': vol['rbd_name'],
+    }
+    if vol['size']:
+        labels['volume-size'] = vol['size']
+    if not clone:
+        labels['rbd-clone'] = 'false'
+    if FS_FAST_SCAN:
+        labels['fast-scan'] = 'true'
+    return labels
+
+
+def rbd_fs_container(vol, name, volume_name, batch=False):
+    """Build the container backing up a filesystem volume.
+
+    In a batch, the container doesn't fail, recording the error as its
+    termination message instead.
+    """
+    restic_args = ' --host $(HOST) --exclude lost+found'
+    script = 'set -o pipefail; ' + restic_cache_script()
+    if FS_FAST_SCAN:
+        # Find the last snapshot for this volume, if any
+        script += (
+            'PARENT=$(restic snapshots --json --latest 1'
+            + ' --host "$HOST" --path /data'
+            + ' | grep -o \'"id":"[0-9a-f]*"\' | tail -n 1'
+            + ' | cut -d \'"\' -f 4); '
+        )
+        restic_args += (
+            ' --ignore-inode --ignore-ctime'
+            + ' ${PARENT:+--parent "$PARENT"}'
+        )
+    script += (
+        'stdbuf -o L -e L restic --json'
+        + restic_args
+        + ' backup /data'
+        + RESTIC_SUMMARY
+    )
+    if batch:
+        script = (
+            '(' + script + ')'
+            + ' || echo \'{"message_type":"error"}\' > /dev/termination-log'
+        )
+    return k8s_client.V1Container(
+        name=name,
+        image=BACKUP_IMAGE,
+        image_pull_policy=BACKUP_IMAGE_PULL_POLICY,
+        args=['bash', '-c', script],
+        resources=container_resources(),
+        env=format_env(
+            RESTIC_REPOSITORY=('secret', RESTIC_SECRET_NAME, 'url'),
+            HOST='rbd-fs-%s-nspvc-%s' % (vol['namespace'], vol['name']),
+            RESTIC_PASSWORD=('secret', RESTIC_SECRET_NAME, 'password'),
+        ),
+        volume_mounts=[
+            k8s_client.V1VolumeMount(
+                mount_path='/data',
+                name=volume_name,
+                read_only=True,
+            ),
+        ] + restic_cache_mounts(),
+    )
+
+
+def rbd_fs_volume(ceph, vol, name, rbd_backup_img, clone=True):
+    """Build the pod volume for the snapshot of a filesystem volume."""
+    return k8s_client.V1Volume(
+        name=name,
+        rbd=k8s_client.V1RBDVolumeSource(
+            monitors=ceph['monitors'],
+            pool=vol['rbd_pool'],
+            image=rbd_backup_img,
+            fs_type=vol['csi']['fstype'],
+            secret_ref=k8s_client.V1SecretReference(
+                name=ceph['secret'],
+            ),
+            user=ceph['user'],
+            read_only=not clone,
+        ),
+    )
+
+
+def backup_rbd_fs(api, rbd, ceph, vol, now, clone=True, node=None):
+    batchv1 = k8s_client.BatchV1Api(api)
+
+    rbd_backup_img = snapshot_rbd_fs(rbd, vol, clone)
 
     # Create a job to do the backup
+    labels = {METADATA_PREFIX + 'volume-type': 'rbd'}
+    for key, value in rbd_fs_volume_labels(vol, clone).items():
+        labels[METADATA_PREFIX + key] = value
+    pod_volumes = [rbd_fs_volume(ceph, vol, 'data', rbd_backup_img, clone)]
+    cache_volume = restic_cache_volume()
+    if cache_volume is not None:
+        pod_volumes.append(cache_volume)
+    with stages.stage('create-job'):
+        job = batchv1.create_namespaced_job(NAMESPACE, k8s_client.V1Job(
+            metadata=k8s_client.V1ObjectMeta(
+                generate_name='backup-rbd-fs-%s-' % vol['namespace'],
+                labels=labels,
+                annotations={
+                    METADATA_PREFIX + 'start-time': render_date(now),
+                },
+            ),
+            spec=k8s_client.V1JobSpec(
+                active_deadline_seconds=12 * 3600,
+                template=k8s_client.V1PodTemplateSpec(
+                    metadata=k8s_client.V1ObjectMeta(
+                        labels=labels,
+                        annotations=pod_annotations(node),
+                    ),
+                    spec=k8s_client.V1PodSpec(
+                        restart_policy='Never',
+                        containers=[
+                            rbd_fs_container(vol, 'backup', 'data'),
+                        ],
+                        volumes=pod_volumes,
+                        **pod_placement(node),
+                    ),
+                ),
+            ),
+        ))
+    logger.info("Created job %s", job.metadata.name)
+
+
+def backup_rbd_fs_batch(
+    api, rbd, ceph, vols, now, attached=None, node=None, ledger=None,
+):
+    """Back up several small filesystem volumes from the same pool in a job.
+
+    The volumes are backed up one after the other by init containers, which
+    don't fail, so that one volume failing doesn't stop the others. Restic's
+    summary, in the termination message of each container, tells which ones
+    succeeded.
+
+    Returns the list of ``(vol, exception)`` for volumes that could not be
+    set up, which are not part of the job.
+    """
+    batchv1 = k8s_client.BatchV1Api(api)
+
+    failures = []
+    volumes = []
+    init_containers = []
+    pod_volumes = []
+    for vol in vols:
+        try:
+            with tracer.start_as_current_span(
+                'snapshot_rbd_fs',
+                attributes={
+                    'pvc_namespace': vol['namespace'],
+                    'pvc': vol['name'],
+                },
+            ):
+                annotate_last_attempt(api, vol, now, ledger)
+                # Volumes that are not attached don't need a clone
+                clone = attached is None or vol['pv'] in attached
+                rbd_backup_img = snapshot_rbd_fs(rbd, vol, clone)
+        except Exception as e:
+            failures.append((vol, e))
+            continue
+
+        name = 'backup-%d' % len(volumes)
+        volume = rbd_fs_volume_labels(vol, clone)
+        volume['container'] = name
+        volumes.append(volume)
+        init_containers.append(rbd_fs_container(
+            vol, name, 'data-%d' % len(pod_volumes), batch=True,
+        ))
+        pod_volumes.append(rbd_fs_volume(
+            ceph, vol, 'data-%d' % len(pod_volumes), rbd_backup_img, clone,
+        ))
+
+    if not volumes:
+        return failures
+
+    cache_volume = restic_cache_volume()
+    if cache_volume is not None:
+        pod_volumes.append(cache_volume)
+
     labels = {
         METADATA_PREFIX + 'volume-type': 'rbd',
         METADATA_PREFIX + 'volume-mode': 'filesystem',
+        METADATA_PREFIX + 'rbd-pool': vols[0]['rbd_pool'],
+    }
+    with stages.stage('create-job'):
+        job = batchv1.create_namespaced_job(NAMESPACE, k8s_client.V1Job(
+            metadata=k8s_client.V1ObjectMeta(
+                generate_name='backup-rbd-fs-batch-',
+                labels=labels,
+                annotations={
+                    METADATA_PREFIX + 'start-time': render_date(now),
+                    ANNOTATION_VOLUMES: json.dumps(volumes, sort_keys=True),
+                },
+            ),
+            spec=k8s_client.V1JobSpec(
+                active_deadline_seconds=12 * 3600,
+                template=k8s_client.V1PodTemplateSpec(
+                    metadata=k8s_client.V1ObjectMeta(
+                        labels=labels,
+                        annotations=pod_annotations(node),
+                    ),
+                    spec=k8s_client.V1PodSpec(
+                        restart_policy='Never',
+                        init_containers=init_containers,
+                        containers=[
+                            k8s_client.V1Container(
+                                name='done',
+                                image=BACKUP_IMAGE,
+                                image_pull_policy=BACKUP_IMAGE_PULL_POLICY,
+                                args=['true'],
+                            ),
+                        ],
+                        volumes=pod_volumes,
+                        **pod_placement(node),
+                    ),
+                ),
+            ),
+        ))
+    logger.info(
+        "Created job %s for %d volumes", job.metadata.name, len(volumes),
+    )
+    return failures
+
+
+def cephfs_script(vol):
+    """Build the script backing up the snapshot of a CephFS volume.
+
+    The snapshot is mounted on /data. With CEPHFS_RCTIME_PRUNING, if its
+    recursive ctime is not newer than the last backup, restic isn't run and
+    the summary records that nothing was added. Otherwise restic walks the
+    whole tree, only reading the files that changed since the parent
+    snapshot.
+    """
+    script = 'set -o pipefail; ' + restic_cache_script()
+    if CEPHFS_RCTIME_PRUNING and vol['last_backup'] is not None:
+        script += (
+            'if python3 -c \'import os, sys;'
+            + ' rctime = os.getxattr("/data", "ceph.dir.rctime");'
+            + ' sys.exit(int(rctime.split(b".")[0]) > int(sys.argv[1]))\''
+            + ' "$LAST_BACKUP"; then'
+            + ' echo "No change since the last backup" >&2;'
+            + ' echo \'{"message_type":"summary","files_new":0,'
+            + '"files_changed":0,"data_added":0,"total_bytes_processed":0,'
+            + '"total_duration":0}\' > /dev/termination-log;'
+            + ' exit 0; fi; '
+        )
+    # Snapshots keep the inode numbers, but ignore them anyway so that a
+    # different mount doesn't make restic read every file again
+    script += (
+        'stdbuf -o L -e L restic --json --host $(HOST) --ignore-inode'
+        + ' backup /data'
+        + RESTIC_SUMMARY
+    )
+    return script
+
+
+def backup_cephfs(api, ceph, vol, now, node=None):
+    """Back up a CephFS volume from a snapshot.
+
+    An init container takes the snapshot by creating a directory in the .snap
+    directory of the volume, replacing the one from the last backup. The
+    backup container then mounts the snapshot read-only.
+    """
+    batchv1 = k8s_client.BatchV1Api(api)
+
+    labels = {
+        METADATA_PREFIX + 'volume-type': 'cephfs',
+        METADATA_PREFIX + 'volume-mode': 'cephfs',
         METADATA_PREFIX + 'pv-name': vol['pv'],
         METADATA_PREFIX + 'pvc-namespace': vol['namespace'],
         METADATA_PREFIX + 'pvc-name': vol['name'],
-        METADATA_PREFIX + 'rbd-pool': vol['rbd_pool'],
-        METADATA_PREFIX + 'rbd-name': vol['rbd_name'],
     }
-    with tracer.start_as_current_span('create-job'):
+    if vol['cephfs_fs']:
+        labels[METADATA_PREFIX + 'cephfs-fs'] = vol['cephfs_fs']
+    if vol['size']:
+        labels[METADATA_PREFIX + 'volume-size'] = vol['size']
+
+    env = dict(
+        RESTIC_REPOSITORY=('secret', RESTIC_SECRET_NAME, 'url'),
+        HOST='cephfs-%s-nspvc-%s' % (vol['namespace'], vol['name']),
+        RESTIC_PASSWORD=('secret', RESTIC_SECRET_NAME, 'password'),
+    )
+    if vol['last_backup'] is not None:
+        env['LAST_BACKUP'] = '%d' % (
+            (vol['last_backup'] - datetime(1970, 1, 1)).total_seconds()
+            - CEPHFS_RCTIME_SLACK
+        )
+
+    pod_volumes = [
+        k8s_client.V1Volume(
+            name='data',
+            cephfs=k8s_client.V1CephFSVolumeSource(
+                monitors=ceph['monitors'],
+                path=vol['cephfs_path'],
+                secret_ref=k8s_client.V1SecretReference(
+                    name=ceph['secret'],
+                ),
+                user=ceph['user'],
+            ),
+        ),
+    ]
+    cache_volume = restic_cache_volume()
+    if cache_volume is not None:
+        pod_volumes.append(cache_volume)
+
+    snapshot = '/volume/.snap/' + CEPHFS_SNAPSHOT
+    with stages.stage('create-job'):
         job = batchv1.create_namespaced_job(NAMESPACE, k8s_client.V1Job(
             metadata=k8s_client.V1ObjectMeta(
-                generate_name='backup-rbd-fs-%s-' % vol['namespace'],
+                generate_name='backup-cephfs-%s-' % vol['namespace'],
                 labels=labels,
                 annotations={
                     METADATA_PREFIX + 'start-time': render_date(now),
@@ -419,60 +1712,52 @@ def backup_rbd_fs(api, ceph, vol, now):
                 template=k8s_client.V1PodTemplateSpec(
                     metadata=k8s_client.V1ObjectMeta(
                         labels=labels,
+                        annotations=pod_annotations(node),
                     ),
                     spec=k8s_client.V1PodSpec(
                         restart_policy='Never',
-                        containers=[
+                        init_containers=[
                             k8s_client.V1Container(
-                                name='backup',
+                                name='snapshot',
                                 image=BACKUP_IMAGE,
                                 image_pull_policy=BACKUP_IMAGE_PULL_POLICY,
                                 args=[
-                                    'stdbuf', '-o', 'L', '-e', 'L',
-                                    'restic',
-                                    '--host', '$(HOST)',
-                                    '--exclude', 'lost+found',
-                                    'backup', '/data',
+                                    'bash', '-c',
+                                    'set -e; '
+                                    + 'if [ -d %s ]; then rmdir %s; fi; '
+                                    % (snapshot, snapshot)
+                                    + 'mkdir %s' % snapshot,
                                 ],
-                                env=format_env(
-                                    RESTIC_REPOSITORY=(
-                                        'secret', RESTIC_SECRET_NAME, 'url',
-                                    ),
-                                    HOST='rbd-fs-%s-nspvc-%s' % (
-                                        vol['namespace'],
-                                        vol['name'],
-                                    ),
-                                    RESTIC_PASSWORD=(
-                                        'secret', RESTIC_SECRET_NAME, 'password',
-                                    ),
-                                ),
                                 volume_mounts=[
                                     k8s_client.V1VolumeMount(
-                                        mount_path='/data',
+                                        mount_path='/volume',
                                         name='data',
-                                        read_only=True,
                                     ),
                                 ],
                             ),
                         ],
-                        volumes=[
-                            k8s_client.V1Volume(
-                                name='data',
-                                rbd=k8s_client.V1RBDVolumeSource(
-                                    monitors=ceph['monitors'],
-                                    pool=vol['rbd_pool'],
-                                    image=rbd_backup_img,
-                                    fs_type=vol['csi']['fstype'],
-                                    secret_ref=k8s_client.V1SecretReference(
-                                        name=ceph['secret'],
+                        containers=[
+                            k8s_client.V1Container(
+                                name='backup',
+                                image=BACKUP_IMAGE,
+                                image_pull_policy=BACKUP_IMAGE_PULL_POLICY,
+                                args=['bash', '-c', cephfs_script(vol)],
+                                resources=container_resources(),
+                                env=format_env(**env),
+                                volume_mounts=[
+                                    # The snapshot exists by the time this
+                                    # container starts
+                                    k8s_client.V1VolumeMount(
+                                        mount_path='/data',
+                                        name='data',
+                                        sub_path='.snap/' + CEPHFS_SNAPSHOT,
+                                        read_only=True,
                                     ),
-                                    user=ceph['user'],
-                                ),
+                                ] + restic_cache_mounts(),
                             ),
                         ],
-                        affinity=k8s_client.V1Affinity(
-                            pod_anti_affinity=anti_affinity(),
-                        ),
+                        volumes=pod_volumes,
+                        **pod_placement(node),
                     ),
                 ),
             ),
@@ -480,31 +1765,60 @@ def backup_rbd_fs(api, ceph, vol, now):
     logger.info("Created job %s", job.metadata.name)
 
 
-def backup_rbd_block(api, ceph, vol, now):
+def backup_rbd_block(api, rbd, ceph, vol, now, node=None):
     corev1 = k8s_client.CoreV1Api(api)
     batchv1 = k8s_client.BatchV1Api(api)
 
     rbd_fq_image = vol['rbd_pool'] + '/' + vol['rbd_name']
-    rbd_fq_snapshot = rbd_fq_image + '@backup'
     rbd_backup_img = 'backup-' + vol['rbd_name']
-    rbd_fq_backup_img = vol['rbd_pool'] + '/' + rbd_backup_img
+
+    if BLOCK_EXPORTER == 'qcow2-export':
+        exporter = 'qcow2-export --workers %d' % BLOCK_EXPORT_WORKERS
+        if BLOCK_FINE_EXTENTS:
+            exporter += ' --coalesce-gap %d' % BLOCK_COALESCE_GAP
+        if BLOCK_DROP_ZEROS:
+            exporter += ' --drop-zeros'
+    elif BLOCK_EXPORTER == 'streaming-qcow2-writer':
+        exporter = 'streaming-qcow2-writer'
+    else:
+        raise ValueError("Unknown BLOCK_EXPORTER %r" % BLOCK_EXPORTER)
 
     # Clean old snapshots and cloned images for this image
-    if call(['rbd', 'info', rbd_fq_backup_img]) == 0:
-        with tracer.start_as_current_span('delete-snapshot'):
-            check_call(['rbd', 'rm', rbd_fq_backup_img])
-    if call(['rbd', 'info', rbd_fq_snapshot]) == 0:
-        with tracer.start_as_current_span('delete-snapshot'):
-            call(['rbd', 'snap', 'unprotect', rbd_fq_snapshot])
-            check_call(['rbd', 'snap', 'rm', rbd_fq_snapshot])
-
-    with tracer.start_as_current_span('create-snapshot'):
+    delete_backup_snapshot(rbd, vol['rbd_pool'], vol['rbd_name'])
+
+    # Find whether we can do an incremental backup
+    incremental = False
+    if LOCAL_SNAPSHOTS:
+        previous = local_snapshot_name(1)
+    else:
+        previous = 'backup-prev'
+    has_previous = rbd.snapshot_exists(
+        vol['rbd_pool'], vol['rbd_name'], previous,
+    )
+    if not BLOCK_INCREMENTAL:
+        if has_previous and not LOCAL_SNAPSHOTS:
+            # Left over from when incremental backups were enabled
+            with stages.stage('delete-snapshot'):
+                rbd.remove_snapshot(
+                    vol['rbd_pool'], vol['rbd_name'], 'backup-prev',
+                )
+    elif (
+        has_previous
+        and vol['last_full_backup'] is not None
+        # The backups it would build on are known to have succeeded
+        and vol['backup_chain']
+    ):
+        full_age = (now - vol['last_full_backup']).total_seconds()
+        if full_age < BLOCK_FULL_INTERVAL_DAYS * 24 * 3600:
+            incremental = True
+
+    with stages.stage('create-snapshot'):
         # Make a snapshot
-        check_call(['rbd', 'snap', 'create', rbd_fq_snapshot])
+        rbd.create_snapshot(vol['rbd_pool'], vol['rbd_name'], 'backup')
 
         # Turn it into an image
-        check_call(['rbd', 'snap', 'protect', rbd_fq_snapshot])
-        check_call(['rbd', 'clone', rbd_fq_snapshot, rbd_fq_backup_img])
+        rbd.protect_snapshot(vol['rbd_pool'], vol['rbd_name'], 'backup')
+        rbd.clone(vol['rbd_pool'], vol['rbd_name'], 'backup', rbd_backup_img)
 
     labels = {
         METADATA_PREFIX + 'volume-type': 'rbd',
@@ -515,9 +1829,15 @@ def backup_rbd_block(api, ceph, vol, now):
         METADATA_PREFIX + 'rbd-pool': vol['rbd_pool'],
         METADATA_PREFIX + 'rbd-name': vol['rbd_name'],
     }
+    if vol['size']:
+        labels[METADATA_PREFIX + 'volume-size'] = vol['size']
+    if BLOCK_INCREMENTAL:
+        labels[METADATA_PREFIX + 'block-backup-type'] = (
+            'incremental' if incremental else 'full'
+        )
 
     # Create a PersistentVolume
-    with tracer.start_as_current_span('create-pv'):
+    with stages.stage('create-pv'):
         pv = corev1.create_persistent_volume(k8s_client.V1PersistentVolume(
             metadata=k8s_client.V1ObjectMeta(
                 name='backup-rbd-block-%s' % vol['pv'],
@@ -544,7 +1864,7 @@ def backup_rbd_block(api, ceph, vol, now):
     logger.info("Created PersistentVolume %s", pv.metadata.name)
 
     # Create a PersistentVolumeClaim
-    with tracer.start_as_current_span('create-pvc'):
+    with stages.stage('create-pvc'):
         pvc = corev1.create_namespaced_persistent_volume_claim(
             NAMESPACE,
             k8s_client.V1PersistentVolumeClaim(
@@ -566,15 +1886,53 @@ def backup_rbd_block(api, ceph, vol, now):
     logger.info("Created PersistentVolumeClaim %s", pvc.metadata.name)
 
     # Create a job to do the backup
+    if BLOCK_FINE_EXTENTS:
+        layout = 'rbd diff --format=json '
+    else:
+        layout = 'rbd diff --whole-object --format=json '
+    if incremental:
+        # Only the extents that changed since the previous backup end up in
+        # the qcow2 file, restoring needs the last full backup and all the
+        # incremental backups since. Discarded and zeroed extents become
+        # zero clusters
+        layout += (
+            '--from-snap ' + previous + ' ' + rbd_fq_image + '@backup'
+        )
+    else:
+        layout += rbd_fq_image + '@backup'
     script = (
-        'rbd diff --whole-object --format=json ' + rbd_fq_image
+        'set -o pipefail; '
+        + restic_cache_script()
+        + layout
         + ' > /tmp/layout.json'
-        + ' && streaming-qcow2-writer /disk /tmp/layout.json'
-        + ' | stdbuf -o L -e L restic'
+        + ' && ' + exporter + ' /disk /tmp/layout.json'
+        + ' | stdbuf -o L -e L restic --json'
         + ' --host $(HOST)'
         + ' backup --stdin --stdin-filename disk.qcow2'
     )
-    with tracer.start_as_current_span('create-job'):
+    if BLOCK_INCREMENTAL:
+        script += ' --tag ' + ('incremental' if incremental else 'full')
+    script += RESTIC_SUMMARY
+    pod_volumes = [
+        k8s_client.V1Volume(
+            name='disk',
+            persistent_volume_claim=(
+                k8s_client.V1PersistentVolumeClaimVolumeSource(
+                    claim_name=pvc.metadata.name,
+                )
+            ),
+        ),
+        k8s_client.V1Volume(
+            name='ceph',
+            secret=k8s_client.V1SecretVolumeSource(
+                secret_name=CEPH_SECRET_NAME,
+            ),
+        ),
+    ]
+    cache_volume = restic_cache_volume()
+    if cache_volume is not None:
+        pod_volumes.append(cache_volume)
+    with stages.stage('create-job'):
         job = batchv1.create_namespaced_job(NAMESPACE, k8s_client.V1Job(
             metadata=k8s_client.V1ObjectMeta(
                 generate_name='backup-rbd-block-%s-' % vol['namespace'],
@@ -588,6 +1946,7 @@ def backup_rbd_block(api, ceph, vol, now):
                 template=k8s_client.V1PodTemplateSpec(
                     metadata=k8s_client.V1ObjectMeta(
                         labels=labels,
+                        annotations=pod_annotations(node),
                     ),
                     spec=k8s_client.V1PodSpec(
                         restart_policy='Never',
@@ -596,7 +1955,8 @@ def backup_rbd_block(api, ceph, vol, now):
                                 name='backup',
                                 image=BACKUP_IMAGE,
                                 image_pull_policy=BACKUP_IMAGE_PULL_POLICY,
-                                args=['sh', '-c', script],
+                                args=['bash', '-c', script],
+                                resources=container_resources(),
                                 env=format_env(
                                     RESTIC_REPOSITORY=(
                                         'secret', RESTIC_SECRET_NAME, 'url',
@@ -622,7 +1982,7 @@ def backup_rbd_block(api, ceph, vol, now):
                                         name='ceph',
                                         read_only=True,
                                     ),
-                                ],
+                                ] + restic_cache_mounts(),
                                 volume_devices=[
                                     k8s_client.V1VolumeDevice(
                                         device_path='/disk',
@@ -631,48 +1991,10 @@ def backup_rbd_block(api, ceph, vol, now):
                                 ],
                             ),
                         ],
-                        volumes=[
-                            k8s_client.V1Volume(
-                                name='disk',
-                                persistent_volume_claim=(
-                                    k8s_client.V1PersistentVolumeClaimVolumeSource(
-                                        claim_name=pvc.metadata.name,
-                                    )
-                                ),
-                            ),
-                            k8s_client.V1Volume(
-                                name='ceph',
-                                secret=k8s_client.V1SecretVolumeSource(
-                                    secret_name=CEPH_SECRET_NAME,
-                                ),
-                            ),
-                        ],
-                        affinity=k8s_client.V1Affinity(
-                            pod_anti_affinity=anti_affinity(),
-                        ),
+                        volumes=pod_volumes,
+                        **pod_placement(node),
                     ),
                 ),
             ),
         ))
     logger.info("Created job %s", job.metadata.name)
-
-
-def anti_affinity():
-    return k8s_client.V1PodAntiAffinity(
-        preferred_during_scheduling_ignored_during_execution=[
-            k8s_client.V1WeightedPodAffinityTerm(
-                weight=50,
-                pod_affinity_term=k8s_client.V1PodAffinityTerm(
-                    label_selector=k8s_client.V1LabelSelector(
-                        match_expressions=[
-                            k8s_client.V1LabelSelectorRequirement(
-                                key=METADATA_PREFIX + 'volume-type',
-                                operator='Exists',
-                            ),
-                        ],
-                    ),
-                    topology_key='kubernetes.io/hostname',
-                ),
-            ),
-        ],
-    )
@@ -0,0 +1,51 @@
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import contextvars
+
+
+def run_concurrently(func, items, max_workers, key=None, max_per_key=None):
+    """Call ``func`` on each item, using a bounded pool of threads.
+
+    Items are started in order. If ``key`` is given, at most ``max_per_key``
+    items with the same key run at the same time; items that don't fit are
+    skipped over until a slot frees up, so other keys are not held back.
+
+    An exception raised for one item doesn't stop the others. Returns the
+    list of ``(item, exception)`` that failed.
+    """
+    failures = []
+    pending = list(items)
+    running = {}
+    running_per_key = {}
+
+    with ThreadPoolExecutor(max_workers) as executor:
+        while pending or running:
+            # Start as many items as the limits allow
+            i = 0
+            while i < len(pending) and len(running) < max_workers:
+                item = pending[i]
+                item_key = key(item) if key is not None else None
+                if (
+                    max_per_key is not None
+                    and running_per_key.get(item_key, 0) >= max_per_key
+                ):
+                    i += 1
+                    continue
+                del pending[i]
+                running_per_key[item_key] = (
+                    running_per_key.get(item_key, 0) + 1
+                )
+                # Run in a copy of the context, so spans have the right parent
+                context = contextvars.copy_context()
+                future = executor.submit(context.run, func, item)
+                running[future] = item, item_key
+
+            # Wait for something to finish
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                item, item_key = running.pop(future)
+                running_per_key[item_key] -= 1
+                exception = future.exception()
+                if exception is not None:
+                    failures.append((item, exception))
+
+    return failures
@@ -0,0 +1,221 @@
+import kubernetes.client as k8s_client
+import kubernetes.watch as k8s_watch
+import logging
+import opentelemetry.trace
+import threading
+import time
+
+from .ledger import LABEL_LEDGER, SCHEDULE_LEDGER
+from .metadata import JOB_LABEL_SELECTOR, NAMESPACE, list_pages, \
+    raw_list_func, namespace_info, claim_info, volume_info
+
+
+logger = logging.getLogger(__name__)
+tracer = opentelemetry.trace.get_tracer(__name__)
+
+
+WATCH_TIMEOUT = 300
+RETRY_DELAY = 5
+
+
+def object_key(obj):
+    if isinstance(obj, dict):
+        # Parsed JSON, from raw_list_func()
+        return obj['metadata'].get('namespace'), obj['metadata']['name']
+    return obj.metadata.namespace, obj.metadata.name
+
+
+def object_resource_version(obj):
+    if isinstance(obj, dict):
+        # Parsed JSON, from raw_list_func() or a bookmark event
+        return obj['metadata']['resourceVersion']
+    return obj.metadata.resource_version
+
+
+class Informer(object):
+    """Keeps an in-memory copy of a Kubernetes collection up to date.
+
+    The collection is listed once, then watched from the resourceVersion of
+    the list. If the watch expires, the collection is listed again.
+
+    Objects are passed through ``transform`` before being stored, which can
+    turn them into compact records, or return None to not store them.
+
+    Handlers added with ``add_handler()`` are called with the type of each
+    watch event and the object, from the informer's thread.
+    """
+
+    def __init__(self, name, transform, list_func, *args, **kwargs):
+        self.name = name
+        self._transform = transform
+        self._list_func = list_func
+        self._args = args
+        self._kwargs = kwargs
+
+        self._lock = threading.Lock()
+        self._items = {}
+        self._resource_version = None
+        self._synced = threading.Event()
+        self._thread = None
+        self._handlers = []
+
+    def add_handler(self, handler):
+        self._handlers.append(handler)
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self._run,
+            name='informer-%s' % self.name,
+            daemon=True,
+        )
+        self._thread.start()
+
+    def wait_synced(self, timeout=None):
+        return self._synced.wait(timeout)
+
+    def items(self):
+        with self._lock:
+            return list(self._items.values())
+
+    def _run(self):
+        while True:
+            try:
+                if self._resource_version is None:
+                    self._list()
+                self._watch()
+            except k8s_client.ApiException as e:
+                if e.status == 410:
+                    logger.info(
+                        "Watch on %s expired, listing again", self.name,
+                    )
+                    self._resource_version = None
+                    continue
+                logger.exception("Error watching %s", self.name)
+                time.sleep(RETRY_DELAY)
+            except Exception:
+                logger.exception("Error watching %s", self.name)
+                time.sleep(RETRY_DELAY)
+
+    def _list(self):
+        with tracer.start_as_current_span(
+            'informer-list',
+            attributes={'resource': self.name},
+        ):
+            items = {}
+            for page in list_pages(
+                self._list_func,
+                *self._args,
+                **self._kwargs,
+            ):
+                for obj in page.items:
+                    record = self._store(obj)
+                    if record is not None:
+                        items[object_key(obj)] = record
+                resource_version = page.metadata.resource_version
+        with self._lock:
+            self._items = items
+            self._resource_version = resource_version
+        self._synced.set()
+        logger.info("Listed %d %s", len(items), self.name)
+
+    def _watch(self):
+        watch = k8s_watch.Watch()
+        for event in watch.stream(
+            self._list_func,
+            *self._args,
+            resource_version=self._resource_version,
+            timeout_seconds=WATCH_TIMEOUT,
+            allow_watch_bookmarks=True,
+            **self._kwargs,
+        ):
+            obj = event['object']
+            if event['type'] in ('ADDED', 'MODIFIED'):
+                record = self._store(obj)
+            else:
+                record = None
+            with self._lock:
+                if record is not None:
+                    self._items[object_key(obj)] = record
+                elif event['type'] != 'BOOKMARK':
+                    self._items.pop(object_key(obj), None)
+                self._resource_version = object_resource_version(obj)
+            if event['type'] != 'BOOKMARK':
+                for handler in self._handlers:
+                    handler(event['type'], obj)
+
+    def _store(self, obj):
+        if self._transform is None:
+            return obj
+        return self._transform(obj)
+
+
+class ClusterCache(object):
+    """Informers for all the objects the metrics exporter looks at."""
+
+    def __init__(self, api):
+        corev1 = k8s_client.CoreV1Api(api)
+        batchv1 = k8s_client.BatchV1Api(api)
+
+        # Namespaces and PVCs are received as JSON, without building the
+        # client's models for them
+        self.namespaces = Informer(
+            'namespaces',
+            namespace_info,
+            raw_list_func(api, '/api/v1/namespaces', metadata_only=True),
+        )
+        self.claims = Informer(
+            'persistentvolumeclaims',
+            claim_info,
+            raw_list_func(api, '/api/v1/persistentvolumeclaims'),
+        )
+        self.volumes = Informer(
+            'persistentvolumes',
+            volume_info,
+            corev1.list_persistent_volume,
+        )
+        self.jobs = Informer(
+            'jobs',
+            None,
+            batchv1.list_namespaced_job,
+            NAMESPACE,
+            label_selector=JOB_LABEL_SELECTOR,
+        )
+        self.crons = Informer(
+            'scheduler-jobs',
+            None,
+            batchv1.list_namespaced_job,
+            NAMESPACE,
+            label_selector='app.kubernetes.io/component=scheduler',
+        )
+        self.ledger = None
+        if SCHEDULE_LEDGER:
+            self.ledger = Informer(
+                'ledger',
+                None,
+                corev1.list_namespaced_config_map,
+                NAMESPACE,
+                label_selector=LABEL_LEDGER + '=true',
+            )
+
+    def _informers(self):
+        informers = [
+            self.namespaces, self.claims, self.volumes, self.jobs, self.crons,
+        ]
+        if self.ledger is not None:
+            informers.append(self.ledger)
+        return informers
+
+    def start(self):
+        for informer in self._informers():
+            informer.start()
+
+    def wait_synced(self, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        for informer in self._informers():
+            if deadline is None:
+                remaining = None
+            else:
+                remaining = max(0, deadline - time.monotonic())
+            if not informer.wait_synced(remaining):
+                return False
+        return True
@@ -0,0 +1,130 @@
+import kubernetes.client as k8s_client
+import logging
+import os
+from prometheus_client import CollectorRegistry, Counter, Histogram, \
+    push_to_gateway
+import time
+
+
+logger = logging.getLogger(__name__)
+
+
+METRICS_PUSHGATEWAY = os.environ.get('METRICS_PUSHGATEWAY') or None
+
+
+# Metrics about the calls we make, kept separate from the default registry so
+# the scheduler can publish them on their own
+REGISTRY = CollectorRegistry()
+
+API_REQUEST_DURATION = Histogram(
+    'api_request_duration_seconds',
+    "Latency of Kubernetes API requests",
+    ['verb', 'resource'],
+    registry=REGISTRY,
+)
+API_REQUEST_ERRORS = Counter(
+    'api_request_errors',
+    "Kubernetes API requests that failed",
+    ['verb', 'resource', 'code'],
+    registry=REGISTRY,
+)
+RBD_COMMAND_DURATION = Histogram(
+    'rbd_command_duration_seconds',
+    "Latency of RBD operations",
+    ['command'],
+    buckets=(
+        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0,
+    ),
+    registry=REGISTRY,
+)
+RBD_COMMAND_ERRORS = Counter(
+    'rbd_command_errors',
+    "RBD operations that failed",
+    ['command'],
+    registry=REGISTRY,
+)
+STAGE_DURATION = Histogram(
+    'stage_duration_seconds',
+    "Duration of the stages of a scheduler pass",
+    ['stage'],
+    buckets=(
+        0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0,
+        600.0, 1200.0, 1800.0,
+    ),
+    registry=REGISTRY,
+)
+
+
+def api_verb_resource(resource_path, method, query_params):
+    """Get the verb and resource from the path template of an API call.
+
+    For example, ``PATCH /api/v1/namespaces/{namespace}/jobs/{name}/status``
+    is ``('patch', 'jobs/status')``.
+    """
+    parts = resource_path.strip('/').split('/')
+    # Drop the group and version
+    if parts[0] == 'api':
+        parts = parts[2:]
+    else:
+        parts = parts[3:]
+    if parts[:2] == ['namespaces', '{namespace}'] and len(parts) > 2:
+        parts = parts[2:]
+    named = '{name}' in parts
+    resource = '/'.join(p for p in parts if p != '{name}')
+
+    method = method.upper()
+    if method == 'GET':
+        if named:
+            verb = 'get'
+        elif any(k == 'watch' and v for k, v in query_params or ()):
+            verb = 'watch'
+        else:
+            verb = 'list'
+    elif method == 'POST':
+        verb = 'create'
+    elif method == 'PUT':
+        verb = 'update'
+    elif method == 'DELETE':
+        verb = 'delete' if named else 'deletecollection'
+    else:
+        verb = method.lower()
+    return verb, resource
+
+
+class InstrumentedApiClient(k8s_client.ApiClient):
+    """API client that records the latency and errors of every request."""
+
+    def call_api(self, resource_path, method, *args, **kwargs):
+        if len(args) >= 2:
+            query_params = args[1]
+        else:
+            query_params = kwargs.get('query_params')
+        verb, resource = api_verb_resource(
+            resource_path, method, query_params,
+        )
+        start = time.perf_counter()
+        try:
+            return super(InstrumentedApiClient, self).call_api(
+                resource_path, method, *args, **kwargs
+            )
+        except k8s_client.ApiException as e:
+            API_REQUEST_ERRORS.labels(verb, resource, str(e.status)).inc()
+            raise
+        except Exception:
+            API_REQUEST_ERRORS.labels(verb, resource, '').inc()
+            raise
+        finally:
+            API_REQUEST_DURATION.labels(verb, resource).observe(
+                time.perf_counter() - start,
+            )
+
+
+def publish():
+    """Push the metrics to a Pushgateway, if one is configured."""
+    if METRICS_PUSHGATEWAY:
+        try:
+            push_to_gateway(METRICS_PUSHGATEWAY, 'ceph-backup', REGISTRY)
+        except OSError:
+            logger.exception(
+                "Error pushing metrics to %s", METRICS_PUSHGATEWAY,
+            )
@@ -0,0 +1,146 @@
+from datetime import datetime, timezone
+import kubernetes.client as k8s_client
+import logging
+import os
+import socket
+import threading
+import time
+
+from .metadata import NAMESPACE
+
+
+logger = logging.getLogger(__name__)
+
+
+# How long a Lease is valid without being renewed, how long the leader keeps
+# trying to renew it before giving up, and how often it is renewed (or how
+# often the other replicas try to take it)
+LEASE_DURATION = 60
+RENEW_DEADLINE = 40
+RETRY_PERIOD = 10
+
+
+def default_identity():
+    return os.environ.get('POD_NAME') or socket.gethostname()
+
+
+class LeaderElection(object):
+    """Leader election using a coordination.k8s.io Lease.
+
+    Like the Kubernetes controllers, a replica considers the Lease expired if
+    it hasn't seen it change for ``LEASE_DURATION`` seconds, going by its own
+    clock rather than the times written in the Lease by another replica.
+    """
+
+    def __init__(self, api, name, identity=None):
+        self.name = name
+        self.identity = identity or default_identity()
+        self._coordinationv1 = k8s_client.CoordinationV1Api(api)
+
+        # The last version of the Lease we've seen, and when we saw it
+        self._observed = None
+        self._observed_at = None
+
+        self._renew_thread = None
+
+    def acquire(self):
+        """Wait until we are the leader, then keep renewing the Lease.
+
+        If the Lease can't be renewed, the process exits, so that it doesn't
+        keep doing the leader's work while another replica takes over.
+        """
+        logger.info(
+            "Trying to acquire lease %s as %s", self.name, self.identity,
+        )
+        while not self._try_acquire_or_renew():
+            time.sleep(RETRY_PERIOD)
+        logger.info("Acquired lease %s", self.name)
+
+        self._renew_thread = threading.Thread(
+            target=self._renew,
+            name='leader-election',
+            daemon=True,
+        )
+        self._renew_thread.start()
+
+    def _renew(self):
+        last_renew = time.monotonic()
+        while True:
+            time.sleep(RETRY_PERIOD)
+            try:
+                renewed = self._try_acquire_or_renew()
+            except Exception:
+                logger.exception("Error renewing lease %s", self.name)
+                renewed = False
+            if renewed:
+                last_renew = time.monotonic()
+            elif time.monotonic() - last_renew > RENEW_DEADLINE:
+                logger.critical("Lost lease %s, exiting", self.name)
+                logging.shutdown()
+                os._exit(1)
+
+    def _try_acquire_or_renew(self):
+        now = datetime.now(timezone.utc)
+        spec = k8s_client.V1LeaseSpec(
+            holder_identity=self.identity,
+            lease_duration_seconds=LEASE_DURATION,
+            acquire_time=now,
+            renew_time=now,
+            lease_transitions=0,
+        )
+
+        try:
+            lease = self._coordinationv1.read_namespaced_lease(
+                self.name, NAMESPACE,
+            )
+        except k8s_client.ApiException as e:
+            if e.status != 404:
+                raise
+            try:
+                self._coordinationv1.create_namespaced_lease(
+                    NAMESPACE,
+                    k8s_client.V1Lease(
+                        metadata=k8s_client.V1ObjectMeta(name=self.name),
+                        spec=spec,
+                    ),
+                )
+            except k8s_client.ApiException as e:
+                if e.status == 409:
+                    return False
+                raise
+            return True
+
+        # Check whether the current holder's Lease has expired
+        observed = lease.metadata.resource_version
+        if observed != self._observed:
+            self._observed = observed
+            self._observed_at = time.monotonic()
+        holder = lease.spec.holder_identity
+        if (
+            holder
+            and holder != self.identity
+            and time.monotonic() - self._observed_at < (
+                lease.spec.lease_duration_seconds or LEASE_DURATION
+            )
+        ):
+            return False
+
+        if holder == self.identity:
+            spec.acquire_time = lease.spec.acquire_time
+            spec.lease_transitions = lease.spec.lease_transitions or 0
+        else:
+            spec.lease_transitions = (lease.spec.lease_transitions or 0) + 1
+        lease.spec = spec
+
+        # This fails if the Lease changed since we read it
+        try:
+            lease = self._coordinationv1.replace_namespaced_lease(
+                self.name, NAMESPACE, lease,
+            )
+        except k8s_client.ApiException as e:
+            if e.status == 409:
+                return False
+            raise
+        self._observed = lease.metadata.resource_version
+        self._observed_at = time.monotonic()
+        return True
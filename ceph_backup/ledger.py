@@ -0,0 +1,234 @@
+import json
+import kubernetes.client as k8s_client
+import logging
+import os
+import threading
+import zlib
+
+from .dispatch import run_concurrently
+from .metadata import METADATA_PREFIX, NAMESPACE, list_pages, parse_bool, \
+    parse_date
+
+
+logger = logging.getLogger(__name__)
+
+
+# Keep the scheduling state of the volumes (last attempt, last success,
+# duration, size...) in a set of ConfigMaps in our namespace, read with one
+# request at the start of a pass and written at the end, rather than in
+# annotations on every PV and PVC
+SCHEDULE_LEDGER = parse_bool(os.environ.get('SCHEDULE_LEDGER')) or False
+
+# Number of ConfigMaps the ledger is split into. A ConfigMap holds up to
+# 1 MiB, which is about 5000 volumes
+SCHEDULE_LEDGER_SHARDS = int(
+    os.environ.get('SCHEDULE_LEDGER_SHARDS', '16'),
+    10,
+)
+
+# Whether to keep setting the annotations on PVs and PVCs too, for users.
+# This costs a request per volume again, so it is off by default
+SCHEDULE_LEDGER_ANNOTATIONS = parse_bool(
+    os.environ.get('SCHEDULE_LEDGER_ANNOTATIONS'),
+) or False
+
+LABEL_LEDGER = METADATA_PREFIX + 'ledger'
+
+# Warn when a shard gets close to the size limit of ConfigMaps
+SHARD_WARN_SIZE = 900 << 10
+
+
+def shard_name(index):
+    return 'ceph-backup-ledger-%d' % index
+
+
+def volume_shard(pv):
+    return shard_name(zlib.crc32(pv.encode('utf-8')) % SCHEDULE_LEDGER_SHARDS)
+
+
+class Ledger(object):
+    """Scheduling state of the volumes, kept in sharded ConfigMaps.
+
+    Each ConfigMap maps PV names to a JSON object, with the times rendered
+    like in the annotations. Changes are kept in memory until ``flush()``,
+    which patches each shard that changed once.
+    """
+
+    def __init__(self, entries=None):
+        self._lock = threading.Lock()
+        self._entries = entries or {}
+        self._shards = set()
+        # Keys to write (or remove) for each shard
+        self._pending = {}
+
+    @classmethod
+    def from_config_maps(cls, config_maps):
+        ledger = cls()
+        for config_map in config_maps:
+            name = config_map.metadata.name
+            ledger._shards.add(name)
+            for pv, value in (config_map.data or {}).items():
+                try:
+                    entry = json.loads(value)
+                except ValueError:
+                    logger.warning("Invalid ledger entry for %s", pv)
+                    continue
+                if name != volume_shard(pv):
+                    # Left there by a different number of shards, move it
+                    ledger._pending.setdefault(name, {})[pv] = None
+                    if pv in ledger._entries:
+                        continue
+                    ledger._pending.setdefault(
+                        volume_shard(pv), {},
+                    )[pv] = value
+                ledger._entries[pv] = entry
+        return ledger
+
+    @classmethod
+    def load(cls, api):
+        corev1 = k8s_client.CoreV1Api(api)
+        config_maps = []
+        for page in list_pages(
+            corev1.list_namespaced_config_map,
+            NAMESPACE,
+            label_selector=LABEL_LEDGER + '=true',
+        ):
+            config_maps.extend(page.items)
+        ledger = cls.from_config_maps(config_maps)
+        logger.info(
+            "Read %d volumes from %d ledger shards",
+            len(ledger._entries), len(config_maps),
+        )
+        return ledger
+
+    def get(self, pv):
+        with self._lock:
+            return self._entries.get(pv) or {}
+
+    def record(self, pv, **fields):
+        """Update the entry of a volume."""
+        with self._lock:
+            entry = dict(self._entries.get(pv) or {})
+            entry.update(fields)
+            self._entries[pv] = entry
+            self._pending.setdefault(volume_shard(pv), {})[pv] = json.dumps(
+                entry,
+                separators=(',', ':'),
+                sort_keys=True,
+            )
+
+    def prune(self, existing):
+        """Remove the entries of the volumes that don't exist anymore."""
+        with self._lock:
+            for pv in list(self._entries):
+                if pv not in existing:
+                    del self._entries[pv]
+                    self._pending.setdefault(volume_shard(pv), {})[pv] = None
+
+    def flush(self, api, max_workers=1):
+        """Write the changes, with one request per shard that changed.
+
+        Shards that couldn't be written are kept pending for the next flush,
+        and their names are returned.
+        """
+        corev1 = k8s_client.CoreV1Api(api)
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            sizes = {}
+            for pv, entry in self._entries.items():
+                name = volume_shard(pv)
+                sizes[name] = sizes.get(name, 0) + len(pv) + len(
+                    json.dumps(entry, separators=(',', ':')),
+                )
+
+        def write_shard(name):
+            data = pending[name]
+            if sizes.get(name, 0) > SHARD_WARN_SIZE:
+                logger.warning(
+                    "Ledger shard %s is %d bytes, increase "
+                    + "SCHEDULE_LEDGER_SHARDS",
+                    name, sizes[name],
+                )
+            if name not in self._shards:
+                try:
+                    corev1.create_namespaced_config_map(
+                        NAMESPACE,
+                        k8s_client.V1ConfigMap(
+                            metadata=k8s_client.V1ObjectMeta(
+                                name=name,
+                                labels={LABEL_LEDGER: 'true'},
+                            ),
+                            data={
+                                k: v for k, v in data.items()
+                                if v is not None
+                            },
+                        ),
+                    )
+                    self._shards.add(name)
+                    return
+                except k8s_client.ApiException as e:
+                    if e.status != 409:
+                        raise
+                self._shards.add(name)
+            # A merge patch only changes the volumes we recorded, and None
+            # removes them
+            corev1.patch_namespaced_config_map(
+                name,
+                NAMESPACE,
+                {'data': data},
+            )
+
+        failures = run_concurrently(write_shard, sorted(pending), max_workers)
+        for name, exception in failures:
+            logger.error(
+                "Error writing ledger shard %s", name, exc_info=exception,
+            )
+            with self._lock:
+                # Keep the changes made since, they are more recent
+                data = pending[name]
+                data.update(self._pending.get(name, {}))
+                self._pending[name] = data
+        logger.info(
+            "Wrote %d ledger shards, %d failed",
+            len(pending) - len(failures), len(failures),
+        )
+        return set(name for name, exception in failures)
+
+    def apply_volume(self, vol):
+        """Update a VolumeInfo with the ledger, if it is more recent."""
+        last_attempt = self.get(vol.name).get('last_attempt')
+        if last_attempt:
+            last_attempt = parse_date(last_attempt)
+            if vol.last_attempt is None or last_attempt > vol.last_attempt:
+                return vol._replace(last_attempt=last_attempt)
+        return vol
+
+    def apply_claim(self, claim):
+        """Update a ClaimInfo with the ledger, if it is more recent."""
+        entry = self.get(claim.volume_name)
+        last_backup = entry.get('last_backup')
+        if not last_backup:
+            return claim
+        last_backup = parse_date(last_backup)
+        if claim.last_backup is not None and last_backup <= claim.last_backup:
+            return claim
+        # Fields that were never recorded in the ledger come from the
+        # annotations
+        last_full_backup = claim.last_full_backup
+        if entry.get('last_full_backup'):
+            last_full_backup = parse_date(entry['last_full_backup'])
+        local_snapshots = claim.local_snapshots
+        if 'local_snapshots' in entry:
+            local_snapshots = [
+                parse_date(d) for d in entry['local_snapshots']
+            ]
+        backup_chain = entry.get('backup_chain', claim.backup_chain)
+        return claim._replace(
+            last_backup=last_backup,
+            last_duration=entry.get('last_duration', claim.last_duration),
+            last_full_backup=last_full_backup,
+            change_rate=entry.get('change_rate', claim.change_rate),
+            local_snapshots=local_snapshots,
+            backup_chain=backup_chain,
+        )
@@ -1,19 +1,66 @@
+import collections
 from datetime import datetime, timedelta
 import functools
+import json
 import kubernetes.client as k8s_client
+from kubernetes.utils import parse_quantity
 import logging
 import opentelemetry.trace
 import os
 import time
+import types
+
+from .dispatch import run_concurrently
 
 
 METADATA_PREFIX = 'cephbackup.hpc.nyu.edu/'
 
 ANNOTATION_ENABLED = METADATA_PREFIX + 'backup'
 ANNOTATION_LAST_ATTEMPT = METADATA_PREFIX + 'last-start'
+ANNOTATION_LAST_DURATION = METADATA_PREFIX + 'last-backup-duration'
+ANNOTATION_LAST_FULL_BACKUP = METADATA_PREFIX + 'last-full-backup'
+ANNOTATION_BACKUP_SUMMARY = METADATA_PREFIX + 'backup-summary'
+# Data added to the repository per day, as measured by the last backup
+ANNOTATION_CHANGE_RATE = METADATA_PREFIX + 'change-rate'
+# Volumes backed up by a job for a batch of volumes
+ANNOTATION_VOLUMES = METADATA_PREFIX + 'volumes'
+# Start times of the backups kept as local RBD snapshots, newest first
+ANNOTATION_LOCAL_SNAPSHOTS = METADATA_PREFIX + 'local-snapshots'
+# Restic snapshots of the successful block backups to restore from, oldest
+# first: the last full backup and the incremental backups since
+ANNOTATION_BACKUP_CHAIN = METADATA_PREFIX + 'backup-chain'
+
+# Local RBD snapshots of previous backups are named with this prefix and
+# their rank, 1 being the newest
+LOCAL_SNAPSHOT_PREFIX = 'backup-local-'
+
+# Labels of backup jobs that describe the volume they back up
+JOB_VOLUME_LABELS = [
+    'volume-mode', 'pv-name', 'pvc-namespace', 'pvc-name', 'rbd-pool',
+    'rbd-name', 'rbd-clone', 'fast-scan', 'block-backup-type', 'volume-size',
+    'cephfs-fs',
+]
+
+# Selects the backup jobs, of either type of volume
+JOB_LABEL_SELECTOR = METADATA_PREFIX + 'volume-type in (rbd,cephfs)'
 
 NAMESPACE = os.environ.get('NAMESPACE', 'ceph-backup')
 
+# Number of objects to get per request when listing
+LIST_PAGE_SIZE = int(os.environ.get('LIST_PAGE_SIZE', '500'), 10)
+
+# Ask the API server for the metadata of the objects only, like client-go's
+# metadata client does (the last type is a fallback for servers that don't
+# support it)
+ACCEPT_METADATA_LIST = (
+    'application/json;as=PartialObjectMetadataList;g=meta.k8s.io;v=v1,'
+    + 'application/json'
+)
+ACCEPT_METADATA_WATCH = (
+    'application/json;as=PartialObjectMetadata;g=meta.k8s.io;v=v1,'
+    + 'application/json'
+)
+
 
 logger = logging.getLogger(__name__)
 tracer = opentelemetry.trace.get_tracer(__name__)
@@ -30,11 +77,30 @@ def parse_bool(value):
         return None
 
 
+# Whether to back up CephFS volumes, as well as RBD volumes
+CEPHFS_BACKUP = parse_bool(os.environ.get('CEPHFS_BACKUP')) or False
+
+
 def parse_date(s):
     assert len(s) == 20 and s[-1] == 'Z'
     return datetime.fromisoformat(s[:-1])
 
 
+def naive_utc(dt):
+    if dt.tzinfo is None:
+        return dt
+    elif dt.tzinfo.utcoffset(dt) == timedelta(0):
+        return dt.replace(tzinfo=None)
+    else:
+        raise AssertionError("Non-UTC timestamp")
+
+
+def parse_size(size):
+    if not size:
+        return 0
+    return int(parse_quantity(size))
+
+
 WARN_LIMIT = 3
 
 
@@ -57,120 +123,379 @@ def warn_time(func):
     return wrapper
 
 
+def list_pages(list_func, *args, **kwargs):
+    """Get a collection from the API one page at a time."""
+    continue_token = None
+    while True:
+        page = list_func(
+            *args,
+            limit=LIST_PAGE_SIZE,
+            _continue=continue_token,
+            **kwargs,
+        )
+        yield page
+        continue_token = page.metadata._continue
+        if not continue_token:
+            break
+
+
+class RawList(object):
+    """A page of a collection, with the objects as parsed JSON.
+
+    This has the attributes of the client's list models that ``list_pages()``
+    and the informers use.
+    """
+
+    def __init__(self, data):
+        metadata = data.get('metadata') or {}
+        self.items = data.get('items') or []
+        self.metadata = types.SimpleNamespace(
+            _continue=metadata.get('continue'),
+            resource_version=metadata.get('resourceVersion'),
+        )
+
+
+def query_param_name(name):
+    """Turn the name of a client argument into that of a query parameter.
+
+    For example, ``label_selector`` is ``labelSelector``, ``_continue`` is
+    ``continue``.
+    """
+    words = name.lstrip('_').split('_')
+    return words[0] + ''.join(w.title() for w in words[1:])
+
+
+def raw_list_func(api, path, metadata_only=False):
+    """Make a list function that returns the objects as parsed JSON.
+
+    Building the client's models for every object, including fields we never
+    read like managedFields, is what takes most of the time of big listings.
+    The function can be used with ``list_pages()``, ``list_records()``, and by
+    informers (for watches, it returns the response like the client's).
+
+    With ``metadata_only``, the API server only sends the metadata of the
+    objects.
+    """
+    def list_func(_preload_content=True, **kwargs):
+        query_params = []
+        for key, value in kwargs.items():
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = 'true' if value else 'false'
+            query_params.append((query_param_name(key), value))
+        if metadata_only:
+            if kwargs.get('watch'):
+                accept = ACCEPT_METADATA_WATCH
+            else:
+                accept = ACCEPT_METADATA_LIST
+        else:
+            accept = 'application/json'
+        response = api.call_api(
+            path, 'GET',
+            query_params=query_params,
+            header_params={'Accept': accept},
+            auth_settings=['BearerToken'],
+            _preload_content=False,
+            _return_http_data_only=True,
+        )
+        if not _preload_content:
+            return response
+        return RawList(json.loads(response.data))
+
+    return list_func
+
+
+def local_snapshot_name(rank):
+    return '%s%d' % (LOCAL_SNAPSHOT_PREFIX, rank)
+
+
+def job_volumes(job):
+    """Get the volumes that a backup job is for.
+
+    Each volume is a dict of the job labels from JOB_VOLUME_LABELS (without
+    the prefix), plus the name of the container that backs it up. Jobs for a
+    batch of volumes list them in an annotation instead of labels.
+    """
+    volumes = (job.metadata.annotations or {}).get(ANNOTATION_VOLUMES)
+    if volumes:
+        return json.loads(volumes)
+    labels = job.metadata.labels or {}
+    volume = {'container': 'backup'}
+    for key in JOB_VOLUME_LABELS:
+        value = labels.get(METADATA_PREFIX + key)
+        if value is not None:
+            volume[key] = value
+    return [volume]
+
+
+# Compact records holding only the fields we use, so that we don't keep the
+# full API objects in memory
+
+NamespaceInfo = collections.namedtuple('NamespaceInfo', ['name', 'backup'])
+
+ClaimInfo = collections.namedtuple(
+    'ClaimInfo',
+    [
+        'namespace', 'name', 'volume_name', 'backup', 'last_backup',
+        'last_duration', 'last_full_backup', 'change_rate',
+        'local_snapshots', 'backup_chain',
+    ],
+)
+
+VolumeInfo = collections.namedtuple(
+    'VolumeInfo',
+    [
+        'name', 'backup', 'last_attempt', 'mode', 'size',
+        'rbd_pool', 'rbd_name', 'cluster_id', 'fstype',
+        'type', 'cephfs_fs', 'cephfs_path',
+    ],
+)
+
+
+# Namespaces and PVCs are listed as parsed JSON, see raw_list_func()
+
+
+def namespace_info(ns):
+    metadata = ns['metadata']
+    annotations = metadata.get('annotations') or {}
+    return NamespaceInfo(
+        metadata['name'],
+        parse_bool(annotations.get(ANNOTATION_ENABLED)),
+    )
+
+
+def claim_info(pvc):
+    metadata = pvc['metadata']
+    annotations = metadata.get('annotations') or {}
+    last_backup = annotations.get(METADATA_PREFIX + 'last-backup')
+    if last_backup:
+        last_backup = parse_date(last_backup)
+    last_duration = annotations.get(ANNOTATION_LAST_DURATION)
+    if last_duration:
+        last_duration = int(last_duration, 10)
+    else:
+        last_duration = None
+    last_full_backup = annotations.get(ANNOTATION_LAST_FULL_BACKUP)
+    if last_full_backup:
+        last_full_backup = parse_date(last_full_backup)
+    change_rate = annotations.get(ANNOTATION_CHANGE_RATE)
+    if change_rate:
+        change_rate = int(change_rate, 10)
+    else:
+        change_rate = None
+    local_snapshots = annotations.get(ANNOTATION_LOCAL_SNAPSHOTS)
+    if local_snapshots:
+        local_snapshots = [parse_date(d) for d in json.loads(local_snapshots)]
+    backup_chain = annotations.get(ANNOTATION_BACKUP_CHAIN)
+    if backup_chain:
+        backup_chain = json.loads(backup_chain)
+    return ClaimInfo(
+        metadata['namespace'],
+        metadata['name'],
+        (pvc.get('spec') or {}).get('volumeName'),
+        parse_bool(annotations.get(ANNOTATION_ENABLED)),
+        last_backup or None,
+        last_duration,
+        last_full_backup or None,
+        change_rate,
+        local_snapshots or [],
+        backup_chain or [],
+    )
+
+
+def volume_info(pv):
+    # Only keep RBD volumes, and CephFS volumes if enabled
+    if not pv.spec.csi:
+        return None
+    elif pv.spec.csi.driver == 'rbd.csi.ceph.com':
+        volume_type = 'rbd'
+    elif pv.spec.csi.driver == 'cephfs.csi.ceph.com' and CEPHFS_BACKUP:
+        volume_type = 'cephfs'
+    else:
+        return None
+
+    annotations = pv.metadata.annotations or {}
+    last_attempt = annotations.get(ANNOTATION_LAST_ATTEMPT)
+    if last_attempt:
+        last_attempt = parse_date(last_attempt)
+    else:
+        # Don't backup a volume for 6 hours
+        last_attempt = naive_utc(
+            pv.metadata.creation_timestamp - timedelta(hours=18)
+        )
+    attributes = pv.spec.csi.volume_attributes or {}
+    if volume_type == 'rbd':
+        return VolumeInfo(
+            pv.metadata.name,
+            parse_bool(annotations.get(ANNOTATION_ENABLED)),
+            last_attempt,
+            pv.spec.volume_mode,
+            pv.spec.capacity.get('storage'),
+            attributes['pool'],
+            attributes['imageName'],
+            attributes['clusterID'],
+            pv.spec.csi.fs_type,
+            'rbd', None, None,
+        )
+    else:
+        # Provisioned subvolumes have a subvolumePath, static volumes a
+        # rootPath
+        path = attributes.get('subvolumePath') or attributes.get('rootPath')
+        if not path:
+            return None
+        return VolumeInfo(
+            pv.metadata.name,
+            parse_bool(annotations.get(ANNOTATION_ENABLED)),
+            last_attempt,
+            pv.spec.volume_mode,
+            pv.spec.capacity.get('storage'),
+            None, None,
+            attributes.get('clusterID'),
+            None,
+            'cephfs', attributes.get('fsName'), path,
+        )
+
+
+def list_records(transform, list_func, *args, **kwargs):
+    records = []
+    for page in list_pages(list_func, *args, **kwargs):
+        for obj in page.items:
+            record = transform(obj)
+            if record is not None:
+                records.append(record)
+    return records
+
+
 @warn_time
 @tracer.start_as_current_span('list_namespaces')
 def list_namespaces(api):
-    corev1 = k8s_client.CoreV1Api(api)
-    return corev1.list_namespace().items
+    return list_records(
+        namespace_info,
+        raw_list_func(api, '/api/v1/namespaces', metadata_only=True),
+    )
 
 
 @warn_time
 @tracer.start_as_current_span('list_persistent_volume_claims')
 def list_persistent_volume_claims(api):
+    # The volume name is in the spec, so this can't be metadata only
+    return list_records(
+        claim_info,
+        raw_list_func(api, '/api/v1/persistentvolumeclaims'),
+    )
+
+
+@warn_time
+@tracer.start_as_current_span('read_persistent_volume_claims')
+def read_persistent_volume_claims(api, names, max_workers=1):
+    """Read the given PVCs, as a dict mapping (namespace, name) to ClaimInfo.
+
+    This is cheaper than listing every PVC when only a few are needed. PVCs
+    that don't exist are left out.
+    """
     corev1 = k8s_client.CoreV1Api(api)
-    return corev1.list_persistent_volume_claim_for_all_namespaces().items
+    claims = {}
+
+    def read(key):
+        namespace, name = key
+        try:
+            response = corev1.read_namespaced_persistent_volume_claim(
+                name, namespace, _preload_content=False,
+            )
+        except k8s_client.ApiException as e:
+            if e.status != 404:
+                raise
+            return
+        claims[key] = claim_info(json.loads(response.data))
+
+    failures = run_concurrently(read, sorted(names), max_workers)
+    if failures:
+        raise failures[0][1]
+    return claims
 
 
 @warn_time
 @tracer.start_as_current_span('list_persistent_volumes')
 def list_persistent_volumes(api):
     corev1 = k8s_client.CoreV1Api(api)
-    return corev1.list_persistent_volume().items
+    return list_records(volume_info, corev1.list_persistent_volume)
 
 
-@tracer.start_as_current_span('list_volumes_to_backup')
-def list_volumes_to_backup(api):
-    # List all namespaces, collect backup configuration
-    namespaces = {}
-    for ns in list_namespaces(api):
-        annotations = ns.metadata.annotations or {}
-        namespaces[ns.metadata.name] = {
-            'backup': parse_bool(annotations.get(ANNOTATION_ENABLED)),
-        }
+@warn_time
+@tracer.start_as_current_span('list_attached_volumes')
+def list_attached_volumes(api):
+    """Get the names of the PVs that have a VolumeAttachment."""
+    storagev1 = k8s_client.StorageV1Api(api)
+    attached = set()
+    for page in list_pages(storagev1.list_volume_attachment):
+        for attachment in page.items:
+            pv = attachment.spec.source.persistent_volume_name
+            if pv:
+                attached.add(pv)
+    return attached
 
-    # List all PVCs, collect configuration and PV links
-    claims = {}
-    for pvc in list_persistent_volume_claims(api):
-        annotations = pvc.metadata.annotations or {}
-        last_backup = annotations.get(METADATA_PREFIX + 'last-backup')
-        if last_backup:
-            last_backup = parse_date(last_backup)
-        claims[pvc.spec.volume_name] = {
-            'backup': parse_bool(annotations.get(ANNOTATION_ENABLED)),
-            'last_backup': last_backup,
-            'namespace': pvc.metadata.namespace,
-            'name': pvc.metadata.name,
-        }
 
-    # List all PVs, collect configuration
-    volumes = []
-    for pv in list_persistent_volumes(api):
-        annotations = pv.metadata.annotations or {}
-        last_attempt = annotations.get(ANNOTATION_LAST_ATTEMPT)
-        if last_attempt:
-            last_attempt = parse_date(last_attempt)
-        else:
-            # Don't backup a volume for 6 hours
-            last_attempt = pv.metadata.creation_timestamp - timedelta(hours=18)
-            if last_attempt.tzinfo is None:
-                pass
-            elif last_attempt.tzinfo.utcoffset(last_attempt) == timedelta(0):
-                last_attempt = last_attempt.replace(tzinfo=None)
-            else:
-                raise AssertionError("Non-UTC creationTimestamp")
-        if pv.spec.csi and pv.spec.csi.driver == 'rbd.csi.ceph.com':
-            vol = {
-                'name': pv.metadata.name,
-                'backup': parse_bool(annotations.get(ANNOTATION_ENABLED)),
-                'last_attempt': last_attempt,
-                'mode': pv.spec.volume_mode,
-                'size': pv.spec.capacity.get('storage'),
-                'rbd_pool': pv.spec.csi.volume_attributes['pool'],
-                'rbd_name': pv.spec.csi.volume_attributes['imageName'],
-                'csi': {
-                    'cluster_id': pv.spec.csi.volume_attributes['clusterID'],
-                }
-            }
-            if pv.spec.csi.fs_type:
-                vol['csi']['fstype'] = pv.spec.csi.fs_type
-            volumes.append(vol)
-
-    # Build list of RBD volumes to backup
-    to_backup = []
-    for pv in volumes:
+@tracer.start_as_current_span('list_volumes_to_backup')
+def list_volumes_to_backup(api, ledger=None):
+    namespaces = list_namespaces(api)
+    claims = list_persistent_volume_claims(api)
+    volumes = list_persistent_volumes(api)
+    if ledger is not None:
+        # The ledger has the last backup times, if they're not in annotations
+        ledger.prune(set(vol.name for vol in volumes))
+        claims = [ledger.apply_claim(claim) for claim in claims]
+        volumes = [ledger.apply_volume(vol) for vol in volumes]
+    return select_volumes_to_backup(namespaces, claims, volumes)
+
+
+def select_volumes_to_backup(namespace_list, claim_list, volume_list):
+    """Generate the volumes to backup from namespace, PVC, and PV records."""
+    namespaces = {ns.name: ns for ns in namespace_list}
+    claims = {claim.volume_name: claim for claim in claim_list}
+
+    for pv in volume_list:
         try:
-            claim = claims[pv['name']]
+            claim = claims[pv.name]
         except KeyError:
             logger.warning(
                 "PersistentVolume without a PersistentVolumeClaim: %s",
-                pv['name'],
+                pv.name,
             )
             continue
-        ns = namespaces[claim['namespace']]
+        ns = namespaces[claim.namespace]
 
-        if claim['namespace'] == NAMESPACE:
+        if claim.namespace == NAMESPACE:
             continue
 
         # Check configuration
-        if pv['backup'] is False:
+        if pv.backup is False:
             continue
-        elif pv['backup'] is None:
-            if ns['backup'] is False:
+        elif pv.backup is None:
+            if ns.backup is False:
                 continue
-            if claim['backup'] is False:
+            if claim.backup is False:
                 continue
 
-        to_backup.append({
-            'pv': pv['name'],
-            'mode': pv['mode'],
-            'namespace': claim['namespace'],
-            'name': claim['name'],
-            'last_backup': claim['last_backup'],
-            'last_attempt': pv['last_attempt'],
-            'rbd_pool': pv['rbd_pool'],
-            'rbd_name': pv['rbd_name'],
-            'csi': pv['csi'],
-            'size': pv['size'],
-        })
-
-    return to_backup
+        csi = {'cluster_id': pv.cluster_id}
+        if pv.fstype:
+            csi['fstype'] = pv.fstype
+        yield {
+            'pv': pv.name,
+            'mode': pv.mode,
+            'namespace': claim.namespace,
+            'name': claim.name,
+            'last_backup': claim.last_backup,
+            'last_duration': claim.last_duration,
+            'last_full_backup': claim.last_full_backup,
+            'backup_chain': claim.backup_chain,
+            'change_rate': claim.change_rate,
+            'last_attempt': pv.last_attempt,
+            'type': pv.type,
+            'rbd_pool': pv.rbd_pool,
+            'rbd_name': pv.rbd_name,
+            'cephfs_fs': pv.cephfs_fs,
+            'cephfs_path': pv.cephfs_path,
+            'csi': csi,
+            'size': pv.size,
+        }
@@ -1,17 +1,24 @@
 import argparse
 from datetime import datetime
-import kubernetes.client as k8s_client
+import json
 import kubernetes.config as k8s_config
 import logging
 import math
 import opentelemetry.trace
-from prometheus_client import REGISTRY, make_wsgi_app
+from prometheus_client import REGISTRY, Counter, Histogram, make_wsgi_app
 from prometheus_client.exposition import ThreadingWSGIServer
 from prometheus_client.metrics_core import GaugeMetricFamily, \
     GaugeHistogramMetricFamily
+import threading
 from wsgiref.simple_server import make_server, WSGIRequestHandler
 
-from .metadata import METADATA_PREFIX, NAMESPACE, list_volumes_to_backup
+from .informer import ClusterCache
+from .instrumentation import InstrumentedApiClient, \
+    REGISTRY as INSTRUMENTATION_REGISTRY
+from .ledger import Ledger
+from .metadata import METADATA_PREFIX, ANNOTATION_BACKUP_SUMMARY, \
+    ANNOTATION_VOLUMES, job_volumes, select_volumes_to_backup
+from .table import print_table
 
 
 logger = logging.getLogger(__name__)
@@ -19,57 +26,32 @@ tracer = opentelemetry.trace.get_tracer(__name__)
 
 AGE_BUCKETS = 48
 
+# How long a scrape waits for the cache to be filled on startup
+SYNC_TIMEOUT = 60
 
-def print_table(log, table, header=None):
-    # Measure fields
-    table_iter = iter(table)
-    if header:
-        first_row = header
-    else:
-        try:
-            first_row = next(table_iter)
-        except StopIteration:
-            return
-    fields = [len(col) for col in first_row]
-    for row in table_iter:
-        if len(row) != len(fields):
-            raise ValueError("Inconsistent number of columns in table")
-        for col in range(len(row)):
-            fields[col] = max(fields[col], len(row[col]))
-
-    # Print table
-    def print_row(row):
-        line = []
-        for value, size in zip(row, fields):
-            line.append('{0: <{1}}'.format(value, size))
-        log('  '.join(line))
-
-    if header:
-        print_row(header)
-    for row in table:
-        print_row(row)
+MIB = 1 << 20
 
 
 @tracer.start_as_current_span('collect')
-def collect(show_table=False):
+def collect(cache, show_table=False):
     now = datetime.utcnow()
 
-    with k8s_client.ApiClient() as api:
-        to_backup = list_volumes_to_backup(api)
-
-        batchv1 = k8s_client.BatchV1Api(api)
-
-        with tracer.start_as_current_span('list_rbd_jobs'):
-            jobs = batchv1.list_namespaced_job(
-                NAMESPACE,
-                label_selector=METADATA_PREFIX + 'volume-type=rbd',
-            ).items
-
-        with tracer.start_as_current_span('list_scheduler_jobs'):
-            crons = batchv1.list_namespaced_job(
-                NAMESPACE,
-                label_selector='app.kubernetes.io/component=scheduler',
-            ).items
+    if not cache.wait_synced(SYNC_TIMEOUT):
+        raise RuntimeError("Cache is not synced yet")
+
+    claims = cache.claims.items()
+    volumes = cache.volumes.items()
+    if cache.ledger is not None:
+        ledger = Ledger.from_config_maps(cache.ledger.items())
+        claims = [ledger.apply_claim(claim) for claim in claims]
+        volumes = [ledger.apply_volume(vol) for vol in volumes]
+    to_backup = select_volumes_to_backup(
+        cache.namespaces.items(),
+        claims,
+        volumes,
+    )
+    jobs = cache.jobs.items()
+    crons = cache.crons.items()
 
     volumes_backed_up = GaugeMetricFamily(
         'volumes_backed_up',
@@ -107,7 +89,11 @@ def collect(show_table=False):
     )
 
     namespaces = {}
+    table_volumes = []
     for vol in to_backup:
+        if show_table:
+            table_volumes.append(vol)
+
         try:
             data = namespaces[vol['namespace']]
         except KeyError:
@@ -165,35 +151,36 @@ def collect(show_table=False):
     failed_jobs = {}
     backup_info = {}
     for job in jobs:
-        labels = job.metadata.labels
-        ns = labels[METADATA_PREFIX + 'pvc-namespace']
-        pvc = labels[METADATA_PREFIX + 'pvc-name']
         if job.status.active:
-            running_jobs[ns] = running_jobs.get(ns, 0) + 1
-            backup_info.setdefault((ns, pvc), []).append(
-                'active ' + job.metadata.name,
-            )
+            state = 'active'
         elif any(
             condition.type.lower() == 'failed'
             and condition.status.lower() == 'true'
             for condition in job.status.conditions or ()
         ):
-            failed_jobs[ns] = failed_jobs.get(ns, 0) + 1
-            backup_info.setdefault((ns, pvc), []).append(
-                'failed ' + job.metadata.name,
-            )
+            state = 'failed'
         elif not job.metadata.annotations.get(METADATA_PREFIX + 'cleaned-up'):
-            backup_info.setdefault((ns, pvc), []).append(
-                'ran ' + job.metadata.name,
-            )
+            state = 'ran'
         else:
-            backup_info.setdefault((ns, pvc), []).append(
-                'done ' + job.metadata.name,
+            state = 'done'
+
+        # Count batch jobs once in each namespace they back up
+        job_namespaces = set()
+        for vol in job_volumes(job):
+            ns = vol['pvc-namespace']
+            job_namespaces.add(ns)
+            backup_info.setdefault((ns, vol['pvc-name']), []).append(
+                state + ' ' + job.metadata.name,
             )
+        for ns in job_namespaces:
+            if state == 'active':
+                running_jobs[ns] = running_jobs.get(ns, 0) + 1
+            elif state == 'failed':
+                failed_jobs[ns] = failed_jobs.get(ns, 0) + 1
 
     if show_table:
         table = []
-        for vol in to_backup:
+        for vol in table_volumes:
             info = backup_info.get((vol['namespace'], vol['name']), ())
             table.append((
                 vol['namespace'],
@@ -238,9 +225,128 @@ def collect(show_table=False):
     ]
 
 
+class BackupSummaries(object):
+    """Histograms of the restic summaries recorded on finished jobs.
+
+    Each job is counted once, the first time it is seen with a summary.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._seen = set()
+        self.duration = Histogram(
+            'backup_duration_seconds',
+            "Duration of backups, as reported by restic",
+            ['namespace', 'mode'],
+            buckets=(
+                60, 300, 600, 1800, 3600, 2 * 3600, 4 * 3600, 8 * 3600,
+                12 * 3600,
+            ),
+            registry=None,
+        )
+        self.throughput = Histogram(
+            'backup_throughput_bytes_per_second',
+            "Bytes processed per second by backups",
+            ['namespace', 'mode'],
+            buckets=tuple(
+                n * MIB for n in (1, 2, 5, 10, 20, 50, 100, 200, 500)
+            ),
+            registry=None,
+        )
+        self.data_added = Counter(
+            'backup_data_added_bytes',
+            "New data added to the repository by backups",
+            ['namespace', 'mode'],
+            registry=None,
+        )
+        self.files = Counter(
+            'backup_files',
+            "Files seen by backups, by whether they were new, changed, or "
+            + "unmodified (and skipped)",
+            ['namespace', 'mode', 'state'],
+            registry=None,
+        )
+
+    def update(self, jobs):
+        with self._lock:
+            self._update(jobs)
+
+    def _update(self, jobs):
+        current = set()
+        for job in jobs:
+            uid = job.metadata.uid
+            current.add(uid)
+            if uid in self._seen:
+                continue
+            annotations = job.metadata.annotations or {}
+            summary = annotations.get(ANNOTATION_BACKUP_SUMMARY)
+            if not summary:
+                continue
+            self._seen.add(uid)
+            try:
+                summary = json.loads(summary)
+            except ValueError:
+                summary = None
+            volumes = job_volumes(job)
+            if ANNOTATION_VOLUMES in annotations:
+                # Batch job, with a summary for each container
+                if not isinstance(summary, dict):
+                    summary = {}
+                summaries = [
+                    (vol, summary.get(vol['container']))
+                    for vol in volumes
+                ]
+            else:
+                summaries = [(volumes[0], summary)]
+            for vol, summary in summaries:
+                if summary is not None:
+                    self._observe(job, vol, summary)
+
+        # Forget the jobs that were deleted
+        self._seen &= current
+
+    def _observe(self, job, vol, summary):
+        try:
+            duration = float(summary['total_duration'])
+            processed = int(summary['total_bytes_processed'])
+            added = int(summary['data_added'])
+        except (KeyError, TypeError, ValueError):
+            logger.warning(
+                "Invalid backup summary on job %s", job.metadata.name,
+            )
+            return
+
+        namespace = vol['pvc-namespace']
+        mode = vol['volume-mode']
+        self.duration.labels(namespace, mode).observe(duration)
+        if duration > 0:
+            self.throughput.labels(namespace, mode).observe(
+                processed / duration,
+            )
+        self.data_added.labels(namespace, mode).inc(added)
+        for state in ('new', 'changed', 'unmodified'):
+            self.files.labels(namespace, mode, state).inc(
+                summary.get('files_' + state, 0),
+            )
+
+    def collect(self):
+        return (
+            self.duration.collect()
+            + self.throughput.collect()
+            + self.data_added.collect()
+            + self.files.collect()
+        )
+
+
 class Collector(object):
+    def __init__(self, cache):
+        self.cache = cache
+        self.summaries = BackupSummaries()
+
     def collect(self):
-        return collect()
+        metrics = collect(self.cache)
+        self.summaries.update(self.cache.jobs.items())
+        return metrics + self.summaries.collect()
 
 
 class SilentHandler(WSGIRequestHandler):
@@ -271,11 +377,18 @@ def main():
         logger.info("Using in-cluster config")
         k8s_config.load_incluster_config()
 
+    # Keep a copy of the objects we need in memory, updated by watching
+    # the API, so scrapes don't need to list everything
+    cache = ClusterCache(InstrumentedApiClient())
+    cache.start()
+
     if args.table:
-        collect(True)
+        collect(cache, True)
         return
 
-    REGISTRY.register(Collector())
+    REGISTRY.register(Collector(cache))
+    # Also expose the latency of our own API calls
+    REGISTRY.register(INSTRUMENTATION_REGISTRY)
 
     httpd = make_server(
         '0.0.0.0', 8080,
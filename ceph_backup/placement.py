@@ -0,0 +1,267 @@
+import json
+import kubernetes.client as k8s_client
+from kubernetes.utils import parse_quantity
+import logging
+import os
+import threading
+
+from .metadata import METADATA_PREFIX, NAMESPACE, list_pages, raw_list_func
+
+
+logger = logging.getLogger(__name__)
+
+
+def json_env(name, default):
+    value = os.environ.get(name)
+    if not value:
+        return default
+    return json.loads(value)
+
+
+# How many backup pods can run on a node at the same time (0 for no limit).
+# With a limit, the scheduler counts the backup pods on each node and picks
+# the node of every new job itself, the one with the most CPU left to request,
+# deferring the volumes it has no room for to the next run
+BACKUP_MAX_PODS_PER_NODE = int(
+    os.environ.get('BACKUP_MAX_PODS_PER_NODE', '0'),
+    10,
+)
+
+# Where backup pods can run, and what they request, as JSON: the node
+# selector and tolerations are used as-is in the pod spec, the topology
+# spread constraints apply to the backup pods (the label selector is added),
+# and the resources are those of the backup containers. With CPU requests,
+# the Kubernetes scheduler favors the nodes that have the most to spare
+BACKUP_NODE_SELECTOR = json_env('BACKUP_NODE_SELECTOR', {})
+BACKUP_TOLERATIONS = json_env('BACKUP_TOLERATIONS', [])
+BACKUP_TOPOLOGY_SPREAD = json_env('BACKUP_TOPOLOGY_SPREAD', [])
+BACKUP_RESOURCES = json_env('BACKUP_RESOURCES', {})
+
+# The node picked for a backup pod, until it is scheduled (node names can be
+# longer than label values)
+ANNOTATION_NODE = METADATA_PREFIX + 'node'
+
+
+def backup_pods_selector():
+    return k8s_client.V1LabelSelector(
+        match_expressions=[
+            k8s_client.V1LabelSelectorRequirement(
+                key=METADATA_PREFIX + 'volume-type',
+                operator='Exists',
+            ),
+        ],
+    )
+
+
+def anti_affinity():
+    return k8s_client.V1PodAntiAffinity(
+        preferred_during_scheduling_ignored_during_execution=[
+            k8s_client.V1WeightedPodAffinityTerm(
+                weight=50,
+                pod_affinity_term=k8s_client.V1PodAffinityTerm(
+                    label_selector=backup_pods_selector(),
+                    topology_key='kubernetes.io/hostname',
+                ),
+            ),
+        ],
+    )
+
+
+def pod_placement(node=None):
+    """Get the placement fields of the spec of a backup pod.
+
+    If ``node`` is given, the pod can only run on that node.
+    """
+    node_affinity = None
+    if node is not None:
+        node_affinity = k8s_client.V1NodeAffinity(
+            required_during_scheduling_ignored_during_execution=(
+                k8s_client.V1NodeSelector(
+                    node_selector_terms=[
+                        k8s_client.V1NodeSelectorTerm(
+                            # The node name, which can differ from its
+                            # kubernetes.io/hostname label
+                            match_fields=[
+                                k8s_client.V1NodeSelectorRequirement(
+                                    key='metadata.name',
+                                    operator='In',
+                                    values=[node],
+                                ),
+                            ],
+                        ),
+                    ],
+                )
+            ),
+        )
+    return dict(
+        affinity=k8s_client.V1Affinity(
+            node_affinity=node_affinity,
+            pod_anti_affinity=anti_affinity(),
+        ),
+        node_selector=BACKUP_NODE_SELECTOR or None,
+        tolerations=BACKUP_TOLERATIONS or None,
+        topology_spread_constraints=[
+            k8s_client.V1TopologySpreadConstraint(
+                max_skew=constraint.get('maxSkew', 1),
+                topology_key=constraint['topologyKey'],
+                when_unsatisfiable=constraint.get(
+                    'whenUnsatisfiable', 'ScheduleAnyway',
+                ),
+                label_selector=backup_pods_selector(),
+            )
+            for constraint in BACKUP_TOPOLOGY_SPREAD
+        ] or None,
+    )
+
+
+def pod_annotations(node=None):
+    """Get the annotations of a backup pod, recording its node if given."""
+    if node is None:
+        return None
+    return {ANNOTATION_NODE: node}
+
+
+def container_resources():
+    """Get the resources of backup containers."""
+    if not BACKUP_RESOURCES:
+        return None
+    return k8s_client.V1ResourceRequirements(
+        requests=BACKUP_RESOURCES.get('requests'),
+        limits=BACKUP_RESOURCES.get('limits'),
+    )
+
+
+def tolerates(taint):
+    """Whether the backup pods tolerate a taint."""
+    if taint.effect == 'PreferNoSchedule':
+        return True
+    for toleration in BACKUP_TOLERATIONS:
+        if toleration.get('effect') and toleration['effect'] != taint.effect:
+            continue
+        if toleration.get('operator') == 'Exists':
+            if not toleration.get('key') or toleration['key'] == taint.key:
+                return True
+        elif (
+            toleration.get('key') == taint.key
+            and toleration.get('value', '') == (taint.value or '')
+        ):
+            return True
+    return False
+
+
+def node_ready(node):
+    if node.spec.unschedulable:
+        return False
+    if not all(tolerates(taint) for taint in node.spec.taints or ()):
+        return False
+    return any(
+        condition.type == 'Ready' and condition.status == 'True'
+        for condition in node.status.conditions or ()
+    )
+
+
+def pod_cpu_requests(pod):
+    """Get the CPU requested by the containers of a pod, as parsed JSON."""
+    total = 0
+    for container in pod['spec'].get('containers') or ():
+        requests = (container.get('resources') or {}).get('requests') or {}
+        total += parse_quantity(requests.get('cpu', '0'))
+    return total
+
+
+class NodeSlots(object):
+    """Room for backup pods on each node, up to BACKUP_MAX_PODS_PER_NODE.
+
+    New jobs are put on the node with the most CPU left to request (its
+    allocatable CPU minus the requests of the pods on it), which is what the
+    Kubernetes scheduler would favor, taking off what the backup containers
+    request each time. If they request no CPU, the node with the most room
+    left is picked first instead, which spreads the jobs over the nodes.
+    """
+
+    def __init__(self, free, cpu=None):
+        self._lock = threading.Lock()
+        self._free = free
+        self._cpu = cpu or {}
+        requests = (BACKUP_RESOURCES.get('requests') or {}).get('cpu')
+        self._cpu_request = parse_quantity(requests or '0')
+
+    @classmethod
+    def load(cls, api):
+        corev1 = k8s_client.CoreV1Api(api)
+
+        free = {}
+        cpu = {}
+        for page in list_pages(
+            corev1.list_node,
+            label_selector=','.join(
+                '%s=%s' % (k, v) for k, v in BACKUP_NODE_SELECTOR.items()
+            ) or None,
+        ):
+            for node in page.items:
+                if node_ready(node):
+                    free[node.metadata.name] = BACKUP_MAX_PODS_PER_NODE
+                    cpu[node.metadata.name] = parse_quantity(
+                        (node.status.allocatable or {}).get('cpu', '0'),
+                    )
+
+        # Take off the CPU requested by the pods that are running or about
+        # to, in every namespace, and count the backup pods
+        for page in list_pages(
+            raw_list_func(api, '/api/v1/pods'),
+            field_selector='status.phase!=Succeeded,status.phase!=Failed',
+        ):
+            for pod in page.items:
+                phase = (pod.get('status') or {}).get('phase')
+                if phase not in (None, 'Pending', 'Running'):
+                    continue
+                metadata = pod['metadata']
+                node = (
+                    pod['spec'].get('nodeName')
+                    or (metadata.get('annotations') or {}).get(ANNOTATION_NODE)
+                )
+                if node not in free:
+                    continue
+                cpu[node] -= pod_cpu_requests(pod)
+                if (
+                    metadata.get('namespace') == NAMESPACE
+                    and METADATA_PREFIX + 'volume-type' in (
+                        metadata.get('labels') or {}
+                    )
+                ):
+                    free[node] -= 1
+
+        slots = cls(free, cpu)
+        logger.info(
+            "Room for %d backup pods on %d nodes",
+            slots.total(), len(free),
+        )
+        return slots
+
+    def total(self):
+        with self._lock:
+            return sum(max(0, n) for n in self._free.values())
+
+    def reserve(self):
+        """Pick the node for a new backup pod.
+
+        Returns None if all the nodes are full.
+        """
+        with self._lock:
+            available = [n for n, free in self._free.items() if free > 0]
+            if not available:
+                return None
+            if self._cpu_request:
+                node = max(
+                    available,
+                    key=lambda n: (self._cpu.get(n, 0), self._free[n], n),
+                )
+            else:
+                node = max(
+                    available,
+                    key=lambda n: (self._free[n], self._cpu.get(n, 0), n),
+                )
+            self._free[node] -= 1
+            if node in self._cpu:
+                self._cpu[node] -= self._cpu_request
+            return node
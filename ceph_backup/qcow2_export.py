@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+
+"""Stream a disk image as qcow2, only reading its allocated extents.
+
+This is shipped as a standalone script in the backup image, so it only uses
+the standard library.
+
+Usage: qcow2-export [--workers N] [--read-size BYTES] [--coalesce-gap BYTES]
+    [--drop-zeros] DISK LAYOUT.json
+
+The layout is the output of ``rbd diff --format=json``. The qcow2 file is
+written to stdout, all the metadata first, followed by the data clusters in
+the order of the disk, so it can be written without seeking. Reads from the
+disk are done ahead by a pool of threads, into a fixed set of buffers that
+are reused once their data has been written out.
+
+The file holds the same disk as the one streaming-qcow2-writer makes from the
+same layout, but isn't guaranteed to be the same bytes;
+benchmarks/check_qcow2_export.py compares the two and runs ``qemu-img check``
+on them.
+
+With a fine-grained layout (``rbd diff`` without ``--whole-object``), small
+extents that are close to each other are read at once, gap included, but
+only the clusters they cover end up in the qcow2 file.
+
+In a diff (``rbd diff --from-snap``), the extents that were discarded or
+zeroed since the previous snapshot are marked as zero clusters, so that
+applying the file on top of the previous backup clears them.
+
+With ``--drop-zeros``, the extents are read a first time to find the
+clusters that only hold zeros, which are then written as zero clusters
+rather than data. Because the metadata comes first, this reads the data
+twice, which only pays off on images with large zeroed areas.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import heapq
+import itertools
+import json
+import os
+import struct
+import sys
+import threading
+
+
+CLUSTER_BITS = 16
+CLUSTER_SIZE = 1 << CLUSTER_BITS
+
+# 16-bit refcounts
+REFCOUNT_ORDER = 4
+
+L2_ENTRIES = CLUSTER_SIZE // 8
+REFCOUNT_BLOCK_ENTRIES = CLUSTER_SIZE * 8 >> REFCOUNT_ORDER
+
+# The cluster is used only once (no snapshot), so it can be written in place
+QCOW_OFLAG_COPIED = 1 << 63
+# The cluster reads as zeros (qcow2 v3)
+QCOW_OFLAG_ZERO = 1
+
+HEADER_LENGTH = 104
+
+
+def ceil_div(a, b):
+    return (a + b - 1) // b
+
+
+def allocated_clusters(layout, size):
+    """Get the sorted lists of data clusters and zero clusters.
+
+    Extents that don't exist (discarded or zeroed, in a diff) give zero
+    clusters where they cover whole clusters. The clusters they only partly
+    cover are read from the disk, like the extents that hold data.
+    """
+    clusters = set()
+    zeros = set()
+    for extent in layout:
+        start = extent['offset']
+        end = min(start + extent['length'], size)
+        if end <= start:
+            continue
+        if extent.get('exists', 'true') in (False, 'false'):
+            # The last cluster can go past the end of the disk
+            zero_end = ceil_div(end, CLUSTER_SIZE) if end == size \
+                else end >> CLUSTER_BITS
+            zero_start = ceil_div(start, CLUSTER_SIZE)
+            zeros.update(range(zero_start, zero_end))
+            if zero_start > zero_end:
+                # Within a single cluster
+                clusters.add(start >> CLUSTER_BITS)
+                continue
+            if start % CLUSTER_SIZE:
+                clusters.add(start >> CLUSTER_BITS)
+            if zero_end * CLUSTER_SIZE < end:
+                clusters.add(zero_end)
+        else:
+            clusters.update(range(
+                start >> CLUSTER_BITS,
+                ceil_div(end, CLUSTER_SIZE),
+            ))
+    return sorted(clusters), sorted(zeros - clusters)
+
+
+class Layout(object):
+    """Where everything goes in the qcow2 file, in clusters."""
+
+    def __init__(self, size, clusters, zeros=()):
+        self.size = size
+        self.clusters = clusters
+        self.zeros = zeros
+
+        self.l1_size = max(1, ceil_div(size, CLUSTER_SIZE * L2_ENTRIES))
+        self.l1_offset = 1
+        l1_clusters = ceil_div(self.l1_size * 8, CLUSTER_SIZE)
+
+        # The L2 tables that have entries
+        self.l2_tables = sorted(set(
+            c // L2_ENTRIES for c in itertools.chain(clusters, zeros)
+        ))
+
+        # The refcount structures count themselves, so grow them until they
+        # cover every cluster
+        refcount_blocks = 1
+        while True:
+            refcount_table_clusters = ceil_div(
+                refcount_blocks * 8,
+                CLUSTER_SIZE,
+            )
+            total = (
+                1 + l1_clusters + refcount_table_clusters + refcount_blocks
+                + len(self.l2_tables) + len(clusters)
+            )
+            needed = ceil_div(total, REFCOUNT_BLOCK_ENTRIES)
+            if needed <= refcount_blocks:
+                break
+            refcount_blocks = needed
+        self.total_clusters = total
+
+        self.refcount_table_offset = self.l1_offset + l1_clusters
+        self.refcount_table_clusters = refcount_table_clusters
+        self.refcount_blocks_offset = (
+            self.refcount_table_offset + refcount_table_clusters
+        )
+        self.refcount_blocks = refcount_blocks
+        self.l2_offset = self.refcount_blocks_offset + refcount_blocks
+        self.data_offset = self.l2_offset + len(self.l2_tables)
+
+    def header(self):
+        header = struct.pack(
+            '>4sIQIIQIIQQIIQQQQII',
+            b'QFI\xfb',
+            3,  # version
+            0, 0,  # backing file
+            CLUSTER_BITS,
+            self.size,
+            0,  # encryption
+            self.l1_size,
+            self.l1_offset * CLUSTER_SIZE,
+            self.refcount_table_offset * CLUSTER_SIZE,
+            self.refcount_table_clusters,
+            0, 0,  # snapshots
+            0, 0, 0,  # incompatible, compatible, autoclear features
+            REFCOUNT_ORDER,
+            HEADER_LENGTH,
+        )
+        # End of header extensions
+        header += struct.pack('>II', 0, 0)
+        return header
+
+    def l1_table(self):
+        table = [0] * self.l1_size
+        for i, l2 in enumerate(self.l2_tables):
+            table[l2] = ((self.l2_offset + i) * CLUSTER_SIZE) | \
+                QCOW_OFLAG_COPIED
+        return struct.pack('>%dQ' % self.l1_size, *table)
+
+    def refcount_table(self):
+        return struct.pack(
+            '>%dQ' % self.refcount_blocks,
+            *(
+                (self.refcount_blocks_offset + i) * CLUSTER_SIZE
+                for i in range(self.refcount_blocks)
+            ),
+        )
+
+    def refcount_block(self, index):
+        start = index * REFCOUNT_BLOCK_ENTRIES
+        used = max(0, min(
+            self.total_clusters - start,
+            REFCOUNT_BLOCK_ENTRIES,
+        ))
+        return struct.pack('>%dH' % used, *([1] * used))
+
+    def l2_tables_data(self):
+        """Generate the contents of each L2 table."""
+        data_cluster = self.data_offset
+        for l2, clusters in itertools.groupby(
+            heapq.merge(
+                ((c, False) for c in self.clusters),
+                ((c, True) for c in self.zeros),
+            ),
+            key=lambda item: item[0] // L2_ENTRIES,
+        ):
+            table = [0] * L2_ENTRIES
+            for c, zero in clusters:
+                if zero:
+                    table[c - l2 * L2_ENTRIES] = QCOW_OFLAG_ZERO
+                    continue
+                table[c - l2 * L2_ENTRIES] = (data_cluster * CLUSTER_SIZE) | \
+                    QCOW_OFLAG_COPIED
+                data_cluster += 1
+            yield struct.pack('>%dQ' % L2_ENTRIES, *table)
+
+
+def write_all(fd, data):
+    data = memoryview(data)
+    while data:
+        written = os.write(fd, data)
+        data = data[written:]
+
+
+def write_cluster(fd, data):
+    """Write metadata, padded to a whole cluster."""
+    write_all(fd, data)
+    if len(data) % CLUSTER_SIZE:
+        write_all(fd, bytes(CLUSTER_SIZE - len(data) % CLUSTER_SIZE))
+
+
+def read_runs(clusters, read_size, coalesce_gap=0):
+    """Group clusters into reads of up to ``read_size`` bytes.
+
+    Clusters separated by a gap of up to ``coalesce_gap`` bytes are read
+    together, with the gap, to make fewer and larger reads. Generates the
+    first cluster of each read and the list of clusters that were asked for.
+    """
+    max_clusters = max(1, read_size // CLUSTER_SIZE)
+    max_gap = coalesce_gap // CLUSTER_SIZE
+    run_start = None
+    run = []
+    for c in clusters:
+        if run_start is not None and (
+            c - run[-1] - 1 <= max_gap and c - run_start < max_clusters
+        ):
+            run.append(c)
+            continue
+        if run_start is not None:
+            yield run_start, run
+        run_start = c
+        run = [c]
+    if run_start is not None:
+        yield run_start, run
+
+
+def read_into(disk_fd, size, buf, start, length):
+    """Read clusters from the disk, zero-filling past its end."""
+    view = memoryview(buf)[:length * CLUSTER_SIZE]
+    offset = start * CLUSTER_SIZE
+    pos = 0
+    while pos < len(view):
+        n = 0
+        if offset + pos < size:
+            n = os.preadv(
+                disk_fd,
+                [view[pos:min(len(view), size - offset)]],
+                offset + pos,
+            )
+        if n == 0:
+            # End of the disk
+            view[pos:] = bytes(len(view) - pos)
+            break
+        pos += n
+    return view
+
+
+def find_zero_clusters(
+    disk_fd, size, clusters,
+    workers=8, read_size=4 << 20, coalesce_gap=0,
+):
+    """Read the clusters ahead of the export, to find those holding zeros."""
+    buffer_size = max(1, read_size // CLUSTER_SIZE) * CLUSTER_SIZE
+    local = threading.local()
+    zero = bytes(CLUSTER_SIZE)
+
+    def scan(item):
+        start, run = item
+        buf = getattr(local, 'buf', None)
+        if buf is None:
+            buf = local.buf = bytearray(buffer_size)
+        view = read_into(disk_fd, size, buf, start, run[-1] + 1 - start)
+        return [
+            c for c in run
+            if view[
+                (c - start) * CLUSTER_SIZE:(c + 1 - start) * CLUSTER_SIZE
+            ].tobytes() == zero
+        ]
+
+    found = set()
+    with ThreadPoolExecutor(workers) as executor:
+        for zeros in executor.map(
+            scan,
+            read_runs(clusters, read_size, coalesce_gap),
+        ):
+            found.update(zeros)
+    return found
+
+
+def export(
+    disk_fd, size, clusters, out_fd,
+    workers=8, read_size=4 << 20, coalesce_gap=0, zeros=(),
+):
+    layout = Layout(size, clusters, zeros)
+
+    # Metadata
+    write_cluster(out_fd, layout.header())
+    write_cluster(out_fd, layout.l1_table())
+    write_cluster(out_fd, layout.refcount_table())
+    for i in range(layout.refcount_blocks):
+        write_cluster(out_fd, layout.refcount_block(i))
+    for table in layout.l2_tables_data():
+        write_all(out_fd, table)
+
+    # Data, read ahead by the workers, each read into one of the buffers
+    buffer_size = max(1, read_size // CLUSTER_SIZE) * CLUSTER_SIZE
+    free_buffers = [bytearray(buffer_size) for _ in range(workers * 2)]
+    pending = collections.deque()
+    runs = read_runs(clusters, read_size, coalesce_gap)
+    with ThreadPoolExecutor(workers) as executor:
+        while True:
+            while free_buffers:
+                try:
+                    start, run = next(runs)
+                except StopIteration:
+                    break
+                buf = free_buffers.pop()
+                pending.append((start, run, buf, executor.submit(
+                    read_into, disk_fd, size, buf, start, run[-1] + 1 - start,
+                )))
+            if not pending:
+                break
+            start, run, buf, future = pending.popleft()
+            view = future.result()
+            # Only write the clusters that were asked for, not the gaps
+            for _, group in itertools.groupby(
+                enumerate(run),
+                key=lambda item: item[1] - item[0],
+            ):
+                group = list(group)
+                write_all(out_fd, view[
+                    (group[0][1] - start) * CLUSTER_SIZE:
+                    (group[-1][1] + 1 - start) * CLUSTER_SIZE
+                ])
+            free_buffers.append(buf)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'qcow2-export',
+        description="Stream the allocated extents of a disk as qcow2",
+    )
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--read-size', type=int, default=4 << 20)
+    parser.add_argument(
+        '--coalesce-gap', type=int, default=0,
+        help="Read extents separated by up to this many bytes together",
+    )
+    parser.add_argument(
+        '--drop-zeros', action='store_true',
+        help="Read the extents twice, to write zeroed clusters as such",
+    )
+    parser.add_argument('disk')
+    parser.add_argument('layout')
+    args = parser.parse_args()
+
+    with open(args.layout) as fp:
+        layout = json.load(fp)
+
+    disk_fd = os.open(args.disk, os.O_RDONLY)
+    try:
+        size = os.lseek(disk_fd, 0, os.SEEK_END)
+        clusters, zeros = allocated_clusters(layout, size)
+        if args.drop_zeros:
+            found = find_zero_clusters(
+                disk_fd, size, clusters,
+                args.workers, args.read_size, args.coalesce_gap,
+            )
+            clusters = [c for c in clusters if c not in found]
+            zeros = sorted(found.union(zeros))
+        export(
+            disk_fd, size, clusters,
+            sys.stdout.fileno(), args.workers, args.read_size,
+            args.coalesce_gap, zeros,
+        )
+    finally:
+        os.close(disk_fd)
+
+
+if __name__ == '__main__':
+    main()
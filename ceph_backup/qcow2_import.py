@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+
+"""Write a qcow2 stream to a disk, only writing its allocated clusters.
+
+This is shipped as a standalone script in the backup image, so it only uses
+the standard library.
+
+Usage: qcow2-import [--workers N] [--write-size BYTES] [--skip-zeros] DISK
+
+The qcow2 file is read from stdin, in one pass, so its L1 and L2 tables need
+to come before the data clusters, like in the files qcow2-export and
+streaming-qcow2-writer produce. Unallocated clusters are not written, so the
+disk should start out empty (or hold the previous backup, when applying an
+incremental one). Writes are done by a pool of threads, from a fixed set of
+buffers. A summary is printed as JSON on stdout.
+"""
+
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+import collections
+import json
+import os
+import struct
+import sys
+import time
+
+
+QCOW_MAGIC = b'QFI\xfb'
+
+OFFSET_MASK = 0x00fffffffffffe00
+QCOW_OFLAG_COMPRESSED = 1 << 62
+QCOW_OFLAG_ZERO = 1
+
+
+class Qcow2Error(Exception):
+    pass
+
+
+class Stream(object):
+    """Reads a file front to back, keeping track of the position."""
+
+    def __init__(self, fp):
+        self._fp = fp
+        self.position = 0
+
+    def readinto(self, view):
+        pos = 0
+        while pos < len(view):
+            n = self._fp.readinto(view[pos:])
+            if not n:
+                raise Qcow2Error("Unexpected end of file")
+            pos += n
+        self.position += len(view)
+
+    def read(self, size):
+        buf = bytearray(size)
+        self.readinto(memoryview(buf))
+        return buf
+
+    def skip_to(self, offset):
+        if offset < self.position:
+            raise Qcow2Error(
+                "Data at %d comes before the metadata, the file can't be "
+                "read as a stream" % offset
+            )
+        while self.position < offset:
+            self.read(min(offset - self.position, 1 << 20))
+
+
+def read_mapping(stream):
+    """Read the header and tables, at the start of the stream.
+
+    Returns the header fields, a list of ``(host offset, guest cluster)`` for
+    the data clusters, sorted by host offset, and the list of guest clusters
+    that read as zeros.
+    """
+    header = struct.unpack('>4sIQIIQIIQQIIQ', stream.read(72))
+    (
+        magic, version, backing_file_offset, backing_file_size,
+        cluster_bits, size, crypt_method, l1_size, l1_table_offset,
+        refcount_table_offset, refcount_table_clusters, nb_snapshots,
+        snapshots_offset,
+    ) = header
+    if magic != QCOW_MAGIC:
+        raise Qcow2Error("Not a qcow2 file")
+    if version not in (2, 3):
+        raise Qcow2Error("Unsupported qcow2 version %d" % version)
+    if version == 3:
+        incompatible_features, = struct.unpack('>Q', stream.read(8))
+        if incompatible_features:
+            raise Qcow2Error(
+                "Unsupported qcow2 features %x" % incompatible_features
+            )
+    if backing_file_offset:
+        raise Qcow2Error("qcow2 files with a backing file are not supported")
+    if crypt_method:
+        raise Qcow2Error("Encrypted qcow2 files are not supported")
+    cluster_size = 1 << cluster_bits
+    l2_entries = cluster_size // 8
+
+    stream.skip_to(l1_table_offset)
+    l1_table = struct.unpack('>%dQ' % l1_size, stream.read(l1_size * 8))
+    l2_tables = sorted(
+        (entry & OFFSET_MASK, index)
+        for index, entry in enumerate(l1_table)
+        if entry & OFFSET_MASK
+    )
+
+    data = []
+    zeros = []
+    for offset, l1_index in l2_tables:
+        stream.skip_to(offset)
+        table = struct.unpack(
+            '>%dQ' % l2_entries,
+            stream.read(cluster_size),
+        )
+        for l2_index, entry in enumerate(table):
+            guest_cluster = l1_index * l2_entries + l2_index
+            if entry & QCOW_OFLAG_COMPRESSED:
+                raise Qcow2Error("Compressed qcow2 files are not supported")
+            elif entry & QCOW_OFLAG_ZERO:
+                zeros.append(guest_cluster)
+            elif entry & OFFSET_MASK:
+                data.append((entry & OFFSET_MASK, guest_cluster))
+    data.sort()
+
+    return {
+        'cluster_size': cluster_size,
+        'size': size,
+    }, data, zeros
+
+
+def write_runs(data, cluster_size, write_size):
+    """Group data clusters that follow each other on both sides.
+
+    Generates the host offset, the guest offset, and the number of clusters.
+    """
+    max_clusters = max(1, write_size // cluster_size)
+    run = None
+    for host, guest_cluster in data:
+        if run is not None and (
+            host == run[0] + run[2] * cluster_size
+            and guest_cluster * cluster_size == run[1] + run[2] * cluster_size
+            and run[2] < max_clusters
+        ):
+            run[2] += 1
+            continue
+        if run is not None:
+            yield tuple(run)
+        run = [host, guest_cluster * cluster_size, 1]
+    if run is not None:
+        yield tuple(run)
+
+
+def write_all(fd, view, offset):
+    while view:
+        written = os.pwrite(fd, view, offset)
+        view = view[written:]
+        offset += written
+
+
+def import_stream(
+    fp, disk_fd, disk_size, workers=8, write_size=4 << 20, skip_zeros=False,
+):
+    stream = Stream(fp)
+    header, data, zeros = read_mapping(stream)
+    cluster_size = header['cluster_size']
+    if header['size'] > disk_size:
+        raise Qcow2Error(
+            "Disk is too small (%d bytes, %d needed)"
+            % (disk_size, header['size'])
+        )
+
+    stats = {'bytes_written': 0, 'zero_clusters_skipped': 0}
+    buffer_size = max(1, write_size // cluster_size) * cluster_size
+    zero = memoryview(bytes(buffer_size))
+
+    def write(view, offset):
+        if skip_zeros and view == zero[:len(view)]:
+            # The disk is empty, so it reads as zeros already
+            return 0, len(view) // cluster_size
+        write_all(disk_fd, view, offset)
+        return len(view), 0
+
+    def wait(future):
+        written, skipped = future.result()
+        stats['bytes_written'] += written
+        stats['zero_clusters_skipped'] += skipped
+
+    free_buffers = [bytearray(buffer_size) for _ in range(workers * 2)]
+    pending = collections.deque()
+    with ThreadPoolExecutor(workers) as executor:
+        # Clusters marked as zeros (there is no data to read for them)
+        if not skip_zeros:
+            for guest_cluster in zeros:
+                guest = guest_cluster * cluster_size
+                # The last cluster can go past the end of the disk
+                length = max(0, min(cluster_size, header['size'] - guest))
+                pending.append((None, executor.submit(
+                    write, zero[:length], guest,
+                )))
+
+        for host, guest, clusters in write_runs(
+            data, cluster_size, write_size,
+        ):
+            # Get a buffer, waiting for the oldest writes if needed
+            while not free_buffers:
+                buf, future = pending.popleft()
+                wait(future)
+                if buf is not None:
+                    free_buffers.append(buf)
+            buf = free_buffers.pop()
+
+            stream.skip_to(host)
+            view = memoryview(buf)[:clusters * cluster_size]
+            stream.readinto(view)
+            # The last cluster can go past the end of the disk
+            view = view[:max(0, min(len(view), header['size'] - guest))]
+            pending.append((buf, executor.submit(write, view, guest)))
+
+        for buf, future in pending:
+            wait(future)
+
+    stats['bytes_read'] = stream.position
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        'qcow2-import',
+        description="Write a qcow2 stream from stdin to a disk",
+    )
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--write-size', type=int, default=4 << 20)
+    parser.add_argument(
+        '--skip-zeros', action='store_true', default=False,
+        help="Don't write clusters that only hold zeros (the disk has to "
+        + "read as zeros already)",
+    )
+    parser.add_argument('disk')
+    args = parser.parse_args()
+
+    start = time.monotonic()
+    disk_fd = os.open(args.disk, os.O_WRONLY)
+    try:
+        disk_size = os.lseek(disk_fd, 0, os.SEEK_END)
+        stats = import_stream(
+            sys.stdin.buffer, disk_fd, disk_size,
+            args.workers, args.write_size, args.skip_zeros,
+        )
+        os.fsync(disk_fd)
+    except Qcow2Error as e:
+        print("qcow2-import: %s" % e, file=sys.stderr)
+        sys.exit(1)
+    finally:
+        os.close(disk_fd)
+    stats['message_type'] = 'restore_summary'
+    stats['total_duration'] = time.monotonic() - start
+    print(json.dumps(stats, sort_keys=True))
+
+
+if __name__ == '__main__':
+    main()
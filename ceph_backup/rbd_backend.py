@@ -0,0 +1,470 @@
+import logging
+import os
+import shlex
+import subprocess
+import threading
+import time
+
+from .instrumentation import RBD_COMMAND_DURATION, RBD_COMMAND_ERRORS
+
+
+logger = logging.getLogger(__name__)
+
+
+RBD_BACKEND = os.environ.get('RBD_BACKEND', 'cli')
+CEPH_CONF = os.environ.get('CEPH_CONF', '/var/run/secrets/ceph/rbd.conf')
+
+
+def call(args):
+    logger.info("> %s", ' '.join(shlex.quote(a) for a in args))
+    retcode = subprocess.call(args, stdout=subprocess.DEVNULL)
+    logger.info("-> %d", retcode)
+    return retcode
+
+
+def check_call(args):
+    retcode = call(args)
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode, args)
+
+
+def check_output(args):
+    logger.info("> %s", ' '.join(shlex.quote(a) for a in args))
+    with subprocess.Popen(args, stdout=subprocess.PIPE) as process:
+        stdout, stderr = process.communicate()
+        retcode = process.poll()
+    logger.info("-> %d", retcode)
+    if retcode != 0:
+        raise subprocess.CalledProcessError(retcode, args)
+    return stdout
+
+
+class RbdBackend(object):
+    """Operations on RBD images and snapshots.
+
+    Clones are always created in the same pool as their parent.
+    """
+
+    def image_exists(self, pool, image):
+        raise NotImplementedError
+
+    def snapshot_exists(self, pool, image, snapshot):
+        raise NotImplementedError
+
+    def create_image(self, pool, image, size):
+        """Create an empty image of ``size`` bytes."""
+        raise NotImplementedError
+
+    def remove_image(self, pool, image):
+        raise NotImplementedError
+
+    def create_snapshot(self, pool, image, snapshot):
+        raise NotImplementedError
+
+    def protect_snapshot(self, pool, image, snapshot):
+        raise NotImplementedError
+
+    def unprotect_snapshot(self, pool, image, snapshot):
+        """Unprotect a snapshot, doing nothing if it is not protected."""
+        raise NotImplementedError
+
+    def remove_snapshot(self, pool, image, snapshot):
+        raise NotImplementedError
+
+    def rename_snapshot(self, pool, image, snapshot, new_name):
+        raise NotImplementedError
+
+    def clone(self, pool, image, snapshot, clone):
+        raise NotImplementedError
+
+    def flatten(self, pool, image):
+        """Copy the data of a clone's parent into it, detaching it."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+def _image_spec(pool, image):
+    return pool + '/' + image
+
+
+def _snapshot_spec(pool, image, snapshot):
+    return pool + '/' + image + '@' + snapshot
+
+
+class CliRbdBackend(RbdBackend):
+    """Runs the ``rbd`` command-line tool for each operation."""
+
+    def image_exists(self, pool, image):
+        return call(['rbd', 'info', _image_spec(pool, image)]) == 0
+
+    def snapshot_exists(self, pool, image, snapshot):
+        spec = _snapshot_spec(pool, image, snapshot)
+        return call(['rbd', 'info', spec]) == 0
+
+    def create_image(self, pool, image, size):
+        check_call([
+            'rbd', 'create',
+            # In MiB
+            '--size', '%d' % ((size + (1 << 20) - 1) >> 20),
+            _image_spec(pool, image),
+        ])
+
+    def remove_image(self, pool, image):
+        check_call(['rbd', 'rm', _image_spec(pool, image)])
+
+    def create_snapshot(self, pool, image, snapshot):
+        spec = _snapshot_spec(pool, image, snapshot)
+        check_call(['rbd', 'snap', 'create', spec])
+
+    def protect_snapshot(self, pool, image, snapshot):
+        spec = _snapshot_spec(pool, image, snapshot)
+        check_call(['rbd', 'snap', 'protect', spec])
+
+    def unprotect_snapshot(self, pool, image, snapshot):
+        spec = _snapshot_spec(pool, image, snapshot)
+        call(['rbd', 'snap', 'unprotect', spec])
+
+    def remove_snapshot(self, pool, image, snapshot):
+        spec = _snapshot_spec(pool, image, snapshot)
+        check_call(['rbd', 'snap', 'rm', spec])
+
+    def rename_snapshot(self, pool, image, snapshot, new_name):
+        check_call([
+            'rbd', 'snap', 'rename',
+            _snapshot_spec(pool, image, snapshot),
+            _snapshot_spec(pool, image, new_name),
+        ])
+
+    def clone(self, pool, image, snapshot, clone):
+        check_call([
+            'rbd', 'clone',
+            _snapshot_spec(pool, image, snapshot),
+            _image_spec(pool, clone),
+        ])
+
+    def flatten(self, pool, image):
+        check_call(['rbd', 'flatten', _image_spec(pool, image)])
+
+
+class NativeRbdBackend(RbdBackend):
+    """Uses the librados and librbd bindings over a single connection.
+
+    The bindings are built for a specific Python, usually the one from the
+    distribution (python3-rados, python3-rbd), which is what the ceph-backup
+    image runs.
+    """
+
+    def __init__(self, user, conffile=CEPH_CONF, keyring=CEPH_CONF):
+        try:
+            import rados
+            import rbd
+        except ImportError:
+            raise RuntimeError(
+                "The native RBD backend needs the rados and rbd Python "
+                + "modules built for this Python (python3-rados, "
+                + "python3-rbd with the distribution's Python)"
+            )
+        self._rbd_module = rbd
+        self._rbd = rbd.RBD()
+
+        self._cluster = rados.Rados(
+            conffile=conffile,
+            rados_id=user,
+            conf={'keyring': keyring},
+        )
+        self._cluster.connect()
+        logger.info("Connected to Ceph cluster")
+
+        self._lock = threading.Lock()
+        self._ioctxs = {}
+
+    def _ioctx(self, pool):
+        with self._lock:
+            try:
+                return self._ioctxs[pool]
+            except KeyError:
+                ioctx = self._cluster.open_ioctx(pool)
+                self._ioctxs[pool] = ioctx
+                return ioctx
+
+    def _image(self, pool, image, **kwargs):
+        return self._rbd_module.Image(self._ioctx(pool), image, **kwargs)
+
+    def image_exists(self, pool, image):
+        try:
+            with self._image(pool, image, read_only=True):
+                return True
+        except self._rbd_module.ImageNotFound:
+            return False
+
+    def snapshot_exists(self, pool, image, snapshot):
+        try:
+            with self._image(
+                pool, image,
+                snapshot=snapshot,
+                read_only=True,
+            ):
+                return True
+        except self._rbd_module.ImageNotFound:
+            return False
+
+    def create_image(self, pool, image, size):
+        logger.info("Creating image %s/%s (%d bytes)", pool, image, size)
+        self._rbd.create(self._ioctx(pool), image, size)
+
+    def remove_image(self, pool, image):
+        logger.info("Removing image %s/%s", pool, image)
+        self._rbd.remove(self._ioctx(pool), image)
+
+    def create_snapshot(self, pool, image, snapshot):
+        logger.info("Creating snapshot %s/%s@%s", pool, image, snapshot)
+        with self._image(pool, image) as img:
+            img.create_snap(snapshot)
+
+    def protect_snapshot(self, pool, image, snapshot):
+        logger.info("Protecting snapshot %s/%s@%s", pool, image, snapshot)
+        with self._image(pool, image) as img:
+            img.protect_snap(snapshot)
+
+    def unprotect_snapshot(self, pool, image, snapshot):
+        with self._image(pool, image) as img:
+            if img.is_protected_snap(snapshot):
+                logger.info(
+                    "Unprotecting snapshot %s/%s@%s", pool, image, snapshot,
+                )
+                img.unprotect_snap(snapshot)
+
+    def remove_snapshot(self, pool, image, snapshot):
+        logger.info("Removing snapshot %s/%s@%s", pool, image, snapshot)
+        with self._image(pool, image) as img:
+            img.remove_snap(snapshot)
+
+    def rename_snapshot(self, pool, image, snapshot, new_name):
+        logger.info(
+            "Renaming snapshot %s/%s@%s to %s", pool, image, snapshot, new_name,
+        )
+        with self._image(pool, image) as img:
+            img.rename_snap(snapshot, new_name)
+
+    def clone(self, pool, image, snapshot, clone):
+        logger.info(
+            "Cloning %s/%s@%s to %s/%s", pool, image, snapshot, pool, clone,
+        )
+        ioctx = self._ioctx(pool)
+        self._rbd.clone(ioctx, image, snapshot, ioctx, clone)
+
+    def flatten(self, pool, image):
+        logger.info("Flattening %s/%s", pool, image)
+        with self._image(pool, image) as img:
+            img.flatten()
+
+    def close(self):
+        with self._lock:
+            for ioctx in self._ioctxs.values():
+                ioctx.close()
+            self._ioctxs = {}
+        self._cluster.shutdown()
+
+
+class FakeRbdBackend(RbdBackend):
+    """Keeps images in memory and records the calls made, for benchmarks."""
+
+    def __init__(self, create_images=False):
+        self._lock = threading.Lock()
+        # (pool, image) -> {'snapshots': {name: protected}, 'parent': ...}
+        self.images = {}
+        self.calls = []
+        # Whether images that are not known are created on first use
+        self._create_images = create_images
+
+    def add_image(self, pool, image):
+        with self._lock:
+            self.images[(pool, image)] = {'snapshots': {}, 'parent': None}
+
+    def _record(self, *call):
+        self.calls.append(call)
+
+    def _get(self, pool, image):
+        try:
+            return self.images[(pool, image)]
+        except KeyError:
+            if self._create_images:
+                img = {'snapshots': {}, 'parent': None}
+                self.images[(pool, image)] = img
+                return img
+            raise KeyError("No such image %s/%s" % (pool, image))
+
+    def _children(self, pool, image, snapshot):
+        return [
+            key for key, img in self.images.items()
+            if img['parent'] == (pool, image, snapshot)
+        ]
+
+    def image_exists(self, pool, image):
+        with self._lock:
+            self._record('info', pool, image)
+            return (pool, image) in self.images
+
+    def snapshot_exists(self, pool, image, snapshot):
+        with self._lock:
+            self._record('info', pool, image, snapshot)
+            img = self.images.get((pool, image))
+            return img is not None and snapshot in img['snapshots']
+
+    def create_image(self, pool, image, size):
+        with self._lock:
+            self._record('create', pool, image, size)
+            if (pool, image) in self.images:
+                raise ValueError("Image exists")
+            self.images[(pool, image)] = {'snapshots': {}, 'parent': None}
+
+    def remove_image(self, pool, image):
+        with self._lock:
+            self._record('rm', pool, image)
+            if self._get(pool, image)['snapshots']:
+                raise ValueError("Image %s/%s has snapshots" % (pool, image))
+            del self.images[(pool, image)]
+
+    def create_snapshot(self, pool, image, snapshot):
+        with self._lock:
+            self._record('snap create', pool, image, snapshot)
+            snapshots = self._get(pool, image)['snapshots']
+            if snapshot in snapshots:
+                raise ValueError("Snapshot exists")
+            snapshots[snapshot] = False
+
+    def protect_snapshot(self, pool, image, snapshot):
+        with self._lock:
+            self._record('snap protect', pool, image, snapshot)
+            self._get(pool, image)['snapshots'][snapshot] = True
+
+    def unprotect_snapshot(self, pool, image, snapshot):
+        with self._lock:
+            self._record('snap unprotect', pool, image, snapshot)
+            if self._children(pool, image, snapshot):
+                raise ValueError("Snapshot has children")
+            snapshots = self._get(pool, image)['snapshots']
+            if snapshot in snapshots:
+                snapshots[snapshot] = False
+
+    def remove_snapshot(self, pool, image, snapshot):
+        with self._lock:
+            self._record('snap rm', pool, image, snapshot)
+            snapshots = self._get(pool, image)['snapshots']
+            if snapshots[snapshot]:
+                raise ValueError("Snapshot is protected")
+            del snapshots[snapshot]
+
+    def rename_snapshot(self, pool, image, snapshot, new_name):
+        with self._lock:
+            self._record('snap rename', pool, image, snapshot, new_name)
+            snapshots = self._get(pool, image)['snapshots']
+            if new_name in snapshots:
+                raise ValueError("Snapshot exists")
+            snapshots[new_name] = snapshots.pop(snapshot)
+            # Clones refer to their parent by id, so they follow the rename
+            for key in self._children(pool, image, snapshot):
+                self.images[key]['parent'] = (pool, image, new_name)
+
+    def clone(self, pool, image, snapshot, clone):
+        with self._lock:
+            self._record('clone', pool, image, snapshot, clone)
+            if not self._get(pool, image)['snapshots'][snapshot]:
+                raise ValueError("Snapshot is not protected")
+            if (pool, clone) in self.images:
+                raise ValueError("Image exists")
+            self.images[(pool, clone)] = {
+                'snapshots': {},
+                'parent': (pool, image, snapshot),
+            }
+
+    def flatten(self, pool, image):
+        with self._lock:
+            self._record('flatten', pool, image)
+            self._get(pool, image)['parent'] = None
+
+
+# The rbd sub-command each operation corresponds to
+RBD_COMMANDS = {
+    'image_exists': 'info',
+    'snapshot_exists': 'info',
+    'create_image': 'create',
+    'remove_image': 'rm',
+    'create_snapshot': 'snap create',
+    'protect_snapshot': 'snap protect',
+    'unprotect_snapshot': 'snap unprotect',
+    'remove_snapshot': 'snap rm',
+    'rename_snapshot': 'snap rename',
+    'clone': 'clone',
+    'flatten': 'flatten',
+}
+
+
+class InstrumentedRbdBackend(RbdBackend):
+    """Wraps another backend, recording the latency and errors of calls."""
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def _call(self, operation, *args):
+        command = RBD_COMMANDS[operation]
+        start = time.perf_counter()
+        try:
+            return getattr(self.backend, operation)(*args)
+        except Exception:
+            RBD_COMMAND_ERRORS.labels(command).inc()
+            raise
+        finally:
+            RBD_COMMAND_DURATION.labels(command).observe(
+                time.perf_counter() - start,
+            )
+
+    def image_exists(self, pool, image):
+        return self._call('image_exists', pool, image)
+
+    def snapshot_exists(self, pool, image, snapshot):
+        return self._call('snapshot_exists', pool, image, snapshot)
+
+    def create_image(self, pool, image, size):
+        return self._call('create_image', pool, image, size)
+
+    def remove_image(self, pool, image):
+        return self._call('remove_image', pool, image)
+
+    def create_snapshot(self, pool, image, snapshot):
+        return self._call('create_snapshot', pool, image, snapshot)
+
+    def protect_snapshot(self, pool, image, snapshot):
+        return self._call('protect_snapshot', pool, image, snapshot)
+
+    def unprotect_snapshot(self, pool, image, snapshot):
+        return self._call('unprotect_snapshot', pool, image, snapshot)
+
+    def remove_snapshot(self, pool, image, snapshot):
+        return self._call('remove_snapshot', pool, image, snapshot)
+
+    def rename_snapshot(self, pool, image, snapshot, new_name):
+        return self._call(
+            'rename_snapshot', pool, image, snapshot, new_name,
+        )
+
+    def clone(self, pool, image, snapshot, clone):
+        return self._call('clone', pool, image, snapshot, clone)
+
+    def flatten(self, pool, image):
+        return self._call('flatten', pool, image)
+
+    def close(self):
+        self.backend.close()
+
+
+def make_rbd_backend(user):
+    if RBD_BACKEND == 'cli':
+        backend = CliRbdBackend()
+    elif RBD_BACKEND == 'native':
+        backend = NativeRbdBackend(user)
+    else:
+        raise ValueError("Unknown RBD_BACKEND %r" % RBD_BACKEND)
+    return InstrumentedRbdBackend(backend)
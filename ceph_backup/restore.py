@@ -0,0 +1,476 @@
+import argparse
+from datetime import datetime
+import json
+import kubernetes.client as k8s_client
+import kubernetes.config as k8s_config
+import logging
+import os
+import shlex
+import sys
+import time
+
+from .backup import BACKUP_IMAGE, BACKUP_IMAGE_PULL_POLICY, \
+    RESTIC_SECRET_NAME, ceph_from_env, format_env, job_status, \
+    restic_cache_mounts, restic_cache_script, restic_cache_volume
+from .ledger import SCHEDULE_LEDGER, Ledger
+from .metadata import METADATA_PREFIX, NAMESPACE, claim_info, volume_info, \
+    local_snapshot_name, parse_date, parse_size
+from .placement import container_resources, pod_placement
+from .rbd_backend import make_rbd_backend
+
+
+logger = logging.getLogger(__name__)
+
+
+# How often to check whether the restore job has finished
+POLL_INTERVAL = 5
+
+# How long to keep waiting for the restore job after its deadline, for
+# Kubernetes to mark it as failed
+DEADLINE_GRACE = 300
+
+MIB = 1 << 20
+
+# Prints the restic snapshots (listed oldest first, as JSON, on stdin) to
+# restore a block volume from: the last full backup and every backup since,
+# which are incremental. Backups taken without BLOCK_INCREMENTAL have no tag,
+# and are full backups. This is only used for volumes that have no recorded
+# chain (ANNOTATION_BACKUP_CHAIN), as it can't tell the snapshots left by
+# failed jobs apart
+SNAPSHOT_CHAIN_SCRIPT = """
+import json, sys
+snapshots = json.load(sys.stdin)
+full = [
+    i for i, s in enumerate(snapshots)
+    if 'incremental' not in (s.get('tags') or ())
+]
+if not full:
+    sys.exit("No full backup to restore from")
+for s in snapshots[full[-1]:]:
+    print(s['id'])
+"""
+
+
+def pick_local_snapshot(claim, at=None, max_age=None, now=None):
+    """Pick the local snapshot to restore from.
+
+    This is the newest one, or if ``at`` is given, the newest one taken at or
+    before that time. Returns the rank and start time of the backup, or None
+    if there is no local snapshot, or if it is older than ``max_age``.
+    """
+    for rank, start_time in enumerate(claim.local_snapshots, 1):
+        if at is not None and start_time > at:
+            continue
+        if max_age is not None:
+            age = ((now or datetime.utcnow()) - start_time).total_seconds()
+            if age > max_age:
+                return None
+        return rank, start_time
+    return None
+
+
+def restore_local_snapshot(rbd, vol, rank, target_image, flatten=True):
+    """Restore a volume from one of its local snapshots, as a new image.
+
+    The image is a clone of the snapshot, which makes it usable right away.
+    If ``flatten`` is set, the data is then copied into it, so that the
+    snapshot can be rotated out.
+    """
+    snapshot = local_snapshot_name(rank)
+    rbd.protect_snapshot(vol.rbd_pool, vol.rbd_name, snapshot)
+    rbd.clone(vol.rbd_pool, vol.rbd_name, snapshot, target_image)
+    logger.info(
+        "Cloned %s/%s@%s to %s/%s",
+        vol.rbd_pool, vol.rbd_name, snapshot, vol.rbd_pool, target_image,
+    )
+    if flatten:
+        rbd.flatten(vol.rbd_pool, target_image)
+        rbd.unprotect_snapshot(vol.rbd_pool, vol.rbd_name, snapshot)
+
+
+def restore_script(vol, snapshots, workers):
+    """Build the shell script restoring a volume from restic.
+
+    Block volumes are streamed from ``restic dump`` into the new image,
+    applying each snapshot in turn. If ``snapshots`` is None, the script
+    restores the last full backup followed by the incremental ones since,
+    going by their tags, and fails if there is no full backup. Filesystem
+    volumes are restored by ``restic restore`` (from the latest snapshot by
+    default), which writes files in parallel, into the new image mounted on
+    /data. The script writes a summary with the bytes written and the
+    duration as its termination message.
+    """
+    script = 'set -o pipefail; ' + restic_cache_script()
+    if vol.mode == 'Block':
+        if snapshots is None:
+            script += (
+                'SNAPSHOTS=$(restic snapshots --host "$HOST" --json'
+                + ' | python3 -c %s) || exit 1; '
+                % shlex.quote(SNAPSHOT_CHAIN_SCRIPT)
+                + 'echo "Restoring snapshots" $SNAPSHOTS >&2; '
+            )
+        else:
+            script += 'SNAPSHOTS=%s; ' % shlex.quote(' '.join(snapshots))
+        script += (
+            # The new image is empty, until the first snapshot is written
+            'SKIP_ZEROS=--skip-zeros; '
+            + '(for SNAPSHOT in $SNAPSHOTS; do'
+            + ' restic dump --host "$HOST" $SNAPSHOT /disk.qcow2'
+            + ' | qcow2-import --workers %d $SKIP_ZEROS /disk' % workers
+            + ' || exit 1; SKIP_ZEROS=;'
+            + ' done) > /dev/termination-log'
+        )
+    else:
+        snapshot, = snapshots or ['latest']
+        script += (
+            'START=$(date +%s.%N); '
+            + 'restic restore --host "$HOST" --target / '
+            + shlex.quote(snapshot)
+            + ' && printf \'{"message_type":"restore_summary",'
+            + '"bytes_written":%s,"total_duration":%s}\''
+            + ' "$(du -sb /data | cut -f 1)"'
+            + ' "$(awk "BEGIN { print $(date +%s.%N) - $START }")"'
+            + ' > /dev/termination-log'
+        )
+    return script
+
+
+def restore_from_restic(
+    api, rbd, ceph, claim, vol, target_image, snapshots, workers=8,
+    timeout=24 * 3600,
+):
+    """Restore a volume from restic, into a new image in the same pool.
+
+    The job is stopped if it hasn't finished after ``timeout`` seconds,
+    including the time its pod waits to be scheduled. Returns the restore
+    summaries, each with the bytes written and the time it took, or None if
+    the restore failed.
+    """
+    corev1 = k8s_client.CoreV1Api(api)
+    batchv1 = k8s_client.BatchV1Api(api)
+
+    size = parse_size(vol.size)
+    rbd.create_image(vol.rbd_pool, target_image, size)
+
+    labels = {
+        METADATA_PREFIX + 'restore': 'rbd',
+        METADATA_PREFIX + 'pvc-namespace': claim.namespace,
+        METADATA_PREFIX + 'pvc-name': claim.name,
+        METADATA_PREFIX + 'rbd-pool': vol.rbd_pool,
+        METADATA_PREFIX + 'rbd-name': target_image,
+    }
+    rbd_source = dict(
+        monitors=ceph['monitors'],
+        pool=vol.rbd_pool,
+        image=target_image,
+        user=ceph['user'],
+    )
+    volume_mounts = restic_cache_mounts()
+    volume_devices = None
+    pod_volumes = []
+    if vol.mode == 'Block':
+        host = 'rbd-block-%s-nspvc-%s' % (claim.namespace, claim.name)
+
+        # Block devices can only be attached through a PersistentVolumeClaim
+        name = 'restore-rbd-block-%s' % target_image
+        corev1.create_persistent_volume(k8s_client.V1PersistentVolume(
+            metadata=k8s_client.V1ObjectMeta(name=name, labels=labels),
+            spec=k8s_client.V1PersistentVolumeSpec(
+                access_modes=['ReadWriteOnce'],
+                capacity={'storage': vol.size},
+                persistent_volume_reclaim_policy='Retain',
+                storage_class_name='ceph-backup',
+                volume_mode='Block',
+                rbd=k8s_client.V1RBDVolumeSource(
+                    secret_ref=k8s_client.V1SecretReference(
+                        name=ceph['secret'],
+                        namespace=NAMESPACE,
+                    ),
+                    **rbd_source,
+                ),
+            ),
+        ))
+        corev1.create_namespaced_persistent_volume_claim(
+            NAMESPACE,
+            k8s_client.V1PersistentVolumeClaim(
+                metadata=k8s_client.V1ObjectMeta(name=name, labels=labels),
+                spec=k8s_client.V1PersistentVolumeClaimSpec(
+                    access_modes=['ReadWriteOnce'],
+                    resources=k8s_client.V1ResourceRequirements(
+                        requests={'storage': vol.size},
+                    ),
+                    storage_class_name='ceph-backup',
+                    volume_mode='Block',
+                    volume_name=name,
+                ),
+            ),
+        )
+        pod_volumes.append(k8s_client.V1Volume(
+            name='disk',
+            persistent_volume_claim=(
+                k8s_client.V1PersistentVolumeClaimVolumeSource(
+                    claim_name=name,
+                )
+            ),
+        ))
+        volume_devices = [
+            k8s_client.V1VolumeDevice(device_path='/disk', name='disk'),
+        ]
+    else:
+        host = 'rbd-fs-%s-nspvc-%s' % (claim.namespace, claim.name)
+
+        # The empty image gets formatted when it is first mounted
+        pod_volumes.append(k8s_client.V1Volume(
+            name='data',
+            rbd=k8s_client.V1RBDVolumeSource(
+                fs_type=vol.fstype or 'ext4',
+                secret_ref=k8s_client.V1SecretReference(
+                    name=ceph['secret'],
+                ),
+                **rbd_source,
+            ),
+        ))
+        volume_mounts.append(k8s_client.V1VolumeMount(
+            mount_path='/data',
+            name='data',
+        ))
+    cache_volume = restic_cache_volume()
+    if cache_volume is not None:
+        pod_volumes.append(cache_volume)
+
+    start = time.monotonic()
+    job = batchv1.create_namespaced_job(NAMESPACE, k8s_client.V1Job(
+        metadata=k8s_client.V1ObjectMeta(
+            generate_name='restore-rbd-%s-' % claim.namespace,
+            labels=labels,
+        ),
+        spec=k8s_client.V1JobSpec(
+            backoff_limit=0,
+            active_deadline_seconds=int(timeout),
+            ttl_seconds_after_finished=24 * 3600,
+            template=k8s_client.V1PodTemplateSpec(
+                metadata=k8s_client.V1ObjectMeta(labels=labels),
+                spec=k8s_client.V1PodSpec(
+                    restart_policy='Never',
+                    containers=[
+                        k8s_client.V1Container(
+                            name='restore',
+                            image=BACKUP_IMAGE,
+                            image_pull_policy=BACKUP_IMAGE_PULL_POLICY,
+                            args=[
+                                'bash', '-c',
+                                restore_script(vol, snapshots, workers),
+                            ],
+                            resources=container_resources(),
+                            env=format_env(
+                                RESTIC_REPOSITORY=(
+                                    'secret', RESTIC_SECRET_NAME, 'url',
+                                ),
+                                RESTIC_PASSWORD=(
+                                    'secret', RESTIC_SECRET_NAME, 'password',
+                                ),
+                                HOST=host,
+                            ),
+                            volume_mounts=volume_mounts,
+                            volume_devices=volume_devices,
+                        ),
+                    ],
+                    volumes=pod_volumes,
+                    **pod_placement(),
+                ),
+            ),
+        ),
+    ))
+    logger.info("Created job %s", job.metadata.name)
+
+    # Wait for the job to finish
+    while True:
+        time.sleep(POLL_INTERVAL)
+        job = batchv1.read_namespaced_job(job.metadata.name, NAMESPACE)
+        completed, successful = job_status(job)
+        if completed:
+            break
+        if time.monotonic() - start > timeout + DEADLINE_GRACE:
+            logger.error(
+                "Restore job %s didn't finish in time, deleting it",
+                job.metadata.name,
+            )
+            batchv1.delete_namespaced_job(
+                job.metadata.name, NAMESPACE,
+                propagation_policy='Foreground',
+            )
+            successful = False
+            break
+    elapsed = time.monotonic() - start
+
+    # Detach the new image from the cluster
+    if vol.mode == 'Block':
+        corev1.delete_namespaced_persistent_volume_claim(name, NAMESPACE)
+        corev1.delete_persistent_volume(name)
+
+    if not successful:
+        logger.error("Restore job %s failed", job.metadata.name)
+        return None
+
+    summaries = []
+    pods = corev1.list_namespaced_pod(
+        NAMESPACE,
+        label_selector='job-name=' + job.metadata.name,
+    ).items
+    for pod in pods:
+        for status in pod.status.container_statuses or ():
+            terminated = status.state and status.state.terminated
+            if terminated and terminated.message:
+                for line in terminated.message.splitlines():
+                    try:
+                        summaries.append(json.loads(line))
+                    except ValueError:
+                        pass
+
+    written = sum(s.get('bytes_written', 0) for s in summaries)
+    duration = sum(s.get('total_duration', 0) for s in summaries)
+    logger.info(
+        "Restored %.1f MiB in %.0fs (%.1f MiB/s), %.0fs including the job "
+        + "setup",
+        written / MIB, duration,
+        written / MIB / duration if duration else 0,
+        elapsed,
+    )
+    return summaries
+
+
+def main():
+    logging.basicConfig(
+        level=logging.INFO,
+        format="%(asctime)s %(levelname)s %(name)s: %(message)s",
+    )
+
+    parser = argparse.ArgumentParser(
+        'ceph-backup-restore',
+        description="Restore a backed up volume to a new RBD image",
+    )
+    parser.add_argument('--kubeconfig', nargs=1)
+    parser.add_argument(
+        '--at',
+        help="Restore the last backup started at or before this time "
+        + "(2006-01-02T15:04:05Z)",
+    )
+    parser.add_argument(
+        '--max-age', type=float,
+        help="Only restore from a local snapshot up to this many hours old",
+    )
+    parser.add_argument(
+        '--from-restic', action='store_true', default=False,
+        help="Restore from restic even if there is a local snapshot",
+    )
+    parser.add_argument(
+        '--snapshot', action='append',
+        help="Restic snapshot to restore (default: latest, or for block "
+        + "volumes, the last successful full backup and the incremental "
+        + "backups since). Several can be given for block volumes, applied "
+        + "in order",
+    )
+    parser.add_argument(
+        '--workers', type=int, default=8,
+        help="Number of threads writing block volumes",
+    )
+    parser.add_argument(
+        '--timeout', type=float, default=24,
+        help="Give up on restoring from restic after this many hours "
+        + "(default: 24)",
+    )
+    parser.add_argument(
+        '--no-flatten', action='store_false', dest='flatten', default=True,
+        help="Don't copy the data into the new image, which then depends on "
+        + "the snapshot (that can't be removed until the image is "
+        + "flattened)",
+    )
+    parser.add_argument('pvc', help="The volume to restore, as NAMESPACE/PVC")
+    parser.add_argument(
+        'image',
+        help="Name of the new image, in the same pool",
+    )
+    args = parser.parse_args()
+
+    if args.kubeconfig:
+        logger.info("Using specified config file")
+        k8s_config.load_kube_config(args.kubeconfig[0])
+    else:
+        logger.info("Using in-cluster config")
+        k8s_config.load_incluster_config()
+
+    namespace, name = args.pvc.split('/', 1)
+    corev1 = k8s_client.CoreV1Api()
+    claim = claim_info(json.loads(
+        corev1.read_namespaced_persistent_volume_claim(
+            name, namespace, _preload_content=False,
+        ).data
+    ))
+    if SCHEDULE_LEDGER:
+        # The local snapshots might only be listed in the ledger
+        claim = Ledger.load(k8s_client.ApiClient()).apply_claim(claim)
+    vol = volume_info(corev1.read_persistent_volume(claim.volume_name))
+    if vol is None or vol.type != 'rbd':
+        logger.critical("%s is not an RBD volume", args.pvc)
+        sys.exit(1)
+
+    picked = None
+    if not args.from_restic:
+        picked = pick_local_snapshot(
+            claim,
+            at=parse_date(args.at) if args.at else None,
+            max_age=(
+                args.max_age * 3600 if args.max_age is not None else None
+            ),
+        )
+    if picked is None and args.at and not args.snapshot:
+        logger.critical(
+            "No suitable local snapshot for %s, use --snapshot to pick the "
+            + "restic snapshot to restore",
+            args.pvc,
+        )
+        sys.exit(1)
+
+    rbd = make_rbd_backend(os.environ['CEPH_USER'])
+    try:
+        if picked is not None:
+            rank, start_time = picked
+            logger.info(
+                "Restoring %s from the local snapshot of the backup "
+                + "started %s",
+                args.pvc, start_time,
+            )
+            restore_local_snapshot(rbd, vol, rank, args.image, args.flatten)
+        else:
+            snapshots = args.snapshot
+            if snapshots is None and vol.mode == 'Block':
+                if claim.backup_chain:
+                    snapshots = claim.backup_chain
+                else:
+                    logger.warning(
+                        "No backup chain recorded for %s, picking the "
+                        + "restic snapshots by their tags",
+                        args.pvc,
+                    )
+            if (
+                vol.mode != 'Block'
+                and snapshots is not None
+                and len(snapshots) > 1
+            ):
+                logger.critical(
+                    "Filesystem volumes are restored from a single snapshot",
+                )
+                sys.exit(1)
+            logger.info(
+                "Restoring %s from restic snapshots %s",
+                args.pvc,
+                ', '.join(snapshots) if snapshots else "(latest)",
+            )
+            summaries = restore_from_restic(
+                k8s_client.ApiClient(), rbd, ceph_from_env(), claim, vol,
+                args.image, snapshots, args.workers, args.timeout * 3600,
+            )
+            if summaries is None:
+                sys.exit(1)
+    finally:
+        rbd.close()
@@ -0,0 +1,61 @@
+import contextlib
+import opentelemetry.trace
+import threading
+import time
+
+from .instrumentation import STAGE_DURATION
+from .table import print_table
+
+
+tracer = opentelemetry.trace.get_tracer(__name__)
+
+
+class StageTimes(object):
+    """Accumulates how long each stage of a pass took, across threads."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._stages = {}
+
+    @contextlib.contextmanager
+    def stage(self, name, attributes=None):
+        start = time.monotonic()
+        try:
+            with tracer.start_as_current_span(name, attributes=attributes):
+                yield
+        finally:
+            self.record(name, time.monotonic() - start)
+
+    def record(self, name, elapsed):
+        STAGE_DURATION.labels(name).observe(elapsed)
+        with self._lock:
+            try:
+                stage = self._stages[name]
+            except KeyError:
+                stage = self._stages[name] = [0, 0.0, 0.0]
+            stage[0] += 1
+            stage[1] += elapsed
+            stage[2] = max(stage[2], elapsed)
+
+    def reset(self):
+        with self._lock:
+            self._stages = {}
+
+    def summary(self):
+        with self._lock:
+            return [
+                (name, count, total, longest)
+                for name, (count, total, longest) in self._stages.items()
+            ]
+
+    def log_summary(self, log):
+        table = []
+        for name, count, total, longest in self.summary():
+            table.append((
+                name,
+                '%d' % count,
+                '%.1fs' % total,
+                '%.2fs' % (total / count),
+                '%.2fs' % longest,
+            ))
+        print_table(log, table, ('STAGE', 'COUNT', 'TOTAL', 'AVERAGE', 'MAX'))
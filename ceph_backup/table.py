@@ -0,0 +1,28 @@
+def print_table(log, table, header=None):
+    # Measure fields
+    table_iter = iter(table)
+    if header:
+        first_row = header
+    else:
+        try:
+            first_row = next(table_iter)
+        except StopIteration:
+            return
+    fields = [len(col) for col in first_row]
+    for row in table_iter:
+        if len(row) != len(fields):
+            raise ValueError("Inconsistent number of columns in table")
+        for col in range(len(row)):
+            fields[col] = max(fields[col], len(row[col]))
+
+    # Print table
+    def print_row(row):
+        line = []
+        for value, size in zip(row, fields):
+            line.append('{0: <{1}}'.format(value, size))
+        log('  '.join(line))
+
+    if header:
+        print_row(header)
+    for row in table:
+        print_row(row)
@@ -64,6 +64,137 @@ app.kubernetes.io/instance: {{ .Release.Name }}
 app.kubernetes.io/component: scheduler
 {{- end }}
 
+{{/*
+Scheduler environment, for the CronJob or the daemon
+*/}}
+{{- define "ceph-backup.scheduler.env" -}}
+- name: NAMESPACE
+  valueFrom:
+    fieldRef:
+      fieldPath: metadata.namespace
+- name: CEPH_MONITORS
+  valueFrom:
+    secretKeyRef:
+      name: {{ .Values.cephSecretName | quote }}
+      key: monitors
+- name: CEPH_USER
+  valueFrom:
+    secretKeyRef:
+      name: {{ .Values.cephSecretName | quote }}
+      key: user
+- name: CEPH_ARGS
+  value: "--conf /var/run/secrets/ceph/rbd.conf --keyring /var/run/secrets/ceph/rbd.conf --user $(CEPH_USER)"
+- name: CEPH_SECRET_NAME
+  value: {{ .Values.cephSecretName | quote }}
+- name: CEPH_KEY_SECRET_NAME
+  value: {{ .Values.cephKeySecretName | quote }}
+- name: RESTIC_SECRET_NAME
+  value: {{ .Values.resticSecretName | quote }}
+- name: BACKUP_IMAGE
+  value: "{{ .Values.backupImage.repository }}:{{ .Values.backupImage.tag | default .Chart.AppVersion }}"
+- name: BACKUP_IMAGE_PULL_POLICY
+  value: {{ .Values.backupImage.pullPolicy }}
+- name: SCHEDULER_MODE
+  value: {{ .Values.scheduler.mode | quote }}
+{{- with .Values.scheduler.budget }}
+- name: SCHEDULER_BUDGET
+  value: {{ . | quote }}
+{{- end }}
+- name: ADAPTIVE_INTERVAL
+  value: {{ .Values.scheduler.adaptiveInterval.enabled | quote }}
+- name: ADAPTIVE_CHANGE_TARGET
+  value: {{ .Values.scheduler.adaptiveInterval.changeTarget | quote }}
+- name: ADAPTIVE_MIN_INTERVAL_HOURS
+  value: {{ .Values.scheduler.adaptiveInterval.minIntervalHours | quote }}
+- name: ADAPTIVE_MAX_AGE_HOURS
+  value: {{ .Values.scheduler.adaptiveInterval.maxAgeHours | quote }}
+- name: BLOCK_INCREMENTAL
+  value: {{ .Values.blockIncremental.enabled | quote }}
+- name: BLOCK_FULL_INTERVAL_DAYS
+  value: {{ .Values.blockIncremental.fullIntervalDays | quote }}
+- name: LOCAL_SNAPSHOTS
+  value: {{ .Values.localSnapshots | quote }}
+- name: BLOCK_EXPORTER
+  value: {{ .Values.blockExporter.name | quote }}
+- name: BLOCK_EXPORT_WORKERS
+  value: {{ .Values.blockExporter.workers | quote }}
+- name: BLOCK_FINE_EXTENTS
+  value: {{ .Values.blockExporter.fineExtents | quote }}
+- name: BLOCK_COALESCE_GAP
+  value: {{ .Values.blockExporter.coalesceGap | quote }}
+- name: BLOCK_DROP_ZEROS
+  value: {{ .Values.blockExporter.dropZeros | quote }}
+- name: FS_SKIP_CLONE
+  value: {{ .Values.fsSkipClone | quote }}
+- name: FS_FAST_SCAN
+  value: {{ .Values.fsFastScan | quote }}
+- name: FS_BATCH_MAX_VOLUMES
+  value: {{ .Values.fsBatch.maxVolumes | quote }}
+- name: FS_BATCH_VOLUME_SIZE
+  value: {{ .Values.fsBatch.volumeSize | quote }}
+- name: FS_BATCH_MAX_SIZE
+  value: {{ .Values.fsBatch.maxSize | quote }}
+- name: CEPHFS_BACKUP
+  value: {{ .Values.cephfs.enabled | quote }}
+- name: CEPHFS_RCTIME_PRUNING
+  value: {{ .Values.cephfs.rctimePruning | quote }}
+- name: SCHEDULE_LEDGER
+  value: {{ .Values.scheduleLedger.enabled | quote }}
+- name: SCHEDULE_LEDGER_SHARDS
+  value: {{ .Values.scheduleLedger.shards | quote }}
+- name: SCHEDULE_LEDGER_ANNOTATIONS
+  value: {{ .Values.scheduleLedger.annotations | quote }}
+- name: RESTIC_CACHE_MODE
+  value: {{ .Values.resticCache.mode | quote }}
+- name: RESTIC_CACHE_HOST_PATH
+  value: {{ .Values.resticCache.hostPath | quote }}
+{{- if .Values.resticCache.pvc.create }}
+- name: RESTIC_CACHE_PVC
+  value: "{{ include "ceph-backup.fullname" . }}-restic-cache"
+{{- else if .Values.resticCache.pvc.claimName }}
+- name: RESTIC_CACHE_PVC
+  value: {{ .Values.resticCache.pvc.claimName | quote }}
+{{- end }}
+- name: RESTIC_CACHE_SLOTS
+  value: {{ .Values.resticCache.slots | quote }}
+- name: BACKUP_MAX_PODS_PER_NODE
+  value: {{ .Values.backupPods.maxPodsPerNode | quote }}
+- name: BACKUP_NODE_SELECTOR
+  value: {{ .Values.backupPods.nodeSelector | toJson | quote }}
+- name: BACKUP_TOLERATIONS
+  value: {{ .Values.backupPods.tolerations | toJson | quote }}
+- name: BACKUP_TOPOLOGY_SPREAD
+  value: {{ .Values.backupPods.topologySpreadConstraints | toJson | quote }}
+- name: BACKUP_RESOURCES
+  value: {{ .Values.backupPods.resources | toJson | quote }}
+- name: RBD_BACKEND
+  value: {{ .Values.rbdBackend | quote }}
+- name: BACKUP_CONCURRENCY
+  value: {{ .Values.concurrency.total | quote }}
+- name: BACKUP_POOL_CONCURRENCY
+  value: {{ .Values.concurrency.perPool | quote }}
+- name: BACKUP_MAX_RUNNING_JOBS
+  value: {{ .Values.inFlightLimits.jobs | quote }}
+{{- with .Values.inFlightLimits.bytes }}
+- name: BACKUP_MAX_INFLIGHT_BYTES
+  value: {{ . | quote }}
+{{- end }}
+{{- with .Values.schedulerMetrics.pushgateway }}
+- name: METRICS_PUSHGATEWAY
+  value: {{ . | quote }}
+{{- end }}
+{{- if .Values.jaeger.enabled }}
+- name: OTEL_TRACES_EXPORTER
+  value: "otlp_proto_grpc"
+- name: OTEL_EXPORTER_OTLP_ENDPOINT
+  value: "http://{{ include "ceph-backup.fullname" . }}-jaeger:4317"
+- name: OTEL_EXPORTER_OTLP_INSECURE
+  value: "true"
+- name: OTEL_RESOURCE_ATTRIBUTES
+  value: "service.name=ceph-backup-scheduler"
+{{- end }}
+{{- end }}
+
 {{/*
 Metrics labels
 */}}